@@ -0,0 +1,59 @@
+# Benchmark for appending rows to a dataset
+#
+# Compares three ways of storing rows produced one at a time:
+# resizing the dataset and writing each row through the wrappers
+# that codelets use (which stamp the dataset after each operation),
+# adding rows one by one with an Appender, and adding blocks of rows
+# with Appender.extend. Reports the throughput in rows per second.
+#
+# Usage: python appendable.py [number_of_rows [row_length]]
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from activepapers.storage import ActivePaper
+
+
+def resize_per_row(data, rows, row):
+    ds = data.create_dataset('resized', shape=(0, len(row)),
+                             dtype=row.dtype, maxshape=(None, len(row)))
+    for i in range(rows):
+        ds.resize(i+1, axis=0)
+        ds[i] = row
+
+
+def append_rows(data, rows, row):
+    with data.create_appendable('appended', row.dtype,
+                                (len(row),)) as appender:
+        for i in range(rows):
+            appender.append(row)
+
+
+def extend_blocks(data, rows, row):
+    block = np.tile(row, (1000, 1))
+    with data.create_appendable('extended', row.dtype,
+                                (len(row),)) as appender:
+        for i in range(0, rows, len(block)):
+            appender.extend(block[:rows-i])
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    row_length = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    row = np.arange(row_length, dtype=np.float64)
+    fd, filename = tempfile.mkstemp(suffix='.ap')
+    os.close(fd)
+    paper = ActivePaper(filename, 'w')
+    for label, function in [("resize per row", resize_per_row),
+                            ("append", append_rows),
+                            ("extend", extend_blocks)]:
+        start = time.time()
+        function(paper.data, rows, row)
+        elapsed = time.time() - start
+        print("%-15s %12.0f rows/s" % (label, rows/elapsed))
+    paper.close()
+    os.remove(filename)
@@ -0,0 +1,64 @@
+# Benchmark for copying compressed datasets
+#
+# Compares three ways of copying a gzip-compressed dataset to another
+# file: HDF5's object copy (used by copy_node for unchanged copies),
+# layout.copy_dataset with the chunk shape and filters of the source
+# (whose compressed chunks are copied unchanged, as when a paper is
+# repacked with a compression policy that it already satisfies), and
+# layout.copy_dataset with a different chunk shape (which decompresses
+# and compresses the data again). Reports the throughput in MB/s of
+# uncompressed data.
+#
+# Usage: python copying.py [number_of_rows [row_length]]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import h5py
+
+from activepapers.layout import copy_dataset
+
+
+def hdf5_copy(source, dest):
+    dest.copy(source, 'copy')
+
+
+def chunk_copy(source, dest):
+    copy_dataset(source, dest, 'copy',
+                 dict(chunks=source.chunks, compression='gzip',
+                      compression_opts=4, shuffle=True))
+
+
+def block_copy(source, dest):
+    chunks = (source.chunks[0]//2,) + source.chunks[1:]
+    copy_dataset(source, dest, 'copy',
+                 dict(chunks=chunks, compression='gzip',
+                      compression_opts=4, shuffle=True))
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    row_length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    directory = tempfile.mkdtemp()
+    data = np.random.normal(size=(rows, row_length)).round(2)
+    with h5py.File(os.path.join(directory, 'source.h5'), 'w') as f:
+        f.create_dataset('data', data=data, chunks=(1000, row_length),
+                         compression='gzip', compression_opts=4,
+                         shuffle=True)
+    source = h5py.File(os.path.join(directory, 'source.h5'), 'r')
+    for label, function in [("HDF5 copy", hdf5_copy),
+                            ("chunk copy", chunk_copy),
+                            ("block copy", block_copy)]:
+        filename = os.path.join(directory, 'dest.h5')
+        with h5py.File(filename, 'w') as dest:
+            start = time.time()
+            function(source['data'], dest)
+            elapsed = time.time() - start
+        os.remove(filename)
+        print("%-12s %10.1f MB/s" % (label, data.nbytes/elapsed/1e6))
+    source.close()
+    shutil.rmtree(directory)
@@ -0,0 +1,67 @@
+# Benchmark for the computation of the dependency hierarchy
+#
+# Builds synthetic dependency graphs with long chains of items,
+# without creating an ActivePaper, and measures the time needed
+# for computing the levels of the hierarchy.
+#
+# Usage: python dependency_hierarchy.py [number_of_items [chain_length]]
+
+import sys
+import time
+
+from activepapers.depgraph import levels
+
+
+def synthetic_graph(n_items, chain_length):
+    # Chains of items, each item depending on its predecessor in the
+    # chain and on the first item of the preceding chain.
+    dependencies = {}
+    for i in range(n_items):
+        chain, position = divmod(i, chain_length)
+        deps = []
+        if position > 0:
+            deps.append("/data/item%d" % (i-1))
+        if chain > 0:
+            deps.append("/data/item%d" % ((chain-1)*chain_length))
+        dependencies["/data/item%d" % i] = deps
+    return dependencies
+
+
+def quadratic_levels(dependencies):
+    # The algorithm used before the introduction of depgraph.levels
+    known = set()
+    unknown = set()
+    for path, deps in dependencies.items():
+        if deps:
+            unknown.add((path, frozenset(deps)))
+        else:
+            known.add(path)
+    yield set(known)
+    while unknown:
+        next = set(p for p, d in unknown if d <= known)
+        if not next:
+            raise ValueError("cyclic dependencies")
+        known |= next
+        unknown = set((p, d) for p, d in unknown if p not in next)
+        yield next
+
+
+def timing(function, dependencies):
+    start = time.time()
+    n_levels = sum(1 for level in function(dependencies))
+    return n_levels, time.time() - start
+
+
+if __name__ == '__main__':
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    chain_length = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    dependencies = synthetic_graph(n_items, chain_length)
+    n_levels, t = timing(levels, dependencies)
+    print("%d items, %d levels: %.3f s" % (n_items, n_levels, t))
+    # The quadratic algorithm is much too slow for the full graph
+    small = synthetic_graph(n_items // 10, chain_length // 10)
+    for name, function in [("Kahn", levels),
+                           ("quadratic", quadratic_levels)]:
+        n_levels, t = timing(function, small)
+        print("%s, %d items, %d levels: %.3f s"
+              % (name, len(small), n_levels, t))
@@ -0,0 +1,71 @@
+# Benchmark for the file format options of new ActivePapers
+#
+# Creates papers with many small datasets in /data using the default
+# file format and the options libver='latest', track_order=True, and
+# paged allocation, and measures the time needed for creating the
+# paper, opening it, listing its items (as 'aptool ls' does), and
+# iterating over the members of /data.
+#
+# Usage: python file_format.py [number_of_items [directory]]
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from activepapers.storage import ActivePaper
+
+formats = [("default", {}),
+           ("latest", dict(libver='latest')),
+           ("latest+order", dict(libver='latest', track_order=True)),
+           ("latest+order+paged", dict(libver='latest', track_order=True,
+                                       page_size=4096))]
+
+
+def make_paper(filename, n_items, options):
+    paper = ActivePaper(filename, 'w', **options)
+    value = np.arange(10)
+    for i in range(n_items):
+        paper.data['item%d' % i] = value
+    paper.close()
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def open_paper(filename):
+    ActivePaper(filename, 'r').close()
+
+
+def list_items(filename):
+    with ActivePaper(filename, 'r') as paper:
+        for item in paper.iter_items():
+            item.name
+
+
+def iterate(filename):
+    with ActivePaper(filename, 'r') as paper:
+        for name in paper.data_group:
+            paper.data_group[name].attrs.get('ACTIVE_PAPER_TIMESTAMP')
+
+
+if __name__ == '__main__':
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp()
+    print("%-20s %8s %8s %8s %8s %10s"
+          % ("format", "create", "open", "ls", "iterate", "size (MB)"))
+    for name, options in formats:
+        filename = os.path.join(directory, "benchmark-%s.ap" % name)
+        t_create = timed(make_paper, filename, n_items, options)
+        t_open = timed(open_paper, filename)
+        t_ls = timed(list_items, filename)
+        t_iter = timed(iterate, filename)
+        print("%-20s %8.2f %8.3f %8.2f %8.2f %10.1f"
+              % (name, t_create, t_open, t_ls, t_iter,
+                 os.path.getsize(filename)/1.e6))
+        os.remove(filename)
@@ -0,0 +1,64 @@
+# Benchmark for the latency of opening ActivePapers
+#
+# Creates a paper with many small datasets that depends on the Python
+# packages given on the command line (e.g. scipy matplotlib), and
+# measures the time needed by a fresh Python process for opening it
+# for reading, opening it with metadata_only=True, and listing its
+# items as 'aptool ls' does. Opening for reading defers the import of
+# the dependencies until a codelet is run, which is measured
+# separately ("open+import").
+#
+# Usage: python open_latency.py [number_of_items [package ...]]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from activepapers.storage import ActivePaper
+
+tasks = [("python", "import activepapers.storage"),
+         ("open", "ActivePaper(%r, 'r').close()"),
+         ("open+import", "p = ActivePaper(%r, 'r'); "
+                         "p.import_dependencies(); p.close()"),
+         ("metadata only", "ActivePaper(%r, 'r', metadata_only=True).close()"),
+         ("ls", "p = ActivePaper(%r, 'r', metadata_only=True); "
+                "[i.name for i in p.iter_items()]; p.close()")]
+
+repetitions = 5
+
+
+def make_paper(filename, n_items, dependencies):
+    paper = ActivePaper(filename, 'w', dependencies=dependencies)
+    value = np.arange(10)
+    for i in range(n_items):
+        paper.data['item%d' % i] = value
+    paper.close()
+
+
+def timed(statement):
+    # The best of several runs of statement in a new Python process
+    script = "from activepapers.storage import ActivePaper\n" + statement
+    times = []
+    for i in range(repetitions):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', script])
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    dependencies = sys.argv[2:]
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "benchmark.ap")
+    make_paper(filename, n_items, dependencies)
+    for label, statement in tasks:
+        if '%r' in statement:
+            statement = statement % ((filename,) * statement.count('%r'))
+        print("%-15s %8.3f s" % (label, timed(statement)))
+    os.remove(filename)
+    os.rmdir(directory)
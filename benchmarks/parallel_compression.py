@@ -0,0 +1,65 @@
+# Benchmark for parallel chunk compression and decompression
+#
+# Writes a large array of floating-point numbers to a gzip-compressed
+# dataset and reads it back, once through HDF5's serial filter pipeline
+# and once with the chunks (de)compressed in a pool of threads
+# (activepapers.chunkio), and reports the throughput of both.
+#
+# Usage: python parallel_compression.py [size_in_MB [workers [level]]]
+
+import sys
+import tempfile
+import time
+
+import numpy as np
+import h5py
+
+import activepapers.chunkio
+
+
+def make_data(size):
+    n = size // 8
+    # Smooth data with some noise, which compresses moderately well
+    x = np.linspace(0., 100., n)
+    return np.sin(x) + 1.e-3*np.random.random(n)
+
+
+def timed_io(data, level, parallel, workers):
+    with tempfile.NamedTemporaryFile(suffix='.h5') as f:
+        h5file = h5py.File(f.name, 'w')
+        ds = h5file.create_dataset('data', shape=data.shape,
+                                   dtype=data.dtype, chunks=(2**16,),
+                                   compression='gzip',
+                                   compression_opts=level, shuffle=True)
+        start = time.time()
+        if not parallel:
+            ds[...] = data
+        else:
+            activepapers.chunkio.write(ds, data, workers)
+        h5file.flush()
+        elapsed = time.time() - start
+        stored = ds.id.get_storage_size()
+        h5file.close()
+        h5file = h5py.File(f.name, 'r')
+        ds = h5file['data']
+        start = time.time()
+        if not parallel:
+            ds[...]
+        else:
+            activepapers.chunkio.read(ds, Ellipsis, workers)
+        read_time = time.time() - start
+        h5file.close()
+    return elapsed, read_time, stored
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    level = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    data = make_data(size*2**20)
+    for label, parallel in [("serial", False), ("parallel", True)]:
+        elapsed, read_time, stored = timed_io(data, level, parallel,
+                                              workers)
+        print("%-10s write %8.1f MB/s  read %8.1f MB/s  (stored %.1f%%)"
+              % (label, data.nbytes/elapsed/1.e6,
+                 data.nbytes/read_time/1.e6, 100.*stored/data.nbytes))
@@ -0,0 +1,170 @@
+# HDF5 cache settings for ActivePapers
+#
+# The settings are the keywords of h5py.File for the raw data chunk
+# cache (rdcc_nbytes, rdcc_nslots, rdcc_w0) and the page buffer
+# (page_buf_size), plus mdc_nbytes, the initial size of the metadata
+# cache. Settings that are not given explicitly to ActivePaper are
+# taken from the dictionary defaults, which is initialized from the
+# environment variables ACTIVEPAPERS_RDCC_NBYTES etc.
+#
+# With rdcc_nbytes='auto', the chunk cache is sized to hold several
+# chunks of the dataset with the largest chunks in the paper. The size
+# of the largest chunk is recorded in the file attribute
+# ACTIVE_PAPER_LARGEST_CHUNK when a paper is closed after writing
+# (see ActivePaper.close), such that opening a paper doesn't require
+# a walk through all its datasets. Papers written by earlier versions
+# of ActivePapers are walked until the attribute is added.
+#
+# The page buffer works only for papers created with the paged
+# file space strategy. It is ignored for other papers.
+
+import logging
+import os
+
+import h5py
+import numpy as np
+
+from activepapers.layout import default_chunk_size
+
+settings = ['rdcc_nbytes', 'rdcc_nslots', 'rdcc_w0', 'page_buf_size',
+            'mdc_nbytes']
+
+
+def _from_environment():
+    defaults = {}
+    for name in settings:
+        value = os.environ.get('ACTIVEPAPERS_' + name.upper(), None)
+        if value is None:
+            continue
+        if value == 'auto':
+            defaults[name] = value
+        elif name == 'rdcc_w0':
+            defaults[name] = float(value)
+        else:
+            defaults[name] = int(value)
+    return defaults
+
+defaults = _from_environment()
+
+# The number of chunks of the largest size held by an automatically
+# sized chunk cache, and the upper limit for its size in bytes.
+auto_chunks = 16
+auto_max_nbytes = 2**30
+
+
+def _next_prime(n):
+    # HDF5 recommends a prime number of hash table slots
+    def is_prime(n):
+        return all(n % d for d in range(3, int(n**0.5)+1, 2))
+    n = max(3, n) | 1
+    while not is_prime(n):
+        n += 2
+    return n
+
+
+# The file attribute recording the size of the largest chunk
+largest_chunk_attr = 'ACTIVE_PAPER_LARGEST_CHUNK'
+
+
+def chunk_size(dataset):
+    """
+    :return: the size in bytes of a chunk of dataset,
+             or 0 if dataset is not chunked
+    :rtype: int
+    """
+    if dataset.chunks is None:
+        return 0
+    return dataset.dtype.itemsize * int(np.prod(dataset.chunks))
+
+
+def largest_chunk(h5file):
+    """
+    :return: the size in bytes of the largest chunk of all datasets
+             in h5file, or 0 if there is no chunked dataset
+    :rtype: int
+    """
+    largest = [0]
+    def check(name, node):
+        if isinstance(node, h5py.Dataset):
+            largest[0] = max(largest[0], chunk_size(node))
+    h5file.visititems(check)
+    return largest[0]
+
+
+def auto_chunk_cache(chunk_size):
+    """
+    :param chunk_size: the size of the largest chunk in bytes
+    :return: the h5py.File keywords rdcc_nbytes and rdcc_nslots
+             for a chunk cache that can hold several chunks
+    :rtype: dict
+    """
+    chunk_size = max(chunk_size, default_chunk_size)
+    nbytes = min(auto_chunks * chunk_size, auto_max_nbytes)
+    nbytes = max(nbytes, 2**20)
+    return dict(rdcc_nbytes=nbytes,
+                rdcc_nslots=_next_prime(100 * (nbytes // chunk_size)))
+
+
+def file_options(cache):
+    """
+    :param cache: explicit cache settings, or None
+    :type cache: dict
+    :return: the cache settings obtained by completing cache
+             by the defaults
+    :rtype: dict
+    """
+    options = dict(defaults)
+    if cache:
+        for name in cache:
+            if name not in settings:
+                raise ValueError("unknown cache setting %s" % name)
+        options.update(cache)
+    return options
+
+
+def open_file(filename, mode, cache, **kwargs):
+    """
+    Open an HDF5 file with the cache settings in cache, completed
+    by the defaults. The remaining keyword arguments are passed
+    to h5py.File.
+
+    :rtype: h5py.File
+    """
+    options = file_options(cache)
+    mdc_nbytes = options.pop('mdc_nbytes', None)
+    if options.get('rdcc_nbytes') == 'auto':
+        if mode[0] == 'w':
+            largest = default_chunk_size
+        else:
+            driver_options = dict((k, v) for k, v in kwargs.items()
+                                  if k in ['driver', 'meta_ext', 'raw_ext'])
+            with h5py.File(filename, 'r', **driver_options) as h5file:
+                largest = h5file.attrs.get(largest_chunk_attr, None)
+                if largest is None:
+                    largest = largest_chunk(h5file)
+        options.update(auto_chunk_cache(int(largest)))
+    kwargs.update(options)
+    try:
+        h5file = h5py.File(filename, mode, **kwargs)
+    except IOError:
+        if 'page_buf_size' not in kwargs:
+            raise
+        logging.info("page buffer disabled for %s, which doesn't use "
+                     "paged file space allocation" % filename)
+        del kwargs['page_buf_size']
+        h5file = h5py.File(filename, mode, **kwargs)
+    if mdc_nbytes is not None:
+        set_metadata_cache(h5file, mdc_nbytes)
+    return h5file
+
+
+def set_metadata_cache(h5file, nbytes):
+    """
+    Set the size of the metadata cache of an open HDF5 file.
+    """
+    config = h5file.id.get_mdc_config()
+    config.set_initial_size = True
+    config.initial_size = nbytes
+    config.max_size = max(config.max_size, nbytes)
+    config.min_size = min(config.min_size, nbytes)
+    h5file.id.set_mdc_config(config)
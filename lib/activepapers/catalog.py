@@ -0,0 +1,541 @@
+# The item catalog of an ActivePaper
+#
+# The catalog is an optional dataset "catalog/items" in a paper. It
+# contains one entry per item and per group that is not an item, with
+# the information needed for listing and selecting items. Without the
+# catalog, this information must be obtained by walking through the
+# HDF5 hierarchy and reading several attributes of each node, which
+# is very slow for papers with many items.
+#
+# The catalog also contains the dependency graph of the paper
+# (see activepapers.depgraph) and a full-text index of its code
+# and documentation (see activepapers.textindex).
+#
+# While a paper is open, the catalog is kept in memory and updated
+# whenever an item is stamped or deleted. It is written back to the
+# HDF5 file when the paper is flushed or closed.
+
+import collections
+import fnmatch
+import re
+
+import numpy as np
+import h5py
+
+from activepapers.utility import utf8, h5vstring, datatype, owner, isstring
+from activepapers.depgraph import DependencyGraph, dependency_list
+from activepapers.textindex import TextIndex, sections as text_sections
+
+sections = ['/code', '/data', '/documentation']
+
+Entry = collections.namedtuple('Entry', ['path', 'datatype', 'owner',
+                                         'timestamp', 'dummy', 'group',
+                                         'size'])
+Entry.is_item = property(lambda self: not self.group
+                                      or self.datatype == 'data')
+
+entry_dtype = np.dtype([('path', h5vstring),
+                        ('datatype', h5vstring),
+                        ('owner', h5vstring),
+                        ('timestamp', np.int64),
+                        ('dummy', np.bool_),
+                        ('group', np.bool_),
+                        ('size', np.int64)])
+
+
+def make_entry(node):
+    """
+    :param node: an item or a group in a paper
+    :type node: h5py.Node
+    :return: the catalog entry describing the node
+    :rtype: Entry
+    """
+    is_group = isinstance(node, h5py.Group)
+    t = node.attrs.get('ACTIVE_PAPER_TIMESTAMP', None)
+    node_type = datatype(node) or ''
+    return Entry(utf8(node.name),
+                 node_type,
+                 owner(node) or '',
+                 0 if t is None else int(t),
+                 bool(node.attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False)),
+                 is_group,
+                 storage_size(node) if not is_group or node_type == 'data'
+                 else 0)
+
+
+def storage_size(node):
+    """
+    :return: the storage size in bytes of a dataset, or of all
+             datasets in a group
+    :rtype: int
+    """
+    if isinstance(node, h5py.Dataset):
+        return int(node.id.get_storage_size())
+    sizes = []
+    def add(name, item):
+        if isinstance(item, h5py.Dataset):
+            sizes.append(item.id.get_storage_size())
+    node.visititems(add)
+    return int(sum(sizes))
+
+
+def walk_nodes(h5file):
+    """
+    Generator yielding all items and groups in the paper stored
+    in h5file, in the order of a depth-first traversal of the HDF5
+    hierarchy.
+    """
+    def walk_group(group):
+        for node in group.values():
+            yield node
+            if isinstance(node, h5py.Group) and datatype(node) != 'data':
+                for subnode in walk_group(node):
+                    yield subnode
+    for section in sections:
+        for node in walk_group(h5file[section]):
+            yield node
+
+
+def walk(h5file):
+    """
+    Generator yielding the catalog entries for all items and groups
+    in the paper stored in h5file, in the order of a depth-first
+    traversal of the HDF5 hierarchy.
+    """
+    for node in walk_nodes(h5file):
+        yield make_entry(node)
+
+
+def scan(h5file):
+    """
+    Generator yielding the catalog entries for all items and groups
+    in the paper stored in h5file, like walk(). The HDF5 hierarchy
+    is traversed in a single pass by HDF5's object visitor, and each
+    object is opened only once.
+    """
+    for section in sections:
+        group = h5file[section]
+        objects = []
+        h5py.h5o.visit(group.id,
+                       lambda name, info: objects.append((name, info.type)),
+                       info=True)
+        data_item = None
+        for name, obj_type in objects:
+            if data_item is not None and name.startswith(data_item):
+                # Inside a data item
+                continue
+            oid = h5py.h5o.open(group.id, name)
+            if obj_type == h5py.h5o.TYPE_GROUP:
+                node = h5py.Group(oid)
+                if datatype(node) == 'data':
+                    data_item = name + b'/'
+            elif obj_type == h5py.h5o.TYPE_DATASET:
+                node = h5py.Dataset(oid)
+            else:
+                continue
+            yield make_entry(node)
+
+
+def entry_matches(entry, items=True, datatype=None, owner=None, dummy=None,
+                  patterns=None, after=None, before=None,
+                  min_size=None, max_size=None):
+    """
+    :param entry: a catalog entry
+    :type entry: Entry
+    :return: True if entry satisfies the criteria of Catalog.select
+    :rtype: bool
+    """
+    if items is not None and entry.is_item != items:
+        return False
+    if datatype is not None and entry.datatype != datatype:
+        return False
+    if owner is not None and entry.owner != owner:
+        return False
+    if dummy is not None and entry.dummy != dummy:
+        return False
+    if after is not None and entry.timestamp < after:
+        return False
+    if before is not None and entry.timestamp >= before:
+        return False
+    if min_size is not None and entry.size < min_size:
+        return False
+    if max_size is not None and entry.size > max_size:
+        return False
+    if patterns and not any(p.match(entry.path[1:]) for p in patterns):
+        return False
+    return True
+
+
+def _text_column(column):
+    # Variable-length strings as read by h5py (bytes or str objects)
+    # converted to a fixed-width unicode array
+    column = np.asarray(column)
+    if column.dtype.kind == 'O' and len(column) > 0 \
+       and isinstance(column[0], bytes):
+        column = column.astype('S')
+    if column.dtype.kind == 'S':
+        return np.char.decode(column, 'utf-8')
+    return column.astype('U')
+
+
+def _make_table(columns):
+    # A table with fixed-width unicode strings from a list of columns
+    # in the order of the fields of Entry, sorted by path
+    columns = [_text_column(c) if name in _text_fields
+               else np.asarray(c, entry_dtype[name])
+               for name, c in zip(Entry._fields, columns)]
+    table = np.empty((len(columns[0]),),
+                     [(name, c.dtype) for name, c
+                      in zip(Entry._fields, columns)])
+    for name, c in zip(Entry._fields, columns):
+        table[name] = c
+    return table[np.argsort(table['path'], kind='mergesort')]
+
+
+def _entries_table(entries):
+    return _make_table(list(zip(*entries)) if entries
+                       else [[] for name in Entry._fields])
+
+
+def _entry(row):
+    return Entry(str(row['path']), str(row['datatype']), str(row['owner']),
+                 int(row['timestamp']), bool(row['dummy']),
+                 bool(row['group']), int(row['size']))
+
+
+def _prefix_range(paths, prefix):
+    # The rows of a table sorted by path whose path starts with prefix
+    start = np.searchsorted(paths, prefix, side='left')
+    end = np.searchsorted(paths, prefix[:-1] + u'%c' % (ord(prefix[-1])+1),
+                          side='left')
+    return start, end
+
+
+def _glob_prefix(pattern):
+    # The part of a glob pattern before the first wildcard
+    return re.split(r'[*?\[]', pattern)[0]
+
+_text_fields = ['path', 'datatype', 'owner']
+
+
+class Catalog(object):
+
+    # The catalog is kept in memory as a structured array sorted by
+    # path (_table), with fixed-width unicode strings, plus the changes
+    # made since it was read or last saved (_delta, which maps paths
+    # to their new entries, or to None for deleted entries). Changes
+    # thus cost a dictionary update, and the table is sorted again
+    # only when it is saved or needed as a whole (see table()).
+
+    def __init__(self, h5file):
+        self.file = h5file
+        self._set_table(self._read())
+        self._modified = False
+        self.text = TextIndex(h5file)
+        if 'dependencies' in h5file['catalog']:
+            self.graph = DependencyGraph.read(h5file['catalog/dependencies'])
+        else:
+            # Catalog created before the dependency graph was added
+            self.graph = DependencyGraph(
+                (path, dependency_list(self.file[path]))
+                for path in self._table['path'])
+            self._modified = True
+
+    @classmethod
+    def create(cls, h5file):
+        h5file.require_group('catalog')
+        h5file.create_dataset('catalog/items', shape=(0,),
+                              dtype=entry_dtype, maxshape=(None,),
+                              chunks=(1024,))
+        catalog = cls(h5file)
+        catalog.rebuild()
+        return catalog
+
+    def _read(self):
+        items = self.file['catalog/items'][...]
+        return _make_table([items[name] for name in Entry._fields])
+
+    def refresh(self):
+        """
+        Re-read the catalog from a file opened in SWMR mode.
+        """
+        self.file['catalog/items'].refresh()
+        self._set_table(self._read())
+        if 'dependencies' in self.file['catalog']:
+            group = self.file['catalog/dependencies']
+            for name in group:
+                group[name].refresh()
+            self.graph = DependencyGraph.read(group)
+        self.text = TextIndex(self.file)
+        self._modified = False
+
+    def save(self):
+        """
+        Write the catalog to the HDF5 file, if it has been modified.
+        """
+        self.text.save()
+        if not self._modified:
+            return
+        table = self.table()
+        ds = self.file['catalog/items']
+        ds.resize((len(table),))
+        if len(table) > 0:
+            stored = np.empty(table.shape, entry_dtype)
+            for name in Entry._fields:
+                stored[name] = table[name].astype(object) \
+                               if name in _text_fields else table[name]
+            ds[...] = stored
+        self.graph.write(self.file.require_group('catalog/dependencies'))
+        self._modified = False
+
+    def rebuild(self):
+        """
+        Rebuild the catalog from the contents of the paper.
+        """
+        nodes = list(walk_nodes(self.file))
+        self._set_table(_entries_table([make_entry(node)
+                                        for node in nodes]))
+        self.graph = DependencyGraph((utf8(node.name), dependency_list(node))
+                                     for node in nodes)
+        self.text.rebuild()
+        self._changed()
+
+    def verify(self):
+        """
+        :return: a list of (path, catalog entry, actual entry) for
+                 all nodes whose catalog entry is missing, outdated,
+                 or refers to a non-existing node, or whose
+                 dependencies are not correctly recorded in the graph
+        :rtype: list
+        """
+        actual = {}
+        actual_deps = {}
+        for node in walk_nodes(self.file):
+            entry = make_entry(node)
+            actual[entry.path] = entry
+            actual_deps[entry.path] = dependency_list(node)
+        cataloged = dict((entry.path, entry)
+                         for entry in (_entry(row) for row in self.table()))
+        problems = []
+        for path in sorted(set(actual) | set(cataloged)):
+            if actual.get(path) != cataloged.get(path) \
+               or actual_deps.get(path, ()) != self.graph.dependencies(path):
+                problems.append((path, cataloged.get(path),
+                                 actual.get(path)))
+        return problems
+
+    def _set_table(self, table):
+        self._table = table
+        self._delta = {}
+
+    def _get(self, path):
+        # The entry for path, or None
+        if path in self._delta:
+            return self._delta[path]
+        paths = self._table['path']
+        i = np.searchsorted(paths, path)
+        if i < len(paths) and paths[i] == path:
+            return _entry(self._table[i])
+        return None
+
+    def _discard(self, path):
+        self._delta[path] = None
+        self.graph.discard(path)
+        self._discard_children(path)
+
+    def _discard_children(self, path):
+        prefix = path + '/'
+        start, end = _prefix_range(self._table['path'], prefix)
+        children = set(str(child)
+                       for child in self._table['path'][start:end])
+        children.update(child for child in self._delta
+                        if child.startswith(prefix))
+        for child in children:
+            if self._get(child) is not None:
+                self._delta[child] = None
+                self.graph.discard(child)
+
+    def _changed(self):
+        self._modified = True
+
+    def __len__(self):
+        paths = self._table['path']
+        n = len(paths)
+        for path, entry in self._delta.items():
+            i = np.searchsorted(paths, path)
+            in_table = i < len(paths) and paths[i] == path
+            n += (entry is not None) - in_table
+        return n
+
+    def __contains__(self, path):
+        return self._get(path) is not None
+
+    def __getitem__(self, path):
+        entry = self._get(path)
+        if entry is None:
+            raise KeyError(path)
+        return entry
+
+    def _in_sections(self, path, sections=sections):
+        return any(path.startswith(s + '/') for s in sections)
+
+    def _enclosing_item(self, path):
+        # Make sure that all groups containing path are in the catalog
+        # and return the data item containing path, if any.
+        parts = path.split('/')
+        for i in range(3, len(parts)):
+            parent = '/'.join(parts[:i])
+            entry = self._get(parent)
+            if entry is None:
+                node = self.file[parent]
+                entry = make_entry(node)
+                self._delta[parent] = entry
+                self.graph.set(parent, dependency_list(node))
+            if entry.is_item:
+                return parent
+        return None
+
+    def update(self, node):
+        """
+        Update the catalog after a change to node.
+        """
+        path = utf8(node.name)
+        if not self._in_sections(path):
+            return
+        item = self._enclosing_item(path)
+        if item is not None:
+            # Nodes inside a data item are not items themselves,
+            # a change to them is a change of the data item.
+            path = item
+            node = self.file[item]
+        entry = make_entry(node)
+        self._delta[path] = entry
+        self.graph.set(path, dependency_list(node))
+        if entry.group:
+            if entry.is_item:
+                self._discard_children(path)
+            else:
+                # Add the contents of groups that were copied
+                # as a whole from another file.
+                for name in node:
+                    if path + '/' + name not in self:
+                        self.update(node[name])
+        elif self._in_sections(path, text_sections):
+            self.text.update(node)
+        self._changed()
+
+    def remove(self, path):
+        """
+        Update the catalog after the deletion of the node at path.
+        """
+        path = utf8(path)
+        if path in self:
+            self._discard(path)
+            self._changed()
+        if self._in_sections(path, text_sections):
+            self.text.remove(path)
+
+    def _delta_tables(self):
+        # The rows of the table that are not changed, and a table
+        # of the changed entries
+        if not self._delta:
+            return self._table, None
+        unchanged = ~np.isin(self._table['path'],
+                             np.array(list(self._delta), dtype='U'))
+        changed = _entries_table([entry for entry in self._delta.values()
+                                  if entry is not None])
+        return self._table[unchanged], changed
+
+    def table(self):
+        """
+        :return: the catalog as an array sorted by path
+        :rtype: numpy.ndarray
+        """
+        if self._delta:
+            unchanged, changed = self._delta_tables()
+            self._set_table(_make_table(
+                [np.concatenate([unchanged[name], changed[name]])
+                 for name in Entry._fields]))
+        return self._table
+
+    def _mask(self, table, items, datatype, owner, dummy, patterns,
+              after, before, min_size, max_size):
+        mask = np.ones(table.shape, np.bool_)
+        if items is not None:
+            is_item = ~table['group'] | (table['datatype'] == 'data')
+            mask &= is_item if items else ~is_item
+        if datatype is not None:
+            mask &= table['datatype'] == datatype
+        if owner is not None:
+            mask &= table['owner'] == owner
+        if dummy is not None:
+            mask &= table['dummy'] == dummy
+        if after is not None:
+            mask &= table['timestamp'] >= after
+        if before is not None:
+            mask &= table['timestamp'] < before
+        if min_size is not None:
+            mask &= table['size'] >= min_size
+        if max_size is not None:
+            mask &= table['size'] <= max_size
+        if patterns:
+            matches = np.zeros(table.shape, np.bool_)
+            for pattern in patterns:
+                if isstring(pattern):
+                    # A glob pattern: only the paths starting with
+                    # the part before the first wildcard can match.
+                    prefix = _glob_prefix(pattern)
+                    if prefix:
+                        start, end = _prefix_range(table['path'],
+                                                   '/' + prefix)
+                    else:
+                        start, end = 0, len(table)
+                    if pattern == prefix + '*':
+                        matches[start:end] = True
+                        continue
+                    pattern = re.compile(fnmatch.translate(pattern))
+                else:
+                    start, end = 0, len(table)
+                candidates = start + np.flatnonzero(mask[start:end]
+                                                    & ~matches[start:end])
+                for i in candidates:
+                    if pattern.match(table['path'][i][1:]):
+                        matches[i] = True
+            mask &= matches
+        return mask
+
+    def select(self, items=True, datatype=None, owner=None, dummy=None,
+               patterns=None, after=None, before=None,
+               min_size=None, max_size=None):
+        """
+        :param items: True for selecting items, False for groups that
+                      are not items, None for both
+        :param datatype: the ActivePapers datatype of the selected items
+        :param owner: the path of the codelet that generated the
+                      selected items
+        :param dummy: True/False for selecting only dummy/non-dummy items
+        :param patterns: glob patterns or compiled regular expressions,
+                         at least one of which must match the path of a
+                         selected item (without the initial slash)
+        :param after: the earliest timestamp of the selected items
+                      (in milliseconds since the epoch)
+        :param before: the timestamp before which the selected items
+                       were modified (in milliseconds since the epoch)
+        :param min_size: the minimal storage size of the selected items
+        :param max_size: the maximal storage size of the selected items
+        :return: the catalog entries of the selected items, sorted
+                 by path
+        :rtype: numpy.ndarray
+        """
+        criteria = dict(items=items, datatype=datatype, owner=owner,
+                        dummy=dummy, patterns=patterns, after=after,
+                        before=before, min_size=min_size, max_size=max_size)
+        unchanged, changed = self._delta_tables()
+        selected = unchanged[self._mask(unchanged, **criteria)]
+        if changed is None:
+            return selected
+        changed = changed[self._mask(changed, **criteria)]
+        if len(changed) == 0:
+            return selected
+        return _make_table([np.concatenate([selected[name], changed[name]])
+                            for name in Entry._fields])
@@ -0,0 +1,308 @@
+# Parallel compression and decompression of dataset chunks
+#
+# HDF5 applies the filters of a chunked dataset one chunk at a time,
+# in the thread that reads or writes the data. For datasets whose
+# filter pipeline consists of shuffling and deflate (gzip) compression,
+# the functions in this module apply the filters in a pool of threads
+# (zlib releases the GIL) and transfer the compressed chunks using
+# h5py's direct chunk I/O. The stored chunks are identical to those
+# that HDF5 would have produced.
+#
+# Chunks can also be copied without decompression between datasets
+# with identical chunk shapes and filters (see copy_chunks).
+
+import itertools
+import multiprocessing
+import numbers
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import h5py
+
+_filter_shuffle = h5py.h5z.FILTER_SHUFFLE
+_filter_deflate = h5py.h5z.FILTER_DEFLATE
+
+# The number of chunks handed to the thread pool at a time,
+# per worker thread
+_batch_size = 4
+
+
+def filter_pipeline(dataset):
+    """
+    :return: the filters of dataset as a list of (filter id, parameters),
+             or None if the pipeline contains filters other than
+             shuffle and deflate, or if the dataset isn't chunked
+    :rtype: list
+    """
+    if dataset.chunks is None or dataset.is_virtual \
+       or dataset.dtype.hasobject:
+        return None
+    dcpl = dataset.id.get_create_plist()
+    pipeline = []
+    for i in range(dcpl.get_nfilters()):
+        code, flags, values, name = dcpl.get_filter(i)
+        if code not in (_filter_shuffle, _filter_deflate):
+            return None
+        pipeline.append((code, values))
+    return pipeline
+
+
+def _shuffle(buf, itemsize):
+    if itemsize == 1:
+        return buf
+    block = np.frombuffer(buf, np.uint8).reshape((-1, itemsize))
+    return np.ascontiguousarray(block.T).tobytes()
+
+
+def _unshuffle(buf, itemsize):
+    if itemsize == 1:
+        return buf
+    block = np.frombuffer(buf, np.uint8).reshape((itemsize, -1))
+    return np.ascontiguousarray(block.T)
+
+
+def _encode(block, chunks, fillvalue, pipeline):
+    if block.shape != chunks:
+        # HDF5 stores edge chunks in full size, padded by the fill value
+        padded = np.empty(chunks, block.dtype)
+        padded[...] = fillvalue
+        padded[tuple(slice(0, n) for n in block.shape)] = block
+        block = padded
+    buf = np.ascontiguousarray(block).tobytes()
+    for code, values in pipeline:
+        if code == _filter_shuffle:
+            buf = _shuffle(buf, block.dtype.itemsize)
+        else:
+            buf = zlib.compress(buf, values[0] if values else 6)
+    return buf
+
+
+def _decode(buf, filter_mask, dtype, pipeline):
+    for i in range(len(pipeline)-1, -1, -1):
+        if filter_mask & (1 << i):
+            # Filter skipped when the chunk was written
+            continue
+        code, values = pipeline[i]
+        if code == _filter_shuffle:
+            buf = _unshuffle(buf, dtype.itemsize)
+        else:
+            buf = zlib.decompress(buf)
+    return np.frombuffer(buf, dtype)
+
+
+def filters(dataset):
+    """
+    :return: the filters of a chunked dataset as a list of
+             (filter id, flags, parameters)
+    :rtype: list
+    """
+    dcpl = dataset.id.get_create_plist()
+    return [dcpl.get_filter(i)[:3] for i in range(dcpl.get_nfilters())]
+
+
+def chunk_offsets(shape, chunks):
+    """
+    :return: the offsets of all chunks of a dataset of the given
+             shape and chunk shape
+    :rtype: iterator
+    """
+    return itertools.product(*[range(0, n, c)
+                               for n, c in zip(shape, chunks)])
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write(dataset, data, workers=None):
+    """
+    Write data to the complete dataset, applying the filters
+    in a pool of threads if possible.
+
+    :param dataset: an HDF5 dataset
+    :param data: an array of the same shape as dataset
+    :param workers: the number of threads (default: the number of
+                    processors)
+    """
+    pipeline = filter_pipeline(dataset)
+    if pipeline is None or dataset.size == 0:
+        dataset[...] = data
+        return
+    data = np.asarray(data, dtype=dataset.dtype)
+    if data.shape != dataset.shape:
+        data = np.broadcast_to(data, dataset.shape)
+    chunks = dataset.chunks
+    fillvalue = dataset.fillvalue
+    def encode(offset):
+        block = data[tuple(slice(o, o+c) for o, c in zip(offset, chunks))]
+        return offset, _encode(block, chunks, fillvalue, pipeline)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        for batch in _batches(chunk_offsets(dataset.shape, chunks),
+                              _batch_size*workers):
+            for offset, buf in pool.map(encode, batch):
+                dataset.id.write_direct_chunk(offset, buf)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def create_dataset(group, name, args, kwargs, workers=None):
+    """
+    Create a dataset like h5py's create_dataset, but write its
+    initial data using write().
+
+    :param args: the positional arguments to h5py's create_dataset,
+                 after the name of the dataset
+    :param kwargs: the keyword arguments to h5py's create_dataset
+    """
+    params = dict(zip(['shape', 'dtype', 'data'], args))
+    params.update(kwargs)
+    data = params.pop('data', None)
+    if data is None:
+        return group.create_dataset(name, **params)
+    data = np.asarray(data)
+    if params.get('shape') is None:
+        params['shape'] = data.shape
+    if params.get('dtype') is None:
+        params['dtype'] = data.dtype
+    dataset = group.create_dataset(name, **params)
+    write(dataset, data, workers)
+    return dataset
+
+
+def _region(selection, shape):
+    # The start and stop indices along each axis of the block
+    # defined by selection, and the axes that are indexed by an
+    # integer. None for selections other than integers, slices
+    # without step, and Ellipsis.
+    if not isinstance(selection, tuple):
+        selection = (selection,)
+    ellipses = [i for i, s in enumerate(selection) if s is Ellipsis]
+    if len(ellipses) > 1:
+        return None
+    if ellipses:
+        i = ellipses[0]
+        selection = selection[:i] \
+                    + (len(shape)-len(selection)+1)*(slice(None),) \
+                    + selection[i+1:]
+    if len(selection) > len(shape):
+        return None
+    selection = selection + (len(shape)-len(selection))*(slice(None),)
+    starts = []
+    stops = []
+    squeeze = []
+    for axis, (s, n) in enumerate(zip(selection, shape)):
+        if isinstance(s, slice):
+            start, stop, step = s.indices(n)
+            if step != 1:
+                return None
+            stop = max(start, stop)
+        elif isinstance(s, numbers.Integral):
+            start = s+n if s < 0 else s
+            if not 0 <= start < n:
+                raise IndexError("index %d out of range for axis %d"
+                                 % (s, axis))
+            stop = start + 1
+            squeeze.append(axis)
+        else:
+            return None
+        starts.append(start)
+        stops.append(stop)
+    return starts, stops, squeeze
+
+
+def read(dataset, selection=Ellipsis, workers=None):
+    """
+    Read dataset[selection], applying the filters in a pool of threads
+    if possible. This is the case for selections consisting of integers,
+    slices without step, and Ellipsis. Other selections are read
+    by HDF5.
+
+    :param dataset: an HDF5 dataset
+    :param selection: an index expression
+    :param workers: the number of threads (default: the number of
+                    processors)
+    :rtype: numpy.ndarray
+    """
+    pipeline = filter_pipeline(dataset)
+    region = None
+    if pipeline is not None:
+        region = _region(selection, dataset.shape)
+    if region is None:
+        return dataset[selection]
+    starts, stops, squeeze = region
+    result = np.empty([b-a for a, b in zip(starts, stops)], dataset.dtype)
+    result_index = tuple(0 if axis in squeeze else slice(None)
+                         for axis in range(len(starts)))
+    if result.size == 0:
+        return result[result_index]
+    chunks = dataset.chunks
+    fillvalue = dataset.fillvalue
+    def decode(raw_chunk):
+        offset, filter_mask, buf = raw_chunk
+        dest = []
+        source = []
+        for o, c, a, b in zip(offset, chunks, starts, stops):
+            dest.append(slice(max(a, o)-a, min(b, o+c)-a))
+            source.append(slice(max(a, o)-o, min(b, o+c)-o))
+        if buf is None:
+            # Chunk never written
+            result[tuple(dest)] = fillvalue
+        else:
+            block = _decode(buf, filter_mask, dataset.dtype, pipeline)
+            result[tuple(dest)] = block.reshape(chunks)[tuple(source)]
+    def read_chunk(offset):
+        if dataset.id.get_chunk_info_by_coord(offset).byte_offset is None:
+            return offset, 0, None
+        filter_mask, buf = dataset.id.read_direct_chunk(offset)
+        return offset, filter_mask, buf
+    offsets = itertools.product(*[range(a - a % c, b, c)
+                                  for a, b, c in zip(starts, stops, chunks)])
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        for batch in _batches(offsets, _batch_size*workers):
+            pool.map(decode, [read_chunk(offset) for offset in batch])
+    finally:
+        pool.close()
+        pool.join()
+    return result[result_index]
+
+
+def copy_chunks(source, dest):
+    """
+    Copy the stored chunks of source to dest without decompressing
+    them. This is possible only if both datasets have the same shape,
+    dtype, chunk shape, and filters.
+
+    :return: the number of chunks and the number of bytes copied,
+             or None if the chunks can't be copied
+    :rtype: tuple
+    """
+    # Variable-length data refers to the global heap of its file
+    # and can't be copied as raw bytes.
+    if source.chunks is None or source.is_virtual \
+       or source.dtype.hasobject \
+       or source.chunks != dest.chunks \
+       or source.shape != dest.shape \
+       or source.id.get_type() != dest.id.get_type() \
+       or filters(source) != filters(dest):
+        return None
+    nchunks = source.id.get_num_chunks()
+    nbytes = 0
+    for i in range(nchunks):
+        info = source.id.get_chunk_info(i)
+        filter_mask, buf = source.id.read_direct_chunk(info.chunk_offset)
+        dest.id.write_direct_chunk(info.chunk_offset, buf, filter_mask)
+        nbytes += len(buf)
+    return nchunks, nbytes
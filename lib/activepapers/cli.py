@@ -13,6 +13,11 @@ import numpy
 import h5py
 
 import activepapers.storage
+import activepapers.catalog
+import activepapers.layout
+import activepapers.contentstore
+import activepapers.copying
+import activepapers.library
 from activepapers.utility import ascii, datatype, mod_time, stamp, \
                                  timestamp, raw_input
 
@@ -162,7 +167,7 @@ def update_from_file(paper, filename, type=None,
         if dry_run:
             sys.stdout.write("Delete %s\n" % item.name)
         else:
-            del item.parent[item.name.split('/')[-1]]
+            paper.delete_item(item.name)
     if dry_run:
         fulltype = type if language is None else '/'.join((type, language))
         sys.stdout.write("Create item %s of type %s from file %s\n"
@@ -185,42 +190,73 @@ def directory_pattern(pattern):
         return None
     return pattern + "/*"
 
-def process_patterns(patterns):
+def expand_patterns(patterns):
     if patterns is None:
         return None
     patterns = sum([(p, directory_pattern(p)) for p in patterns], ())
-    patterns = [re.compile(fnmatch.translate(p))
-                for p in patterns
-                if p is not None]
-    return patterns
+    return [p for p in patterns if p is not None]
+
+def process_patterns(patterns):
+    if patterns is None:
+        return None
+    return [re.compile(fnmatch.translate(p))
+            for p in expand_patterns(patterns)]
 
 #
 #  Command handlers called from argparse
 #
 
-def create(paper, d=None):
+def create(paper, d=None, catalog=False, libver=None, track_order=False,
+           page_size=None, split=False):
     if paper is None:
         sys.stderr.write("no paper given\n")
         raise CLIExit
-    paper = activepapers.storage.ActivePaper(paper, 'w', d)
+    paper = activepapers.storage.ActivePaper(paper, 'w', d, catalog=catalog,
+                                             libver=libver,
+                                             track_order=track_order,
+                                             page_size=page_size,
+                                             split=split)
     paper.close()
 
-def ls(paper, long, type, pattern):
-    paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r')
-    pattern = process_patterns(pattern)
+def _catalog_entries(paper, type, pattern):
+    # Select items using the catalog of the paper if it exists,
+    # or by walking through all items otherwise.
+    if paper.catalog is not None:
+        if type == 'dummy':
+            selection = dict(dummy=True)
+        elif type is not None:
+            selection = dict(datatype=type, dummy=False)
+        else:
+            selection = {}
+        for entry in paper.catalog.select(patterns=pattern, **selection):
+            yield activepapers.catalog.Entry(*entry)
+        return
+    if pattern:
+        pattern = [re.compile(fnmatch.translate(p)) for p in pattern]
     for item in paper.iter_items():
-        name = item.name[1:] # remove initial slash
-        dtype = datatype(item)
-        if item.attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False):
+        entry = activepapers.catalog.make_entry(item)
+        if entry.dummy:
             dtype = 'dummy'
+        else:
+            dtype = entry.datatype
         if pattern and \
-           not any(p.match(name) for p in pattern):
+           not any(p.match(entry.path[1:]) for p in pattern):
             continue
         if type is not None and dtype != type:
             continue
+        yield entry
+
+def ls(paper, long, type, pattern):
+    paper = get_paper(paper)
+    paper = activepapers.storage.ActivePaper(paper, 'r', metadata_only=True)
+    pattern = expand_patterns(pattern)
+    if long:
+        stale = paper.stale_items()
+    for entry in _catalog_entries(paper, type, pattern):
+        name = entry.path[1:] # remove initial slash
+        dtype = 'dummy' if entry.dummy else entry.datatype
         if long:
-            t = item.attrs.get('ACTIVE_PAPER_TIMESTAMP', None)
+            t = entry.timestamp or None
             if t is None:
                 sys.stdout.write(21*" ")
             else:
@@ -228,15 +264,15 @@ def ls(paper, long, type, pattern):
                                                time.localtime(t/1000.)))
             field_len = len("importlet ")  # the longest data type name
             sys.stdout.write((dtype + field_len*" ")[:field_len])
-            sys.stdout.write('*' if paper.is_stale(item) else ' ')
+            sys.stdout.write('*' if entry.path in stale else ' ')
         sys.stdout.write(name)
         sys.stdout.write('\n')
     paper.close()
 
 def rm(paper, force, pattern):
     paper_name = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper_name, 'r')
-    deps = paper.dependency_graph()
+    paper = activepapers.storage.ActivePaper(paper_name, 'r',
+                                             metadata_only=True)
     pattern = process_patterns(pattern)
     if not pattern:
         return
@@ -244,18 +280,10 @@ def rm(paper, force, pattern):
     for item in it.chain(paper.iter_items(), paper.iter_groups()):
         if any(p.match(item.name[1:]) for p in pattern):
             names.add(item.name)
+    names |= paper.dependents(names, transitive=True)
     paper.close()
     if not names:
         return
-    while True:
-        new_names = set()
-        for name in names:
-            for dep in deps[name]:
-                new_names.add(dep)
-        if new_names - names:
-            names |= new_names
-        else:
-            break
     names = sorted(names)
     if not force:
         for name in names:
@@ -274,15 +302,15 @@ def rm(paper, force, pattern):
         if isinstance(paper.file[name], h5py.Group):
             most_recent_group = name
         try:
-            del paper.file[name]
+            paper.delete_item(name)
         except:
             sys.stderr.write("Can't delete %s\n" % name)
     paper.close()
 
 def dummy(paper, force, pattern):
     paper_name = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper_name, 'r')
-    deps = paper.dependency_graph()
+    paper = activepapers.storage.ActivePaper(paper_name, 'r',
+                                             metadata_only=True)
     pattern = process_patterns(pattern)
     if not pattern:
         return
@@ -312,7 +340,7 @@ def dummy(paper, force, pattern):
             raise
     paper.close()
 
-def set_(paper, dataset, expr):
+def set_(paper, dataset, expr, gzip=None, shuffle=False, workers=None):
     paper = get_paper(paper)
     paper = activepapers.storage.ActivePaper(paper, 'r+')
     value = eval(expr, numpy.__dict__, {})
@@ -320,7 +348,15 @@ def set_(paper, dataset, expr):
         del paper.data[dataset]
     except KeyError:
         pass
-    paper.data[dataset] = value
+    if gzip is None and workers is None:
+        paper.data[dataset] = value
+    else:
+        options = {}
+        if gzip is not None:
+            options = dict(compression='gzip', compression_opts=gzip,
+                           shuffle=shuffle)
+        paper.data.create_dataset(dataset, data=value, workers=workers,
+                                  **options)
     paper.close()
 
 def group(paper, group_name):
@@ -332,7 +368,7 @@ def group(paper, group_name):
         raise CLIExit
     paper = get_paper(paper)
     paper = activepapers.storage.ActivePaper(paper, 'r+')
-    paper.file.create_group(group_name)
+    paper.node_changed(paper.file.create_group(group_name))
     paper.close()
 
 def extract(paper, dataset, filename):
@@ -369,9 +405,9 @@ def import_module(paper, module):
     paper.import_module(module)
     paper.close()
 
-def run(paper, codelet, debug, profile, checkin):
+def run(paper, codelet, debug, profile, checkin, swmr=False):
     paper = get_paper(paper)
-    with activepapers.storage.ActivePaper(paper, 'r+') as paper:
+    with activepapers.storage.ActivePaper(paper, 'r+', swmr=swmr) as paper:
         if checkin:
             for root, dirs, files in os.walk('code'):
                 for f in files:
@@ -398,21 +434,20 @@ def run(paper, codelet, debug, profile, checkin):
             sys.stderr.write(exc)
 
 def _find_calclet_for_dummy_or_stale_item(paper_name):
-    paper = activepapers.storage.ActivePaper(paper_name, 'r')
-    deps = paper.dependency_hierarchy()
+    paper = activepapers.storage.ActivePaper(paper_name, 'r',
+                                             metadata_only=True)
+    deps = paper.dependency_hierarchy(nodes=False)
     next(deps) # the first set has no dependencies
+    stale = paper.stale_items()
     calclet = None
     item_name = None
     for item_set in deps:
-        for item in item_set:
-            if paper.is_dummy(item) or paper.is_stale(item):
-                item_name = item.name
+        for name in sorted(item_set):
+            item = paper.file[name]
+            if paper.is_dummy(item) or name in stale:
+                item_name = name
                 calclet = item.attrs['ACTIVE_PAPER_GENERATING_CODELET']
                 break
-        # We must del item_set to prevent h5py from crashing when the
-        # file is closed. Presumably there are HDF5 handles being freed
-        # as a consequence of the del.
-        del item_set
         if calclet is not None:
             break
     paper.close()
@@ -489,20 +524,24 @@ def ln(paper, reference, name):
             ref_path = None
         paper.create_ref(name, ref_type + ':' + ref_name, ref_path)
     
-def cp(paper, reference, name):
+def cp(paper, reference, name, verbose=False):
     ref_parts = reference.split(':')
     if len(ref_parts) != 3:
         sys.stderr.write('Invalid reference %s\n' % reference)
         raise CLIExit
     ref_type, ref_name, ref_path = ref_parts
+    statistics = activepapers.copying.CopyStatistics()
     with activepapers.storage.ActivePaper(get_paper(paper), 'r+') as paper:
         if ref_path == '':
             ref_path = None
-        paper.create_copy(name, ref_type + ':' + ref_name, ref_path)
+        paper.create_copy(name, ref_type + ':' + ref_name, ref_path,
+                          statistics)
+    if verbose:
+        sys.stdout.write("Copied %s\n" % statistics)
 
 def refs(paper, verbose):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r')
+    paper = activepapers.storage.ActivePaper(paper, 'r', metadata_only=True)
     refs = paper.external_references()
     paper.close()
     sorted_refs = sorted(refs.keys())
@@ -558,3 +597,185 @@ def ipython(paper, modify):
     data = paper.data
     IPython.embed()
     paper.close()
+
+def catalog(paper, rebuild, verify):
+    paper = get_paper(paper)
+    with activepapers.storage.ActivePaper(paper,
+                                          'r+' if rebuild else 'r') as paper:
+        if rebuild:
+            paper.rebuild_catalog()
+        if paper.catalog is None:
+            sys.stderr.write("paper has no catalog, use --rebuild "
+                             "to create one\n")
+            raise CLIExit
+        if verify or rebuild:
+            problems = paper.catalog.verify()
+            for path, cataloged, actual in problems:
+                if cataloged is None:
+                    sys.stdout.write("missing from catalog: %s\n" % path)
+                elif actual is None:
+                    sys.stdout.write("not in paper: %s\n" % path)
+                else:
+                    sys.stdout.write("outdated: %s\n" % path)
+            if problems:
+                raise CLIExit
+        else:
+            table = paper.catalog.table()
+            nitems = (~table['group'] | (table['datatype'] == 'data')).sum()
+            sys.stdout.write("%d items, %d groups\n"
+                             % (nitems, len(table)-nitems))
+
+def tune_compression(paper, samples, sample_size, bandwidth, min_size, apply):
+    paper = get_paper(paper)
+    with activepapers.storage.ActivePaper(paper,
+                                          'r+' if apply else 'r') as paper:
+        datasets = []
+        def collect(name, node):
+            if isinstance(node, h5py.Dataset) \
+               and node.dtype.kind in 'biufc' \
+               and node.size*node.dtype.itemsize >= min_size:
+                datasets.append(node)
+        paper.data_group.visititems(collect)
+        if not datasets:
+            sys.stderr.write("no numerical dataset of at least %d bytes\n"
+                             % min_size)
+            raise CLIExit
+        datasets.sort(key=lambda ds: ds.size*ds.dtype.itemsize, reverse=True)
+        data = [activepapers.layout.sample(ds, sample_size)
+                for ds in datasets[:samples]]
+        raw_size = sum(d.nbytes for d in data)
+        results = activepapers.layout.benchmark(
+                      data, activepapers.layout.candidate_policies(min_size))
+        for policy, ratio, elapsed in results:
+            policy_text = repr(policy).split(' (')[0]
+            sys.stdout.write("%-32s size %5.1f%%  %8.1f MB/s\n"
+                             % (policy_text, 100.*ratio,
+                                raw_size/max(elapsed, 1.e-6)/1.e6))
+        best = activepapers.layout.recommend(results, raw_size,
+                                             bandwidth*1.e6)
+        sys.stdout.write("recommended: %s\n" % repr(best))
+        if apply:
+            paper.set_compression_policy(best)
+
+def dedup(paper, store, min_size, inline):
+    paper = get_paper(paper)
+    with activepapers.storage.ActivePaper(paper, 'r+') as paper:
+        if inline:
+            for path in paper.inline_shared():
+                sys.stdout.write("inlined %s\n" % path)
+            return
+        store = activepapers.contentstore.ContentStore(store)
+        before = set(store.hashes())
+        moved = paper.deduplicate(store, min_size)
+        for path, h in moved:
+            sys.stdout.write("%s %s %s\n"
+                             % (h[:12], "shared" if h in before else "stored",
+                                path))
+        sys.stdout.write("content store %s: %d datasets, %d bytes\n"
+                         % (store.directory, len(store.hashes()),
+                            store.size()))
+
+def repack(paper, recompress, if_over, threshold):
+    paper = get_paper(paper)
+    policy = None
+    with activepapers.storage.ActivePaper(paper, 'r') as ap:
+        if recompress:
+            policy = ap.compression_policy
+            if policy is None:
+                sys.stderr.write("paper has no compression policy\n")
+                raise CLIExit
+        if if_over is not None and if_over < 0:
+            # --if-over without a fraction
+            if_over = ap.repack_threshold()
+            if if_over is None:
+                sys.stderr.write("paper has no repack threshold\n")
+                raise CLIExit
+        needed = if_over is None or ap.needs_repack(if_over)
+        unused, size = ap.unused_space(), ap.file.id.get_filesize()
+    if needed:
+        old_size, new_size = activepapers.storage.repack(paper, policy)
+        sys.stdout.write("%d bytes -> %d bytes, reclaimed %d bytes\n"
+                         % (old_size, new_size, old_size-new_size))
+    else:
+        sys.stdout.write("%d of %d bytes unused, not repacked\n"
+                         % (unused, size))
+    if threshold is not None:
+        with activepapers.storage.ActivePaper(paper, 'r+') as ap:
+            ap.set_repack_threshold(threshold if threshold > 0 else None)
+
+def convert(paper, layout):
+    paper = get_paper(paper)
+    activepapers.storage.repack(paper, split=layout == 'split')
+    files = activepapers.storage.paper_files(paper)
+    for filename in files:
+        sys.stdout.write("%s: %d bytes\n"
+                         % (filename, os.path.getsize(filename)))
+
+def parse_time(text):
+    """
+    :param text: a date (YYYY-MM-DD), a date and time
+                 (YYYY-MM-DD/HH:MM:SS, as shown by 'ls -l'), or an
+                 age given as a number followed by s, m, h, or d
+    :return: the time in seconds since the epoch
+    :rtype: float
+    """
+    units = dict(s=1, m=60, h=3600, d=86400)
+    if text and text[-1] in units:
+        try:
+            return time.time() - float(text[:-1])*units[text[-1]]
+        except ValueError:
+            pass
+    for fmt in ["%Y-%m-%d/%H:%M:%S", "%Y-%m-%d"]:
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise ValueError("invalid time %s" % text)
+
+def parse_size(text):
+    """
+    :param text: a number of bytes, optionally followed by
+                 k, M, G, or T (powers of 1024)
+    :rtype: int
+    """
+    units = dict(k=2**10, K=2**10, M=2**20, G=2**30, T=2**40)
+    if text and text[-1] in units:
+        return int(float(text[:-1])*units[text[-1]])
+    return int(text)
+
+def find(paper, type, owner, newer, older, min_size, max_size, dummy,
+         long, pattern):
+    paper = get_paper(paper)
+    if owner is not None and not owner.startswith('/'):
+        owner = '/code/' + owner
+    paper = activepapers.storage.ActivePaper(paper, 'r', metadata_only=True)
+    entries = paper.query(datatype=type, owner=owner,
+                          after=newer, before=older,
+                          min_size=min_size, max_size=max_size,
+                          dummy=True if dummy else None,
+                          patterns=expand_patterns(pattern))
+    for entry in entries:
+        if long:
+            if entry.timestamp:
+                sys.stdout.write(time.strftime("%Y-%m-%d/%H:%M:%S  ",
+                                 time.localtime(entry.timestamp/1000.)))
+            else:
+                sys.stdout.write(21*" ")
+            sys.stdout.write("%-10s %12d  " % (entry.datatype, entry.size))
+        sys.stdout.write(entry.path[1:])
+        sys.stdout.write('\n')
+    paper.close()
+
+def grep(paper, ignore_case, library, string):
+    if library:
+        papers = activepapers.library.library_papers()
+    else:
+        papers = [(None, get_paper(paper))]
+    for paper_ref, filename in papers:
+        paper = activepapers.storage.ActivePaper(filename, 'r',
+                                                 metadata_only=True)
+        for path, number, line in paper.search_text(string, ignore_case):
+            if paper_ref is not None:
+                sys.stdout.write(paper_ref + ':')
+            sys.stdout.write("%s:%d:%s\n" % (path[1:], number, line))
+        paper.close()
@@ -0,0 +1,126 @@
+# A content-addressed store for large datasets shared by several papers
+#
+# The store is a directory (by default "store" in the first directory
+# of the ActivePapers library) containing one HDF5 file per distinct
+# dataset content, named after the SHA-256 hash of the content. A
+# paper refers to a stored dataset through an HDF5 virtual dataset
+# that maps the complete stored dataset. The virtual dataset keeps
+# all attributes of the original item (datatype, timestamp,
+# dependencies, ...), so deduplication is invisible to codelets.
+#
+# Identical datasets in different papers, for example copies made
+# by ActivePaper.create_copy, are thus stored only once.
+
+import hashlib
+import os
+
+import numpy as np
+import h5py
+
+from activepapers.library import library
+from activepapers.utility import ascii, datatype
+
+# The dataset in each store file
+content_name = 'content'
+
+# The attribute recording the content hash of a shared dataset
+hash_attribute = 'ACTIVE_PAPER_CONTENT_HASH'
+
+
+def content_hash(dataset, block_size=2**24):
+    """
+    :param dataset: an HDF5 dataset
+    :param block_size: the approximate number of bytes read at once
+    :return: the SHA-256 hash of the shape, dtype, and contents of
+             dataset, independent of its storage layout
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    h.update(ascii(str(dataset.dtype.descr)).encode('ascii'))
+    h.update(ascii(str(dataset.shape)).encode('ascii'))
+    if len(dataset.shape) == 0:
+        h.update(np.ascontiguousarray(dataset[...]).tobytes())
+        return h.hexdigest()
+    row_size = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    step = max(1, block_size // max(1, row_size))
+    for start in range(0, dataset.shape[0], step):
+        block = dataset[start:start+step]
+        h.update(np.ascontiguousarray(block).tobytes())
+    return h.hexdigest()
+
+
+def shareable(dataset, min_size):
+    """
+    :return: True if dataset can be moved to a content store
+    :rtype: bool
+    """
+    # Resizable datasets would lose their maxshape, and internal
+    # files are written through InternalFile, which resizes them.
+    return len(dataset.shape) > 0 \
+           and None not in (dataset.maxshape or ()) \
+           and datatype(dataset) not in ('file', 'text') \
+           and not dataset.is_virtual \
+           and dataset.dtype.kind in 'biufcSV' \
+           and not dataset.dtype.hasobject \
+           and dataset.size * dataset.dtype.itemsize >= min_size
+
+
+class ContentStore(object):
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(library[0], 'store')
+        self.directory = os.path.abspath(directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def filename(self, content_hash):
+        return os.path.join(self.directory, content_hash + '.h5')
+
+    def __contains__(self, content_hash):
+        return os.path.exists(self.filename(content_hash))
+
+    def add(self, dataset, content_hash):
+        """
+        Copy dataset to the store, unless its content is already
+        there. The copy keeps the storage layout and the filters
+        of dataset, but not its attributes.
+
+        :return: the name of the store file
+        :rtype: str
+        """
+        filename = self.filename(content_hash)
+        if content_hash not in self:
+            tmp_filename = filename + '.tmp'
+            with h5py.File(tmp_filename, 'w') as store_file:
+                store_file.copy(dataset, content_name, without_attrs=True)
+            os.rename(tmp_filename, filename)
+        return filename
+
+    def layout(self, content_hash):
+        """
+        :return: the layout of a virtual dataset for the stored content
+        :rtype: h5py.VirtualLayout
+        """
+        filename = self.filename(content_hash)
+        with h5py.File(filename, 'r') as store_file:
+            stored = store_file[content_name]
+            shape, dtype = stored.shape, stored.dtype
+        layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+        layout[...] = h5py.VirtualSource(filename, content_name, shape=shape)
+        return layout
+
+    def hashes(self):
+        """
+        :return: the content hashes of all datasets in the store
+        :rtype: list
+        """
+        return sorted(name[:-3] for name in os.listdir(self.directory)
+                      if name.endswith('.h5'))
+
+    def size(self):
+        """
+        :return: the total size of the store files in bytes
+        :rtype: int
+        """
+        return sum(os.path.getsize(self.filename(h)) for h in self.hashes())
@@ -0,0 +1,65 @@
+# Copying datasets and groups between HDF5 files
+#
+# copy_node copies a dataset or a group unchanged. This is done by
+# HDF5 (H5Ocopy), which keeps all creation properties and copies
+# compressed chunks without decompressing them. Copies that change
+# the storage layout are made by activepapers.layout.copy_dataset,
+# which copies the compressed chunks unchanged where the chunk shape
+# and the filters permit it (see activepapers.chunkio.copy_chunks),
+# and decompresses and compresses the data again otherwise.
+#
+# The amount of data moved by each method is recorded in a
+# CopyStatistics object.
+
+import h5py
+
+# The copy methods recorded in CopyStatistics:
+#  'chunks': compressed chunks copied unchanged
+#  'blocks': data decompressed and compressed again
+#  'hdf5':   objects copied by HDF5
+copy_methods = ['chunks', 'blocks', 'hdf5']
+
+
+class CopyStatistics(object):
+
+    def __init__(self):
+        self.datasets = 0
+        self.nbytes = dict((method, 0) for method in copy_methods)
+
+    def record(self, method, nbytes):
+        self.datasets += 1
+        self.nbytes[method] += nbytes
+
+    @property
+    def bytes_moved(self):
+        return sum(self.nbytes.values())
+
+    def __str__(self):
+        details = ", ".join("%s: %d" % (method, self.nbytes[method])
+                            for method in copy_methods
+                            if self.nbytes[method])
+        return "%d datasets, %d bytes (%s)" \
+               % (self.datasets, self.bytes_moved, details or "none")
+
+
+def copy_node(node, group, name, statistics=None):
+    """
+    Copy a dataset or group to group[name] using HDF5's object copy,
+    which keeps all creation properties and copies the stored chunks
+    without decompressing them. Objects referenced from the copied
+    tree are copied as well (expand_refs=True).
+
+    :param node: an HDF5 dataset or group
+    :param statistics: records the number of bytes copied
+    :type statistics: CopyStatistics
+    :return: the copy
+    """
+    group.copy(node, name, expand_refs=True)
+    if statistics is not None:
+        def record(node):
+            if isinstance(node, h5py.Dataset):
+                statistics.record('hdf5', node.id.get_storage_size())
+        record(node)
+        if isinstance(node, h5py.Group):
+            node.visititems(lambda name, item: record(item))
+    return group[name]
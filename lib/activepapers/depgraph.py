@@ -0,0 +1,246 @@
+# The dependency graph of an ActivePaper
+#
+# The graph is stored in the group "catalog/dependencies" as part of
+# the catalog (see activepapers.catalog). It uses compressed sparse
+# row (CSR) form over a table of interned paths: the dependencies of
+# the node with id i are the nodes whose ids are
+# indices[indptr[i]:indptr[i+1]]. All queries are answered by
+# NumPy operations on these integer arrays, without accessing the
+# dependency attributes of the individual items.
+
+import collections
+
+import numpy as np
+
+from activepapers.utility import utf8, h5vstring
+
+
+def dependency_list(node):
+    """
+    :param node: an item or a group in a paper
+    :type node: h5py.Node
+    :return: the paths of the dependencies of node
+    :rtype: tuple
+    """
+    deps = node.attrs.get('ACTIVE_PAPER_DEPENDENCIES', None)
+    if deps is None:
+        return ()
+    return tuple(utf8(d) for d in deps)
+
+
+def _write(group, name, data, dtype):
+    if name not in group:
+        group.create_dataset(name, shape=(0,), dtype=dtype,
+                             maxshape=(None,), chunks=(1024,))
+    ds = group[name]
+    ds.resize((len(data),))
+    if len(data) > 0:
+        ds[...] = data
+
+
+def _expand(indptr, indices, ids):
+    # The concatenation of the rows ids of a CSR matrix.
+    starts = indptr[ids]
+    lengths = indptr[ids+1] - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros((0,), np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(total)]
+
+
+class DependencyGraph(object):
+
+    def __init__(self, dependencies=None):
+        # A dictionary mapping paths to the tuple of the paths
+        # of their dependencies. Nodes without dependencies
+        # are not stored.
+        self._deps = {}
+        self._csr = None
+        if dependencies is not None:
+            for path, deps in dependencies:
+                self.set(path, deps)
+
+    @classmethod
+    def read(cls, group):
+        paths = np.array([utf8(p) for p in group['paths'][...]],
+                         dtype=object)
+        indptr = group['indptr'][...]
+        indices = group['indices'][...]
+        graph = cls()
+        for i in np.nonzero(np.diff(indptr))[0]:
+            graph._deps[paths[i]] = \
+                      tuple(paths[indices[indptr[i]:indptr[i+1]]])
+        return graph
+
+    def write(self, group):
+        paths, ids, indptr, indices = self.csr()
+        _write(group, 'paths', paths, h5vstring)
+        _write(group, 'indptr', indptr, np.int64)
+        _write(group, 'indices', indices, np.int64)
+
+    def __eq__(self, other):
+        return self._deps == other._deps
+
+    def __ne__(self, other):
+        return not self == other
+
+    def set(self, path, deps):
+        """
+        Set the dependencies of path.
+        """
+        deps = tuple(deps)
+        if self._deps.get(path, ()) == deps:
+            return
+        if deps:
+            self._deps[path] = deps
+        else:
+            del self._deps[path]
+        self._csr = None
+
+    def discard(self, path):
+        """
+        Remove path from the graph, as a dependent item. The
+        dependencies on path of the remaining items are kept.
+        """
+        if path in self._deps:
+            del self._deps[path]
+            self._csr = None
+
+    def dependencies(self, path):
+        """
+        :return: the paths of the dependencies of path
+        :rtype: tuple
+        """
+        return self._deps.get(path, ())
+
+    def csr(self):
+        """
+        :return: the sorted array of all paths in the graph, a dictionary
+                 mapping paths to ids (indices into the path array),
+                 and the arrays indptr and indices defining the
+                 dependencies in CSR form
+        :rtype: tuple
+        """
+        if self._csr is None:
+            paths = set(self._deps)
+            for deps in self._deps.values():
+                paths.update(deps)
+            paths = np.array(sorted(paths), dtype=object)
+            ids = dict((p, i) for i, p in enumerate(paths))
+            lengths = np.array([len(self._deps.get(p, ())) for p in paths],
+                               dtype=np.int64)
+            indptr = np.zeros((len(paths)+1,), np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+            indices = np.array([ids[d]
+                                for p in paths
+                                for d in self._deps.get(p, ())],
+                               dtype=np.int64)
+            self._csr = (paths, ids, indptr, indices)
+        return self._csr
+
+    def reverse_csr(self):
+        """
+        :return: the arrays indptr and indices defining the reverse
+                 dependencies in CSR form, using the same ids as csr()
+        :rtype: tuple
+        """
+        paths, ids, indptr, indices = self.csr()
+        n = len(paths)
+        items = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+        order = np.argsort(indices, kind='mergesort')
+        rindptr = np.zeros((n+1,), np.int64)
+        np.cumsum(np.bincount(indices, minlength=n), out=rindptr[1:])
+        return rindptr, items[order]
+
+    def dependents(self, paths, transitive=False):
+        """
+        :param paths: a sequence of paths
+        :param transitive: if True, include indirect dependents
+        :return: the paths of the items that depend on any of paths
+        :rtype: set
+        """
+        all_paths, ids, indptr, indices = self.csr()
+        start = np.array([ids[p] for p in paths if p in ids], np.int64)
+        if len(start) == 0:
+            return set()
+        rindptr, rindices = self.reverse_csr()
+        visited = np.zeros((len(all_paths),), np.bool_)
+        found = np.zeros((len(all_paths),), np.bool_)
+        visited[start] = True
+        frontier = start
+        while len(frontier) > 0:
+            neighbours = np.unique(_expand(rindptr, rindices, frontier))
+            found[neighbours] = True
+            if not transitive:
+                break
+            frontier = neighbours[~visited[neighbours]]
+            visited[frontier] = True
+        return set(all_paths[found])
+
+    def reverse(self):
+        """
+        :return: a dictionary mapping each path to the set of the paths
+                 of the items that depend on it
+        :rtype: dict
+        """
+        reverse = {}
+        for path, deps in self._deps.items():
+            for dep in deps:
+                reverse.setdefault(dep, set()).add(path)
+        return reverse
+
+    def stale(self, timestamps):
+        """
+        :param timestamps: a dictionary mapping paths to modification
+                           times
+        :return: the paths of the items that are older than at least
+                 one of their dependencies
+        :rtype: set
+        """
+        paths, ids, indptr, indices = self.csr()
+        t = np.array([timestamps.get(p, 0) for p in paths], np.int64)
+        items = np.repeat(np.arange(len(paths), dtype=np.int64),
+                          np.diff(indptr))
+        stale = items[t[indices] > t[items]]
+        return set(paths[np.unique(stale)])
+
+
+def levels(dependencies):
+    """
+    Generator yielding a sequence of sets of paths such that the
+    items in each set depend only on the items in the preceding sets.
+    The first set contains the items without dependencies.
+
+    :param dependencies: a dictionary mapping the path of each item
+                         to a sequence of the paths of its dependencies
+    :raises ValueError: if some items can't be placed in any set,
+                        because of cyclic dependencies or dependencies
+                        on non-existing items
+    """
+    # Kahn's algorithm, processing one level at a time
+    dependents = collections.defaultdict(list)
+    unresolved = {}
+    level = []
+    for path, deps in dependencies.items():
+        deps = set(deps)
+        if deps:
+            unresolved[path] = len(deps)
+            for dep in deps:
+                dependents[dep].append(path)
+        else:
+            level.append(path)
+    yield set(level)
+    while unresolved:
+        next_level = []
+        for path in level:
+            for dependent in dependents.get(path, ()):
+                unresolved[dependent] -= 1
+                if unresolved[dependent] == 0:
+                    next_level.append(dependent)
+        if not next_level:
+            raise ValueError("cyclic dependencies")
+        for path in next_level:
+            del unresolved[path]
+        level = next_level
+        yield set(level)
@@ -13,8 +13,13 @@ import numpy as np
 import activepapers.utility
 from activepapers.utility import ascii, utf8, isstring, execstring, \
                                  codepath, datapath, path_in_section, owner, \
-                                 datatype, timestamp, stamp, ms_since_epoch
+                                 datatype, timestamp, stamp, ms_since_epoch, \
+                                 file_registry
 import activepapers.standardlib
+import activepapers.chunkio
+from activepapers.layout import chunk_options
+from activepapers.contentstore import hash_attribute
+from activepapers.table import Table
 
 #
 # A codelet is a Python script inside a paper.
@@ -78,6 +83,7 @@ class Codelet(object):
     def _run(self, environment):
         logging.info("Running %s %s"
                      % (self.__class__.__name__.lower(), self.path))
+        self.paper.import_dependencies()
         self.paper.remove_owned_by(self.path)
         # A string uniquely identifying the paper from which the
         # calclet is called. Used in Importer.
@@ -90,6 +96,7 @@ class Codelet(object):
         self._contents_module.open = self.open_data_file
         self._contents_module.open_documentation = self.open_documentation_file
         self._contents_module.snapshot = self.paper.snapshot
+        self._contents_module.start_swmr = self.paper.start_swmr
 
         # The remaining part of this method is not thread-safe because
         # of the way the global state in sys.modules is modified.
@@ -163,7 +170,8 @@ class Calclet(Codelet):
                and top_level not in activepapers.standardlib.allowed_modules \
                and top_level not in ['numpy', 'h5py']:
                 raise ImportError("import of %s not allowed" % module_name)
-        else:
+        elif node.in_paper(self.paper):
+            # Modules in referenced papers are not dependencies
             if datatype(node) != "module":
                 node = node.get("__init__", None)
             if node is not None and node.in_paper(self.paper):
@@ -228,32 +236,60 @@ class DatasetWrapper(object):
         self._codelet = codelet
         self.attrs = AttrWrapper(ds)
         self.ref = ds.ref
+        self._unshared = False
 
     @property
     def parent(self):
         return self._parent
 
+    def _unshare(self):
+        # A dataset whose contents are in a content store is shared
+        # with other papers. It is copied back into its paper before
+        # the first modification.
+        if self._unshared:
+            return
+        node = self._node
+        if hash_attribute in node.attrs and node.is_virtual:
+            self._node = file_registry[node.file.id].unshare(node.name)
+            self.attrs = AttrWrapper(self._node)
+            self.ref = self._node.ref
+        self._unshared = True
+
     def __len__(self):
         return len(self._node)
 
     def __getitem__(self, item):
         return self._node[item]
 
+    def read_parallel(self, selection=Ellipsis, workers=None):
+        """
+        Equivalent to self[selection], but decompresses the chunks
+        of gzip-compressed datasets in a pool of threads
+        (see activepapers.chunkio.read).
+
+        :param workers: the number of threads (default: the number
+                        of processors)
+        """
+        return activepapers.chunkio.read(self._node, selection, workers)
+
     def __setitem__(self, item, value):
+        self._unshare()
         self._node[item] = value
         stamp(self._node, "data", self._codelet.dependency_attributes())
 
     def __getattr__(self, attr):
         return getattr(self._node, attr)
 
-    def read_direct(dest, source_sel=None, dest_sel=None):
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
         return self._node.read_direct(dest, source_sel, dest_sel)
 
     def resize(self, size, axis=None):
+        self._unshare()
         self._node.resize(size, axis)
         stamp(self._node, "data", self._codelet.dependency_attributes())
 
-    def write_direct(source, source_sel=None, dest_sel=None):
+    def write_direct(self, source, source_sel=None, dest_sel=None):
+        self._unshare()
         self._node.write_direct(source, source_sel, dest_sel)
         stamp(self._node, "data", self._codelet.dependency_attributes())
 
@@ -272,6 +308,110 @@ class DatasetWrapper(object):
                          % (repr(self._node.shape), str(self._node.dtype)))
         return "\n".join(lines)
 
+#
+# An Appender adds rows to a dataset whose first dimension is
+# unlimited. Rows are collected in a buffer of about one chunk and
+# written a block at a time. The dataset grows geometrically, which
+# limits the number of resize operations to the logarithm of the
+# number of rows, and is trimmed to the number of rows on close().
+# Until then, readers see unused rows filled with the fill value
+# at the end of the dataset. The dataset is stamped only on close().
+#
+
+class Appender(object):
+
+    # The factor by which the dataset grows when it is full
+    growth_factor = 2
+
+    def __init__(self, dataset, buffer_rows=None):
+        """
+        :param dataset: the wrapper of an empty dataset whose first
+                        dimension is unlimited
+        :type dataset: DatasetWrapper
+        :param buffer_rows: the number of rows kept in memory before
+                            writing them (default: the rows of a chunk)
+        """
+        self.dataset = dataset
+        node = dataset._node
+        if buffer_rows is None:
+            buffer_rows = node.chunks[0]
+        self._buffer = np.empty((buffer_rows,)+node.shape[1:], node.dtype)
+        self._buffered = 0
+        self._length = node.shape[0]
+        self._capacity = node.shape[0]
+        self.resizes = 0
+        self.closed = False
+
+    def __len__(self):
+        return self._length + self._buffered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _check_if_open(self):
+        if self.closed:
+            raise ValueError("appender for %s is closed"
+                             % self.dataset._node.name)
+
+    def append(self, row):
+        """
+        Add a single row to the end of the dataset.
+        """
+        self._check_if_open()
+        self._buffer[self._buffered] = row
+        self._buffered += 1
+        if self._buffered == len(self._buffer):
+            self.flush()
+
+    def extend(self, rows):
+        """
+        Add several rows, given as an array whose first dimension
+        is the number of rows, to the end of the dataset.
+        """
+        self._check_if_open()
+        rows = np.asarray(rows, dtype=self._buffer.dtype)
+        if self._buffered + len(rows) < len(self._buffer):
+            self._buffer[self._buffered:self._buffered+len(rows)] = rows
+            self._buffered += len(rows)
+        else:
+            self.flush()
+            self._write(rows)
+
+    def flush(self):
+        """
+        Write the buffered rows to the dataset.
+        """
+        if self._buffered > 0:
+            self._write(self._buffer[:self._buffered])
+            self._buffered = 0
+
+    def _write(self, rows):
+        node = self.dataset._node
+        end = self._length + len(rows)
+        if end > self._capacity:
+            self._capacity = max(end, self.growth_factor*self._capacity)
+            node.resize(self._capacity, axis=0)
+            self.resizes += 1
+        node[self._length:end] = rows
+        self._length = end
+
+    def close(self):
+        """
+        Write the buffered rows, trim the dataset to the number
+        of rows appended, and stamp it.
+        """
+        if self.closed:
+            return
+        self.flush()
+        node = self.dataset._node
+        if node.shape[0] != self._length:
+            node.resize(self._length, axis=0)
+        stamp(node, "data", self.dataset._codelet.dependency_attributes())
+        self.closed = True
+
 #
 # DataGroup is a wrapper class for the "data" group in a paper,
 # which is the only group accessible to codelets.
@@ -301,12 +441,15 @@ class DataGroup(object):
     def _wrap_and_track_dependencies(self, node):
         ap_type = datatype(node)
         if ap_type == 'reference':
-            from activepapers.storage import dereference
+            from activepapers.storage import dereference, paper_pool
             paper, node = dereference(node)
             if isinstance(node, h5py.Group):
                 node = DataGroup(paper, None, node, None, None)
             else:
                 node = DatasetWrapper(None, node, None)
+            # The referenced paper stays open while the wrapper
+            # (or a wrapper inside a DataGroup) is in use.
+            node._pin = paper_pool.pin(paper)
         else:
             if self._codelet is not None:
                 if ap_type is not None and ap_type != "group":
@@ -328,6 +471,8 @@ class DataGroup(object):
         if self._data_item:
             stamp(self._data_item._node, "data",
                   self._codelet.dependency_attributes())
+            if isinstance(node, h5py.Dataset):
+                self._paper.dataset_changed(node)
         else:
             stamp(node, ap_type, self._codelet.dependency_attributes())
 
@@ -372,7 +517,14 @@ class DataGroup(object):
             value = value._node
         else:
             needs_stamp = True
-        self._node[path] = value
+        policy = self._paper.compression_policy
+        if needs_stamp and policy is not None \
+           and isinstance(value, (np.ndarray, list, tuple)):
+            self._node.create_dataset(path,
+                                      **self._storage_options((),
+                                                              {'data': value}))
+        else:
+            self._node[path] = value
         if needs_stamp:
             node = self._node[path]
             stamp(node, "data", self._codelet.dependency_attributes())
@@ -380,18 +532,21 @@ class DataGroup(object):
     def __delitem__(self, path):
         test = self._node[datapath(path)]
         if owner(test) == self._codelet.path:
-            del self._node[datapath(path)]
+            self._paper.delete_item(test.name)
         else:
             raise ValueError("%s trying to remove data created by %s"
                              % (str(self._codelet.path), str(owner(test))))
 
     def create_group(self, path):
-        group = self._node.create_group(datapath(path))
+        group = self._node.create_group(datapath(path),
+                                        track_order=self._paper.track_order)
         self._stamp_new_node(group, "group")
         return DataGroup(self._paper, self, group,
                          self._codelet, self._data_item)
 
     def require_group(self, path):
+        if datapath(path) not in self._node:
+            return self.create_group(path)
         group = self._node.require_group(datapath(path))
         self._stamp_new_node(group, "group")
         return DataGroup(self._paper, self, group,
@@ -401,12 +556,65 @@ class DataGroup(object):
         stamp(self._node, "data", self._codelet.dependency_attributes())
         self._data_item = self
 
+    def _storage_options(self, args, kwargs):
+        access = kwargs.pop('access', None)
+        policy = self._paper.compression_policy
+        if policy is not None:
+            kwargs = policy.dataset_options(args, kwargs)
+        return chunk_options(args, kwargs, access)
+
     def create_dataset(self, path, *args, **kwargs):
-        ds = self._node.create_dataset(datapath(path), *args, **kwargs)
+        workers = kwargs.pop('workers', None)
+        kwargs = self._storage_options(args, kwargs)
+        if workers is None:
+            ds = self._node.create_dataset(datapath(path), *args, **kwargs)
+        else:
+            ds = activepapers.chunkio.create_dataset(self._node,
+                                                     datapath(path),
+                                                     args, kwargs, workers)
         self._stamp_new_node(ds, "data")
         return DatasetWrapper(self, ds, self._codelet)
 
+    def create_appendable(self, path, dtype, row_shape=(),
+                          buffer_rows=None, **kwargs):
+        """
+        Create an empty dataset for adding rows with an Appender.
+
+        :param dtype: the dtype of the dataset
+        :param row_shape: the shape of a row
+        :param buffer_rows: the number of rows kept in memory before
+                            writing them (default: the rows of a chunk)
+        :param kwargs: further keyword arguments for create_dataset
+                       (e.g. compression)
+        :return: an appender, which must be closed after the last
+                 row has been added
+        :rtype: Appender
+        """
+        row_shape = tuple(row_shape)
+        kwargs.setdefault('access', 'append')
+        ds = self.create_dataset(path, shape=(0,)+row_shape, dtype=dtype,
+                                 maxshape=(None,)+row_shape, **kwargs)
+        return Appender(ds, buffer_rows)
+
+    def create_table(self, path, dtype, index=()):
+        """
+        Create a table data item (see activepapers.table).
+
+        :param dtype: the compound dtype of the records
+        :param index: the names of the fields to be indexed
+        :rtype: activepapers.table.Table
+        """
+        return Table.create(self.create_group(path), dtype, index)
+
+    def open_table(self, path):
+        """
+        :return: the table at path
+        :rtype: activepapers.table.Table
+        """
+        return Table(self[path])
+
     def require_dataset(self, path, *args, **kwargs):
+        kwargs = self._storage_options(args, kwargs)
         ds = self._node.require_dataset(datapath(path), *args, **kwargs)
         self._stamp_new_node(ds, "data")
         return DatasetWrapper(self, ds, self._codelet)
@@ -0,0 +1,391 @@
+# Storage layout of datasets: chunking and compression
+#
+# A paper can define a compression policy, stored in attributes of
+# the root group, that selects chunking, shuffling and compression
+# for new datasets created without explicit storage options. The
+# policy applies only to numerical datasets above a minimal size.
+#
+# The shape of the chunks of new datasets is chosen according to the
+# expected access pattern (see chunk_shape), rather than by h5py's
+# heuristics, which produce very small chunks for resizable datasets.
+
+import time
+
+import numpy as np
+import h5py
+
+import activepapers.chunkio
+
+# The keywords of h5py's create_dataset that define filters.
+# A policy is applied only if none of them is used.
+filter_keywords = ['compression', 'compression_opts', 'shuffle',
+                   'scaleoffset', 'fletcher32']
+
+_attr_prefix = 'ACTIVE_PAPER_COMPRESSION'
+
+# The access patterns known to chunk_shape
+access_patterns = ['rows', 'columns', 'append']
+
+# The default chunk size in bytes. It is well below the default size
+# of HDF5's chunk cache (1 MB), which can then hold at least one chunk.
+default_chunk_size = 2**19
+
+
+def shape_and_dtype(args, kwargs):
+    """
+    :param args: the positional arguments to h5py's create_dataset,
+                 after the name of the dataset
+    :param kwargs: the keyword arguments to h5py's create_dataset
+    :return: the shape and dtype of the dataset to be created,
+             or (None, None) if they can't be determined
+    """
+    params = dict(zip(['shape', 'dtype', 'data'], args))
+    params.update((k, kwargs[k]) for k in ['shape', 'dtype', 'data']
+                  if k in kwargs)
+    shape = params.get('shape')
+    dtype = params.get('dtype')
+    data = params.get('data')
+    if data is not None and (shape is None or dtype is None):
+        data = np.asarray(data)
+        if shape is None:
+            shape = data.shape
+        if dtype is None:
+            dtype = data.dtype
+    if shape is None:
+        return None, None
+    if isinstance(shape, int):
+        shape = (shape,)
+    try:
+        dtype = np.dtype(dtype if dtype is not None else 'f')
+    except TypeError:
+        return None, None
+    return tuple(shape), dtype
+
+
+def filter_options(dataset):
+    """
+    :return: the keyword arguments to h5py's create_dataset that
+             reproduce the filters of dataset
+    :rtype: dict
+    """
+    options = dict((k, getattr(dataset, k)) for k in filter_keywords)
+    if options['compression'] is None:
+        del options['compression_opts']
+    if not options['scaleoffset']:
+        del options['scaleoffset']
+    return options
+
+
+def copy_attributes(source, dest):
+    """
+    Copy all attributes of source to dest, keeping their HDF5 datatypes.
+    """
+    for attr in source.attrs:
+        dest.attrs.create(attr, source.attrs[attr],
+                          dtype=source.attrs.get_id(attr).dtype)
+
+
+def copy_dataset(dataset, group, name, options=None, statistics=None):
+    """
+    Copy dataset and its attributes to group[name], with the storage
+    options given by the keyword arguments to h5py's create_dataset
+    in options. If options is None, the dataset is copied unchanged
+    by HDF5. Otherwise, if the chunk shape and the filters of the copy
+    are the same as those of dataset, the compressed chunks are copied
+    unchanged, and if not, the data is copied in blocks of about 64 MB.
+
+    :param statistics: an object whose method record(method, nbytes)
+                       is called with method 'hdf5', 'chunks' or
+                       'blocks' and the number of bytes copied
+                       (see activepapers.copying.CopyStatistics)
+    :return: the new dataset
+    :rtype: h5py.Dataset
+    """
+    if options is None:
+        group.copy(dataset, name)
+        if statistics is not None:
+            statistics.record('hdf5', dataset.id.get_storage_size())
+        return group[name]
+    options = dict(options)
+    if dataset.fillvalue is not None:
+        options.setdefault('fillvalue', dataset.fillvalue)
+    new = group.create_dataset(name, shape=dataset.shape,
+                               dtype=dataset.dtype,
+                               maxshape=dataset.maxshape, **options)
+    copied = activepapers.chunkio.copy_chunks(dataset, new)
+    if copied is not None:
+        method, nbytes = 'chunks', copied[1]
+    else:
+        method, nbytes = 'blocks', _copy_blocks(dataset, new)
+    copy_attributes(dataset, new)
+    if statistics is not None:
+        statistics.record(method, nbytes)
+    return new
+
+
+def _copy_blocks(dataset, new):
+    if dataset.shape is None:
+        # Empty dataset
+        return 0
+    if len(dataset.shape) == 0:
+        new[...] = dataset[...]
+        return dataset.dtype.itemsize
+    # Blocks aligned on the new chunks
+    rows = new.chunks[0] if new.chunks else 1
+    row_size = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    step = max(1, (2**26 // max(1, row_size)) // rows) * rows
+    for start in range(0, dataset.shape[0], step):
+        block = slice(start, min(start+step, dataset.shape[0]))
+        new[block] = dataset[block]
+    return row_size * dataset.shape[0]
+
+
+def chunk_shape(shape, dtype, access, maxshape=None,
+                target_size=default_chunk_size):
+    """
+    :param shape: the initial shape of the dataset
+    :param dtype: the dtype of the dataset
+    :param access: the expected access pattern: 'rows' for reading
+                   or writing blocks of consecutive rows (slices along
+                   the first axis), 'columns' for reading all rows of
+                   a few columns, 'append' for adding rows to a dataset
+                   whose first dimension is unlimited
+    :param maxshape: the maximal shape of the dataset
+    :param target_size: the approximate size of a chunk in bytes
+    :return: a chunk shape adapted to the access pattern, or None
+             for scalar datasets
+    :rtype: tuple
+    """
+    if access not in access_patterns:
+        raise ValueError("unknown access pattern %s" % str(access))
+    if len(shape) == 0:
+        return None
+    if maxshape is None:
+        maxshape = shape
+    extents = [max(1, n) for n in shape]
+    budget = max(1, target_size // np.dtype(dtype).itemsize)
+    growing = access == 'append' or maxshape[0] is None
+    if access == 'columns':
+        # Long chunks along the first axis, the remaining budget
+        # going to the last axes, which are contiguous in memory.
+        rows = budget if growing else min(extents[0], budget)
+        inner = [1] * (len(shape)-1)
+        remaining = budget // rows
+        for axis in range(len(inner)-1, -1, -1):
+            inner[axis] = max(1, min(extents[axis+1], remaining))
+            remaining //= inner[axis]
+        return tuple([rows] + inner)
+    # Chunks containing complete rows, unless a single row
+    # exceeds the budget.
+    inner = extents[1:]
+    axis = 0
+    while int(np.prod(inner)) > budget:
+        while inner[axis] == 1:
+            axis += 1
+        inner[axis] = (inner[axis]+1) // 2
+    rows = max(1, budget // int(np.prod(inner)))
+    if not growing:
+        rows = min(rows, extents[0])
+    return tuple([rows] + inner)
+
+
+def chunk_options(args, kwargs, access=None):
+    """
+    :param args: the positional arguments to h5py's create_dataset,
+                 after the name of the dataset
+    :param kwargs: the keyword arguments to h5py's create_dataset
+    :param access: the expected access pattern (see chunk_shape)
+    :return: kwargs with a chunk shape chosen by chunk_shape for
+             chunked datasets without an explicit chunk shape
+    :rtype: dict
+    """
+    chunks = kwargs.get('chunks')
+    chunked = chunks is True or access is not None \
+              or kwargs.get('maxshape') is not None \
+              or any(k in kwargs for k in filter_keywords)
+    if chunks not in (None, True) or not chunked:
+        return kwargs
+    shape, dtype = shape_and_dtype(args, kwargs)
+    if shape is None or len(shape) == 0:
+        return kwargs
+    maxshape = kwargs.get('maxshape')
+    if access is None:
+        access = 'append' if maxshape is not None and maxshape[0] is None \
+                 else 'rows'
+    kwargs = dict(kwargs)
+    kwargs['chunks'] = chunk_shape(shape, dtype, access, maxshape)
+    return kwargs
+
+
+class CompressionPolicy(object):
+
+    def __init__(self, compression='gzip', compression_opts=4,
+                 shuffle=True, min_size=65536):
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.min_size = min_size
+
+    @classmethod
+    def read(cls, h5file):
+        """
+        :return: the compression policy stored in h5file, or None
+        """
+        attrs = h5file.attrs
+        if _attr_prefix not in attrs:
+            return None
+        compression = attrs[_attr_prefix]
+        if isinstance(compression, bytes):
+            compression = compression.decode('ASCII')
+        opts = int(attrs[_attr_prefix + '_OPTS'])
+        return cls(compression or None,
+                   None if opts < 0 else opts,
+                   bool(attrs[_attr_prefix + '_SHUFFLE']),
+                   int(attrs[_attr_prefix + '_MIN_SIZE']))
+
+    def write(self, h5file):
+        attrs = h5file.attrs
+        attrs[_attr_prefix] = self.compression or ''
+        attrs[_attr_prefix + '_OPTS'] = \
+                  -1 if self.compression_opts is None \
+                  else self.compression_opts
+        attrs[_attr_prefix + '_SHUFFLE'] = self.shuffle
+        attrs[_attr_prefix + '_MIN_SIZE'] = self.min_size
+
+    @classmethod
+    def remove(cls, h5file):
+        for suffix in ['', '_OPTS', '_SHUFFLE', '_MIN_SIZE']:
+            if _attr_prefix + suffix in h5file.attrs:
+                del h5file.attrs[_attr_prefix + suffix]
+
+    def __repr__(self):
+        if self.compression is None:
+            text = "no compression"
+        else:
+            text = self.compression
+            if self.compression_opts is not None:
+                text += " level %d" % self.compression_opts
+        if self.shuffle:
+            text += " with shuffle"
+        return "%s (datasets of at least %d bytes)" % (text, self.min_size)
+
+    def applies_to(self, shape, dtype):
+        """
+        :return: True if the policy is applicable to a dataset
+                 of the given shape and dtype
+        :rtype: bool
+        """
+        if len(shape) == 0 or dtype.kind not in 'biufc':
+            return False
+        return dtype.itemsize * int(np.prod(shape)) >= self.min_size
+
+    def options(self):
+        """
+        :return: the keyword arguments to h5py's create_dataset
+                 that implement the policy
+        :rtype: dict
+        """
+        options = {}
+        if self.compression is not None:
+            options['compression'] = self.compression
+            if self.compression_opts is not None:
+                options['compression_opts'] = self.compression_opts
+        if self.shuffle:
+            options['shuffle'] = True
+        return options
+
+    def dataset_options(self, args, kwargs):
+        """
+        :param args: the positional arguments to h5py's create_dataset,
+                     after the name of the dataset
+        :param kwargs: the keyword arguments to h5py's create_dataset
+        :return: kwargs updated by the storage options required
+                 by the policy
+        :rtype: dict
+        """
+        if any(k in kwargs for k in filter_keywords) \
+           or kwargs.get('chunks', True) is False:
+            return kwargs
+        shape, dtype = shape_and_dtype(args, kwargs)
+        if shape is None or not self.applies_to(shape, dtype):
+            return kwargs
+        kwargs = dict(kwargs)
+        kwargs.update(self.options())
+        kwargs.setdefault('chunks', True)
+        return kwargs
+
+
+#
+# Selection of a compression policy by benchmarking candidate
+# policies on samples of existing datasets.
+#
+
+def candidate_policies(min_size=65536):
+    candidates = [CompressionPolicy(None, None, False, min_size)]
+    for shuffle in [False, True]:
+        candidates.append(CompressionPolicy('lzf', None, shuffle, min_size))
+        for level in [1, 4, 9]:
+            candidates.append(CompressionPolicy('gzip', level, shuffle,
+                                                min_size))
+    return candidates
+
+
+def sample(dataset, sample_size):
+    """
+    :return: the leading part of dataset, containing about
+             sample_size bytes
+    :rtype: numpy.ndarray
+    """
+    if len(dataset.shape) == 0:
+        return dataset[...]
+    row_size = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    nrows = max(1, sample_size // max(1, row_size))
+    return dataset[:nrows]
+
+
+def benchmark(samples, policies):
+    """
+    Store and read back all samples with each policy in a
+    temporary in-memory HDF5 file.
+
+    :param samples: a list of arrays
+    :param policies: a list of CompressionPolicy objects
+    :return: for each policy, the ratio of the stored size to the
+             uncompressed size, and the time needed for writing and
+             reading all samples
+    :rtype: list
+    """
+    raw_size = sum(s.nbytes for s in samples)
+    results = []
+    for policy in policies:
+        h5file = h5py.File('benchmark-%d' % id(policy), 'w',
+                           driver='core', backing_store=False)
+        stored = 0
+        start = time.time()
+        for i, data in enumerate(samples):
+            ds = h5file.create_dataset(str(i), data=data, chunks=True,
+                                       **policy.options())
+            stored += ds.id.get_storage_size()
+        for i in range(len(samples)):
+            h5file[str(i)][...]
+        elapsed = time.time() - start
+        h5file.close()
+        results.append((policy, stored/float(max(1, raw_size)), elapsed))
+    return results
+
+
+def recommend(results, raw_size, bandwidth):
+    """
+    :param results: the return value of benchmark()
+    :param raw_size: the uncompressed size of the samples in bytes
+    :param bandwidth: the I/O bandwidth of the storage device in
+                      bytes per second
+    :return: the policy that minimizes the estimated time for
+             writing and reading the data, including the time
+             spent on I/O
+    :rtype: CompressionPolicy
+    """
+    def cost(result):
+        policy, ratio, elapsed = result
+        return elapsed + 2.*ratio*raw_size/bandwidth
+    return min(results, key=cost)[0]
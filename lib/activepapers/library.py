@@ -120,8 +120,42 @@ download_handlers = {'local': _get_local_file,
                      'doi': _get_doi,
                      'cwd': _get_file_in_cwd}
 
+#
+# The local filenames of the papers found so far, indexed by the
+# library directories, the paper reference, and for references
+# of type 'cwd' the current directory. A filename is used as long
+# as the file exists.
+#
+_found = {}
+
 def find_in_library(paper_ref):
     ref_type, label = split_paper_ref(paper_ref)
+    key = (tuple(library), paper_ref,
+           os.getcwd() if ref_type == 'cwd' else None)
+    filename = _found.get(key)
+    if filename is not None and os.path.exists(filename):
+        return filename
     handler = download_handlers.get(ref_type)
     assert handler is not None
-    return handler(label)
+    filename = handler(label)
+    _found[key] = filename
+    return filename
+
+#
+# Iterate over all papers in the library.
+#
+
+def library_papers():
+    for dir in library:
+        for dirpath, dirnames, filenames in os.walk(dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith('.ap'):
+                    continue
+                full_name = os.path.join(dirpath, filename)
+                label = os.path.relpath(full_name, dir)[:-3]
+                label = '/'.join(label.split(os.sep))
+                if label.startswith('local/'):
+                    yield 'local:' + label[6:], full_name
+                else:
+                    yield 'doi:' + label, full_name
@@ -0,0 +1,223 @@
+# A bounded pool of papers opened for reading
+#
+# Papers referenced by other papers (see storage.open_paper_ref) are
+# kept open in a pool, so that they are not reopened for each access
+# to a referenced item. The number of open papers is limited: opening
+# one more paper closes the least recently used one. Nodes obtained
+# through references (storage.APNode) open their paper only when they
+# are used, and reopen it if needed. The wrappers that codelets obtain
+# through references (execution.DataGroup and DatasetWrapper) can't
+# reopen their paper, so they pin it (see PaperPool.pin): a pinned
+# paper is not closed to make room for others, and the pool can then
+# temporarily contain more than the maximal number of papers.
+#
+# The default limit can be set by the environment variable
+# ACTIVEPAPERS_MAX_OPEN_PAPERS.
+#
+# Each paper also keeps a cache of the targets of its reference nodes
+# (ReferenceCache), such that repeated traversals of a reference don't
+# have to read the reference, look up the paper in the library, and
+# resolve the path in the referenced paper again. A cached target is
+# used as long as its paper is open. Entries are invalidated when the
+# reference node changes (see storage.ActivePaper.node_changed).
+
+import collections
+import os
+
+default_max_open = int(os.environ.get('ACTIVEPAPERS_MAX_OPEN_PAPERS', 64))
+
+
+class PaperPool(object):
+
+    def __init__(self, opener, max_open=default_max_open):
+        """
+        :param opener: a function that takes a filename and returns
+                       an open ActivePaper
+        :param max_open: the maximal number of open papers
+        """
+        self.opener = opener
+        self.max_open = max_open
+        # Maps filenames to (paper, file status), with the most
+        # recently used paper at the end
+        self._papers = collections.OrderedDict()
+        # Maps filenames to the number of live handles pinning them
+        self._pins = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._papers)
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self._papers
+
+    def get(self, filename):
+        """
+        :return: the open paper stored in filename
+        :rtype: activepapers.storage.ActivePaper
+        """
+        filename = os.path.abspath(filename)
+        status = self._status(filename)
+        paper, paper_status = self._papers.pop(filename, (None, None))
+        if paper is not None and paper.open and paper_status == status:
+            self.hits += 1
+        else:
+            # Not yet opened, closed by its user, or modified
+            # since it was opened.
+            self.misses += 1
+            if paper is not None:
+                paper.close()
+            paper = self.opener(filename)
+        self._papers[filename] = (paper, status)
+        self._evict()
+        return paper
+
+    def _status(self, filename):
+        st = os.stat(filename)
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _evict(self):
+        # The most recently used paper is kept, it is in use
+        # by the caller of get().
+        for filename in list(self._papers)[:-1]:
+            if len(self._papers) <= self.max_open:
+                break
+            if self._pins[filename] > 0:
+                continue
+            paper, status = self._papers.pop(filename)
+            paper.close()
+            self.evictions += 1
+
+    def pin(self, paper):
+        """
+        Keep paper open as long as the returned handle exists.
+
+        :return: a handle that releases the paper when it is deleted
+        """
+        filename = os.path.abspath(paper.filename)
+        self._pins[filename] += 1
+        return _Pin(self, filename)
+
+    def _release(self, filename):
+        self._pins[filename] -= 1
+        if self._pins[filename] <= 0:
+            del self._pins[filename]
+            self._evict()
+
+    def discard(self, filename):
+        """
+        Close the paper stored in filename if it is in the pool.
+        """
+        paper, status = self._papers.pop(os.path.abspath(filename),
+                                         (None, None))
+        if paper is not None:
+            paper.close()
+
+    def set_max_open(self, max_open):
+        self.max_open = max_open
+        self._evict()
+
+    def clear(self):
+        """
+        Close all papers in the pool.
+        """
+        while self._papers:
+            filename, (paper, status) = self._papers.popitem(last=False)
+            paper.close()
+
+    def statistics(self):
+        """
+        :return: the number of open papers, the maximal number,
+                 the number of pinned papers, and the numbers of
+                 hits, misses, and evictions
+        :rtype: dict
+        """
+        return dict(open=len(self._papers), max_open=self.max_open,
+                    pinned=len(self._pins), hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
+
+
+class _Pin(object):
+
+    def __init__(self, pool, filename):
+        self._pool = pool
+        self._filename = filename
+
+    def __del__(self):
+        self._pool._release(self._filename)
+
+
+class ReferenceCache(object):
+
+    def __init__(self):
+        # Maps (path, object id) of reference nodes to their targets.
+        # The object id identifies the reference node and its file,
+        # such that a reference node replaced by another one at the
+        # same path is never mistaken for it.
+        self._targets = {}
+        # Maps the paths of the cached reference nodes to their keys
+        self._keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._targets)
+
+    def lookup(self, ref_node, resolve):
+        """
+        :param ref_node: a reference node
+        :param resolve: a function that takes a reference node
+                        and returns its target
+        :return: the target of ref_node as (paper_ref, paper, node)
+        :rtype: tuple
+        """
+        path = ref_node.name
+        key = (path, ref_node.id)
+        target = self._targets.get(key)
+        if target is not None:
+            paper_ref, paper, node = target
+            # The referenced paper is still the one that was opened
+            # for resolving the reference.
+            if paper.open and node.id.valid:
+                self.hits += 1
+                return target
+        self.misses += 1
+        target = resolve(ref_node)
+        if path is not None:
+            self.invalidate(path)
+            self._targets[key] = target
+            self._keys[path] = key
+        return target
+
+    def invalidate(self, path):
+        """
+        Remove the target of the reference node at path.
+        """
+        key = self._keys.pop(path, None)
+        if key is not None:
+            del self._targets[key]
+            self.invalidations += 1
+
+    def invalidate_group(self, path):
+        """
+        Remove the targets of the reference nodes inside the group
+        at path, after its deletion.
+        """
+        prefix = path.rstrip('/') + '/'
+        for ref_path in [p for p in self._keys if p.startswith(prefix)]:
+            self.invalidate(ref_path)
+
+    def clear(self):
+        self._targets.clear()
+        self._keys.clear()
+
+    def statistics(self):
+        """
+        :return: the number of cached references, and the numbers
+                 of hits, misses, and invalidations
+        :rtype: dict
+        """
+        return dict(cached=len(self._targets), hits=self.hits,
+                    misses=self.misses, invalidations=self.invalidations)
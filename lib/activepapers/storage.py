@@ -1,22 +1,37 @@
+import atexit
 import collections
+import fnmatch
 import getpass
 import imp
 import importlib
 import io
 import itertools as it
 import os
+import re
 import socket
 import sys
-import weakref
 
 import numpy as np
 import h5py
 
 from activepapers.utility import ascii, utf8, h5vstring, isstring, execstring, \
                                  codepath, datapath, owner, mod_time, \
-                                 datatype, timestamp, stamp, ms_since_epoch
+                                 datatype, timestamp, stamp, ms_since_epoch, \
+                                 set_attribute, file_registry
 from activepapers.execution import Calclet, Importlet, DataGroup, paper_registry
 from activepapers.library import find_in_library
+from activepapers.paperpool import PaperPool, ReferenceCache
+from activepapers.cache import open_file, chunk_size, largest_chunk, \
+                               largest_chunk_attr
+from activepapers.catalog import Catalog, Entry, walk, scan, sections, \
+                                  entry_matches
+from activepapers.depgraph import dependency_list, levels
+from activepapers.textindex import search as search_text
+from activepapers.layout import CompressionPolicy, chunk_shape, \
+                                filter_options, copy_dataset, copy_attributes
+from activepapers.copying import copy_node
+from activepapers.contentstore import ContentStore, content_hash, \
+                                      shareable, hash_attribute, content_name
 import activepapers.version
 
 readme_text = """
@@ -35,11 +50,71 @@ For more information about ActivePapers see:
 
 class ActivePaper(object):
 
-    def __init__(self, filename, mode="r", dependencies=None):
+    def __init__(self, filename, mode="r", dependencies=None, catalog=False,
+                 swmr=False, in_memory=False, image=None, cache=None,
+                 libver=None, track_order=False, page_size=None,
+                 split=False, metadata_only=False):
+        self.open = False
+        if metadata_only:
+            if mode != 'r':
+                raise ValueError("metadata_only requires mode 'r'")
+            # The data of large datasets is not read, so there is
+            # no need for sizing the chunk cache.
+            cache = dict(cache or {}, rdcc_nbytes=2**20)
+        self.metadata_only = metadata_only
         self.filename = filename
-        self.file = h5py.File(filename, mode)
+        self.swmr = swmr
+        self.in_memory = in_memory
+        self.reference_cache = ReferenceCache()
+        # Attribute changes that HDF5 doesn't permit in SWMR mode,
+        # as (path, name, value, dtype), see utility.set_attribute
+        self.deferred_attributes = []
+        # The largest chunk of the datasets changed in this session
+        self._largest_chunk = 0
+        if mode[0] == 'w':
+            self.split = split
+            if not split and not in_memory \
+               and os.path.exists(raw_filename(filename)):
+                # The raw data of a paper being overwritten
+                os.remove(raw_filename(filename))
+        else:
+            self.split = not in_memory \
+                         and os.path.exists(raw_filename(filename))
+        if self.split:
+            if swmr or in_memory:
+                raise ValueError("the split layout requires a single "
+                                 "writer and a file on disk")
+            filename, split_options = split_layout_options(filename)
+        if mode[0] == 'w':
+            format_options = file_format_options(libver, track_order,
+                                                 page_size)
+        elif libver is not None or track_order or page_size is not None:
+            raise ValueError("file format options can only be given "
+                             "for new papers")
+        else:
+            format_options = {}
+        if in_memory:
+            if swmr:
+                raise ValueError("SWMR mode requires a file on disk")
+            self.file = _open_in_memory(filename, mode, image,
+                                        **format_options)
+        elif self.split:
+            format_options.update(split_options)
+            self.file = open_file(filename, mode, cache, **format_options)
+        elif not swmr:
+            self.file = open_file(filename, mode, cache, **format_options)
+        elif mode == 'r':
+            self.file = open_file(filename, mode, cache,
+                                  libver='latest', swmr=True)
+        else:
+            # SWMR requires the most recent file format. Writers
+            # switch to SWMR mode only in start_swmr(), after
+            # all the required items have been created.
+            format_options['libver'] = 'latest'
+            self.file = open_file(filename, mode, cache, **format_options)
         self.open = True
         self.writable = False
+        self.catalog = None
         if mode[0] == 'r':
             assert dependencies is None
             if ascii(self.file.attrs['DATA_MODEL']) != 'active-papers-py':
@@ -55,16 +130,31 @@ class ActivePaper(object):
                 self.dependencies = []
             else:
                 self.dependencies = [ascii(n) for n in deps]
-            for module_name in self.dependencies:
-                importlib.import_module(module_name)
+            # The dependencies of papers opened for reading are
+            # imported before running the first codelet (see
+            # import_dependencies). Writable papers need them
+            # immediately for recording their versions in the history.
+            self._dependencies_imported = False
+            if self.writable:
+                self.import_dependencies()
         elif mode[0] == 'w':
             self.file.attrs['DATA_MODEL'] = ascii('active-papers-py')
             self.file.attrs['DATA_MODEL_MAJOR_VERSION'] = 0
             self.file.attrs['DATA_MODEL_MINOR_VERSION'] = 1
-            self.code_group = self.file.create_group("code")
-            self.data_group = self.file.create_group("data")
-            self.documentation_group = self.file.create_group("documentation")
+            self.file.attrs[largest_chunk_attr] = 0
+            if libver is not None:
+                self.file.attrs['ACTIVE_PAPER_LIBVER'] = ascii(libver)
+            if track_order:
+                self.file.attrs['ACTIVE_PAPER_TRACK_ORDER'] = True
+            self.code_group = self.file.create_group("code",
+                                                     track_order=track_order)
+            self.data_group = self.file.create_group("data",
+                                                     track_order=track_order)
+            self.documentation_group = \
+                self.file.create_group("documentation",
+                                       track_order=track_order)
             deps = self.file.create_group('external-dependencies')
+            self._dependencies_imported = True
             if dependencies is None:
                 self.dependencies = []
             else:
@@ -94,17 +184,52 @@ class ActivePaper(object):
             readme[...] = readme_text
             self.writable = True
 
+        self.compression_policy = CompressionPolicy.read(self.file)
+        self.track_order = \
+            bool(self.file.attrs.get('ACTIVE_PAPER_TRACK_ORDER', False))
+
+        if 'catalog' in self.file:
+            self.catalog = Catalog(self.file)
+        elif catalog and self.writable:
+            self.catalog = Catalog.create(self.file)
+
         if self.writable:
             self.update_history(close=False)
 
-        import activepapers.utility
-        self.data = DataGroup(self, None, self.data_group, ExternalCode(self))
+        self._data = None
         self.imported_modules = {}
 
         self._local_modules = {}
 
         paper_id = hex(id(self))[2:]
         paper_registry[paper_id] = self
+        file_registry[self.file.id] = self
+
+    @property
+    def data(self):
+        # Created on first use, since most users of a paper
+        # opened for reading don't need it.
+        if self._data is None:
+            if self.metadata_only:
+                raise ValueError("paper %s was opened with metadata_only=True"
+                                 % self.filename)
+            self._data = DataGroup(self, None, self.data_group,
+                                   ExternalCode(self))
+        return self._data
+
+    def import_dependencies(self):
+        """
+        Import the Python packages on which the paper depends.
+        This is done automatically before running the first codelet.
+        """
+        if self._dependencies_imported:
+            return
+        if self.metadata_only:
+            raise ValueError("paper %s was opened with metadata_only=True"
+                             % self.filename)
+        for module_name in self.dependencies:
+            importlib.import_module(module_name)
+        self._dependencies_imported = True
 
     def update_history(self, close):
         if close:
@@ -128,13 +253,77 @@ class ActivePaper(object):
                                 h5py.version.hdf5_version) \
                                + tuple(getversion(m) for m in self.dependencies)
 
+    @classmethod
+    def from_bytes(cls, image, mode="r", filename="<memory>"):
+        """
+        :param image: the contents of an ActivePaper file, as
+                      returned by to_bytes()
+        :type image: bytes
+        :param mode: 'r' or 'r+'
+        :return: an in-memory ActivePaper with the contents of image
+        :rtype: ActivePaper
+        """
+        return cls(filename, mode, in_memory=True, image=image)
+
+    def to_bytes(self):
+        """
+        :return: the contents of the paper's HDF5 file, with the
+                 current time as the closing time of the current
+                 session in the history
+        :rtype: bytes
+        """
+        self.assert_is_open()
+        if not self.writable:
+            return self.file.id.get_file_image()
+        # The closing time is recorded for the image only, the
+        # session of the open paper goes on.
+        entry = self.history[-1]
+        self.update_history(close=True)
+        self.flush()
+        image = self.file.id.get_file_image()
+        self.history[-1] = entry
+        return image
+
+    def save(self, filename):
+        """
+        Write the current state of the paper to filename. This is
+        mainly useful for papers opened with in_memory=True, which
+        are otherwise lost when they are closed.
+        """
+        image = self.to_bytes()
+        with open(filename, 'wb') as f:
+            f.write(image)
+
     def close(self):
         if self.open:
             if self.writable:
                 self.update_history(close=True)
+                if self.catalog is not None:
+                    self.catalog.save()
+                self._record_unused_space()
+                self._record_largest_chunk()
             del self._local_modules
+            self.reference_cache.clear()
             self.open = False
+            try:
+                del file_registry[self.file.id]
+            except KeyError:
+                pass
             self.file.close()
+            if self.deferred_attributes:
+                with h5py.File(self.filename, 'r+',
+                               libver='latest') as h5file:
+                    for path, name, value, dtype \
+                            in self.deferred_attributes:
+                        h5file[path].attrs.create(name, value, dtype=dtype)
+                    if self.catalog is not None:
+                        # The catalog recorded the previous dependencies
+                        catalog = Catalog(h5file)
+                        for path in set(d[0] for d
+                                        in self.deferred_attributes):
+                            catalog.update(h5file[path])
+                        catalog.save()
+                self.deferred_attributes = []
             paper_id = hex(id(self))[2:]
             try:
                 del paper_registry[paper_id]
@@ -156,8 +345,251 @@ class ActivePaper(object):
         return False
 
     def flush(self):
+        if self.writable and self.catalog is not None:
+            self.catalog.save()
         self.file.flush()
 
+    def set_compression_policy(self, policy):
+        """
+        Define the storage options for datasets created later
+        without explicit storage options.
+
+        :param policy: the new policy, or None for removing the policy
+        :type policy: activepapers.layout.CompressionPolicy
+        """
+        if policy is None:
+            CompressionPolicy.remove(self.file)
+        else:
+            policy.write(self.file)
+        self.compression_policy = policy
+
+    def rechunk(self, path, chunks=None, access='rows', **options):
+        """
+        Rewrite a dataset with a new chunk shape, keeping its data,
+        its attributes (including its timestamp and dependencies)
+        and, unless overridden by options, its filters. The dataset
+        is copied block by block, so it need not fit into memory.
+
+        HDF5 object references to the old dataset become invalid.
+
+        :param path: the path of the dataset
+        :param chunks: the new chunk shape
+        :param access: the expected access pattern, used for choosing
+                       the chunk shape if chunks is None
+                       (see activepapers.layout.chunk_shape)
+        :param options: filter keywords for h5py's create_dataset
+                        (compression, compression_opts, shuffle,
+                        scaleoffset, fletcher32)
+        """
+        ds = self._dataset_to_rewrite(path)
+        if len(ds.shape) == 0:
+            raise ValueError("scalar dataset %s can't be chunked" % path)
+        if chunks is None:
+            chunks = chunk_shape(ds.shape, ds.dtype, access, ds.maxshape)
+        options = dict(filter_options(ds), **options)
+        self._replace_dataset(ds, dict(options, chunks=tuple(chunks)))
+
+    def _dataset_to_rewrite(self, path):
+        self.assert_is_open()
+        if not self.writable:
+            raise ValueError("ActivePaper %s is not writable" % self.filename)
+        ds = self.file[path]
+        if not isinstance(ds, h5py.Dataset):
+            raise TypeError("%s is not a dataset" % path)
+        return ds
+
+    def _replace_dataset(self, ds, options=None, layout=None):
+        # Replace ds by a new dataset with the same attributes,
+        # created with the given storage options, or by a virtual
+        # dataset with the given layout.
+        name = ds.name
+        tmp_name = name + '.rewrite'
+        if layout is not None:
+            new = self.file.create_virtual_dataset(tmp_name, layout)
+            copy_attributes(ds, new)
+        else:
+            copy_dataset(ds, self.file, tmp_name, options)
+        del self.file[name]
+        self.file.move(tmp_name, name)
+        self.node_changed(self.file[name])
+        return self.file[name]
+
+    def _shared_datasets(self):
+        shared = []
+        def collect(name, node):
+            if isinstance(node, h5py.Dataset) and node.is_virtual \
+               and hash_attribute in node.attrs:
+                shared.append(node)
+        self.data_group.visititems(collect)
+        return shared
+
+    def deduplicate(self, store=None, min_size=2**20):
+        """
+        Move the contents of all datasets in the data section of at
+        least min_size bytes to a content store, which keeps a single
+        copy of identical contents. The datasets are replaced by
+        virtual datasets with the same attributes. Resizable datasets
+        and internal files are not moved. A dataset modified through
+        the wrappers used by codelets (and by paper.data) is copied
+        back into the paper first (see unshare()), such that the
+        shared contents are never modified. HDF5 opens the store
+        files with the access mode of the paper, so the store can't
+        be protected against writes to the HDF5 datasets themselves
+        (paper.data_group, paper.file): call unshare() before writing
+        to a dataset with the attribute ACTIVE_PAPER_CONTENT_HASH.
+
+        The space freed in the paper becomes available for new data.
+        Use repack() to shrink the file.
+
+        :param store: the content store (default: the store in the
+                      ActivePapers library)
+        :type store: activepapers.contentstore.ContentStore
+        :return: a list of (path, content hash) for the datasets
+                 that were moved to the store
+        :rtype: list
+        """
+        if self.split:
+            # HDF5 opens the source files of virtual datasets
+            # with the file driver of the virtual dataset's file.
+            raise ValueError("papers in the split layout can't "
+                             "be deduplicated")
+        if store is None:
+            store = ContentStore()
+        candidates = []
+        def collect(name, node):
+            if isinstance(node, h5py.Dataset) and shareable(node, min_size):
+                candidates.append(node.name)
+        self.data_group.visititems(collect)
+        moved = []
+        for path in candidates:
+            ds = self._dataset_to_rewrite(path)
+            h = content_hash(ds)
+            store.add(ds, h)
+            new = self._replace_dataset(ds, layout=store.layout(h))
+            new.attrs[hash_attribute] = h
+            moved.append((path, h))
+        return moved
+
+    def inline_shared(self):
+        """
+        Copy the contents of all datasets in the data section that
+        refer to a content store back into the paper, making it
+        self-contained. This is the inverse of deduplicate().
+
+        :return: the paths of the datasets that were copied
+        :rtype: list
+        """
+        return [self.unshare(ds.name).name
+                for ds in self._shared_datasets()]
+
+    def unshare(self, path):
+        """
+        Copy the contents of a dataset that refers to a content
+        store back into the paper.
+
+        :return: the new dataset
+        :rtype: h5py.Dataset
+        """
+        ds = self._dataset_to_rewrite(path)
+        with h5py.File(ds.virtual_sources()[0].file_name, 'r') as f:
+            stored = f[content_name]
+            options = filter_options(stored)
+            options['chunks'] = stored.chunks
+        new = self._replace_dataset(ds, options)
+        del new.attrs[hash_attribute]
+        return new
+
+    def start_swmr(self):
+        """
+        Switch a paper opened for writing with swmr=True to HDF5's
+        single-writer/multiple-reader mode. From then on, other
+        processes can open the paper with mode 'r' and swmr=True and
+        watch datasets grow by calling their refresh() method. The
+        changes become visible to the readers after each flush().
+
+        HDF5 doesn't guarantee that readers see objects that are
+        created after the switch, so codelets should create all
+        their datasets (resizable if required) before calling
+        start_swmr, and then only write to them and resize them.
+        Stamping writes the timestamps in place. Attribute changes
+        that HDF5 doesn't permit in SWMR mode, such as a changed
+        number of dependencies, are made when the paper is closed.
+        """
+        self.assert_is_open()
+        if not (self.writable and self.swmr):
+            raise ValueError("ActivePaper %s was not opened for writing "
+                             "with swmr=True" % self.filename)
+        self.flush()
+        self.file.swmr_mode = True
+
+    def refresh(self):
+        """
+        Update the catalog of a paper opened for reading with
+        swmr=True, to take into account the changes made by
+        the writing process.
+        """
+        self.assert_is_open()
+        if self.catalog is not None:
+            self.catalog.refresh()
+
+    def node_changed(self, node):
+        """
+        Update the catalog after a change to a node. This is done
+        automatically when a node is stamped, so it is required only
+        for nodes created or modified directly through h5py.
+        """
+        if isinstance(node, h5py.Dataset):
+            self.dataset_changed(node)
+        if self.catalog is not None:
+            self.catalog.update(node)
+        if self.reference_cache:
+            self.reference_cache.invalidate(node.name)
+
+    def dataset_changed(self, ds):
+        """
+        Record the chunk size of a dataset that was created or
+        modified, for sizing the chunk cache (see activepapers.cache).
+        This is done by node_changed(), and is required only for
+        datasets inside data items.
+        """
+        self._largest_chunk = max(self._largest_chunk, chunk_size(ds))
+
+    def _record_largest_chunk(self):
+        stored = self.file.attrs.get(largest_chunk_attr, None)
+        if stored is None:
+            # Paper written before the attribute was introduced
+            largest = max(largest_chunk(self.file), self._largest_chunk)
+        elif self._largest_chunk > stored:
+            largest = self._largest_chunk
+        else:
+            return
+        set_attribute(self.file, largest_chunk_attr, largest)
+
+    def delete_item(self, path):
+        """
+        Delete an item or a group, updating the catalog.
+        """
+        node = self.file[path]
+        name = node.name
+        is_group = isinstance(node, h5py.Group)
+        del self.file[path]
+        if self.catalog is not None:
+            self.catalog.remove(name)
+        self.reference_cache.invalidate(name)
+        if is_group:
+            self.reference_cache.invalidate_group(name)
+
+    def rebuild_catalog(self):
+        """
+        Create the catalog of a paper, or rebuild it from scratch
+        if it already exists.
+        """
+        if self.catalog is None:
+            self.catalog = Catalog.create(self.file)
+        else:
+            self.catalog.rebuild()
+        self.catalog.save()
+
     def _create_ref(self, path, paper_ref, ref_path, group, prefix):
         if ref_path is None:
             ref_path = path
@@ -194,13 +626,18 @@ class ActivePaper(object):
             ref_path = "python-packages/" + ref_path
         return self.create_code_ref(path, paper_ref, ref_path)
 
-    def create_copy(self, path, paper_ref, ref_path=None):
+    def create_copy(self, path, paper_ref, ref_path=None, statistics=None):
+        """
+        Copy an item from another paper.
+
+        :param statistics: records the number of bytes copied
+        :type statistics: activepapers.copying.CopyStatistics
+        """
         if ref_path is None:
             ref_path = path
         paper = open_paper_ref(paper_ref)
         item = paper.file[ref_path]
-        self.file.copy(item, path, expand_refs=True)
-        copy = self.file[path]
+        copy = copy_node(item, self.file, path, statistics)
         self._delete_dependency_attributes(copy)
         timestamp(copy, mod_time(item))
         ref_dtype = np.dtype([('paper_ref', h5vstring), ('path', h5vstring)])
@@ -209,6 +646,112 @@ class ActivePaper(object):
                           data=np.array((paper_ref, ref_path), dtype=ref_dtype))
         return copy
 
+    def create_virtual(self, path, sources):
+        """
+        Create a virtual dataset that concatenates regions of datasets
+        in other papers along their first axis, without copying data.
+        The sources are recorded in the attribute
+        ACTIVE_PAPER_VIRTUAL_SOURCES. The referenced papers must remain
+        available in the library for the data to be readable.
+
+        HDF5 opens the source files with the access mode of the file
+        containing the virtual dataset, so reading it from a writable
+        paper requires write permission for the referenced papers.
+
+        :param path: the path of the new dataset
+        :param sources: a list of (paper_ref, ref_path) or
+                        (paper_ref, ref_path, selection), where
+                        selection is an index expression for the
+                        dataset ref_path in the paper paper_ref
+                        (default: the whole dataset)
+        :return: the virtual dataset
+        :rtype: h5py.Dataset
+        """
+        self.assert_is_open()
+        if not sources:
+            raise ValueError("no sources for virtual dataset %s" % path)
+        pieces = []
+        refs = []
+        timestamps = []
+        filenames = set()
+        for source in sources:
+            paper_ref, ref_path = source[:2]
+            selection = source[2] if len(source) > 2 else Ellipsis
+            paper = open_paper_ref(paper_ref)
+            if paper.split:
+                # HDF5 opens the source files of virtual datasets
+                # with the file driver of the virtual dataset's file.
+                raise ValueError("paper %s uses the split layout"
+                                 % paper_ref)
+            item = paper.file[ref_path]
+            if not isinstance(item, h5py.Dataset):
+                raise TypeError("%s in %s is not a dataset"
+                                % (ref_path, paper_ref))
+            virtual_source = h5py.VirtualSource(paper.filename, item.name,
+                                                shape=item.shape,
+                                                dtype=item.dtype)
+            piece = virtual_source[selection]
+            if len(piece.shape) == 0:
+                raise ValueError("source %s:%s is a scalar"
+                                 % (paper_ref, ref_path))
+            pieces.append((piece, item.dtype))
+            refs.append((paper_ref, item.name))
+            timestamps.append(mod_time(item) or 0.)
+            filenames.add(paper.filename)
+        dtype = pieces[0][1]
+        tail = pieces[0][0].shape[1:]
+        for piece, piece_dtype in pieces:
+            if piece.shape[1:] != tail or piece_dtype != dtype:
+                raise ValueError("incompatible sources for virtual "
+                                 "dataset %s" % path)
+        length = sum(piece.shape[0] for piece, piece_dtype in pieces)
+        layout = h5py.VirtualLayout(shape=(length,)+tail, dtype=dtype)
+        offset = 0
+        for piece, piece_dtype in pieces:
+            layout[offset:offset+piece.shape[0]] = piece
+            offset += piece.shape[0]
+        ds = self.file.create_virtual_dataset(path, layout)
+        ref_dtype = np.dtype([('paper_ref', h5vstring), ('path', h5vstring)])
+        ds.attrs.create('ACTIVE_PAPER_VIRTUAL_SOURCES',
+                        np.array(refs, dtype=ref_dtype))
+        stamp(ds, 'data', {})
+        timestamp(ds, max(timestamps))
+        if self.writable:
+            # HDF5 can't open the source files for writing
+            # while they are open read-only in the pool.
+            for filename in filenames:
+                paper_pool.discard(filename)
+        return ds
+
+    def materialize(self, path, chunks=None, access='rows', **options):
+        """
+        Replace a virtual dataset by a physical copy of its data,
+        keeping its attributes. Unless overridden by options, the copy
+        has the filters of the first source dataset.
+
+        :param path: the path of the virtual dataset
+        :param chunks: the chunk shape of the copy
+        :param access: the expected access pattern, used for choosing
+                       the chunk shape if chunks is None
+                       (see activepapers.layout.chunk_shape)
+        :param options: filter keywords for h5py's create_dataset
+        :return: the new dataset
+        :rtype: h5py.Dataset
+        """
+        ds = self._dataset_to_rewrite(path)
+        if not ds.is_virtual:
+            raise ValueError("%s is not a virtual dataset" % path)
+        source = ds.virtual_sources()[0]
+        with h5py.File(source.file_name, 'r') as f:
+            stored = f[source.dset_name]
+            if stored.chunks is not None:
+                options = dict(filter_options(stored), **options)
+        if len(ds.shape) > 0:
+            if chunks is None:
+                chunks = chunk_shape(ds.shape, ds.dtype, access, ds.maxshape)
+            options['chunks'] = tuple(chunks)
+        return self._replace_dataset(ds, options)
+
     def _delete_dependency_attributes(self, node):
         for attr_name in ['ACTIVE_PAPER_GENERATING_CODELET',
                           'ACTIVE_PAPER_DEPENDENCIES']:
@@ -351,7 +894,7 @@ class ActivePaper(object):
                       self.data_group,
                       self.documentation_group]:
             for node_name in owned(group):
-                del self.file[node_name]
+                self.delete_item(node_name)
 
     def replace_by_dummy(self, item_name):
         item = self.file[item_name]
@@ -360,14 +903,14 @@ class ActivePaper(object):
         dtype = datatype(item)
         mtime = mod_time(item)
         deps = item.attrs.get('ACTIVE_PAPER_DEPENDENCIES')
-        del self.file[item_name]
+        self.delete_item(item_name)
         ds = self.file.create_dataset(item_name,
                                       data=np.zeros((), dtype=np.int))
+        ds.attrs['ACTIVE_PAPER_DUMMY_DATASET'] = True
         stamp(ds, dtype,
               dict(ACTIVE_PAPER_GENERATING_CODELET=codelet,
                    ACTIVE_PAPER_DEPENDENCIES=list(deps)))
         timestamp(ds, mtime)
-        ds.attrs['ACTIVE_PAPER_DUMMY_DATASET'] = True
         
     def is_dummy(self, item):
         return item.attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False)
@@ -376,6 +919,10 @@ class ActivePaper(object):
         """
         Iterate over the items in a paper.
         """
+        if self.catalog is not None:
+            for entry in self.catalog.select(items=True):
+                yield self.file[entry['path']]
+            return
         def walk(group):
             for node in group.values():
                 if isinstance(node, h5py.Group) \
@@ -390,10 +937,72 @@ class ActivePaper(object):
             for node in walk(group):
                 yield node
 
+    def query(self, datatype=None, owner=None, after=None, before=None,
+              min_size=None, max_size=None, dummy=None, patterns=None,
+              items=True):
+        """
+        Find the items satisfying all the given criteria. The query
+        is answered from the catalog if the paper has one, and
+        otherwise in a single pass over the HDF5 hierarchy.
+
+        :param datatype: the ActivePapers datatype of the items
+        :param owner: the path of the codelet that generated the items
+        :param after: the earliest modification time of the items
+                      (in seconds since the epoch)
+        :param before: the time before which the items were modified
+                       (in seconds since the epoch)
+        :param min_size: the minimal storage size in bytes
+        :param max_size: the maximal storage size in bytes
+        :param dummy: True/False for only dummy/non-dummy items
+        :param patterns: glob patterns or compiled regular expressions,
+                         at least one of which must match the path of
+                         an item (without the initial slash)
+        :param items: True for items, False for groups that are not
+                      items, None for both
+        :return: an iterator over the catalog entries of the items
+        :rtype: iterator over activepapers.catalog.Entry
+        """
+        self.assert_is_open()
+        def ms(t):
+            return None if t is None else int(1000.*t)
+        criteria = dict(items=items, datatype=datatype, owner=owner,
+                        dummy=dummy, patterns=patterns,
+                        after=ms(after), before=ms(before),
+                        min_size=min_size, max_size=max_size)
+        if self.catalog is not None:
+            return (Entry(*entry) for entry in self.catalog.select(**criteria))
+        if patterns is not None:
+            criteria['patterns'] = [re.compile(fnmatch.translate(p))
+                                    if isstring(p) else p for p in patterns]
+        return (entry for entry in scan(self.file)
+                if entry_matches(entry, **criteria))
+
+    def search_text(self, string, ignore_case=False):
+        """
+        Find the lines of the code and documentation items that
+        contain a string. The search uses the full-text index of
+        the catalog if the paper has one, and otherwise reads all
+        text items.
+
+        :param string: the text to search for
+        :param ignore_case: if True, ignore the difference between
+                            upper and lower case
+        :return: an iterator over (path, line number, line)
+        :rtype: iterator
+        """
+        self.assert_is_open()
+        if self.catalog is not None:
+            return self.catalog.text.search(string, ignore_case)
+        return search_text(self.file, string, ignore_case)
+
     def iter_groups(self):
         """
         Iterate over the groups in a paper that are not items.
         """
+        if self.catalog is not None:
+            for entry in self.catalog.select(items=False):
+                yield self.file[entry['path']]
+            return
         def walk(group):
             for node in group.values():
                 if isinstance(node, h5py.Group) \
@@ -411,17 +1020,38 @@ class ActivePaper(object):
         """
         Iterate over the dependencies of a given item in a paper.
         """
+        if self.catalog is not None:
+            for dep in self.catalog.graph.dependencies(item.name):
+                yield self.file[dep]
+            return
         if 'ACTIVE_PAPER_DEPENDENCIES' in item.attrs:
             for dep in item.attrs['ACTIVE_PAPER_DEPENDENCIES']:
                 yield self.file[dep]
 
     def is_stale(self, item):
+        if self.catalog is not None:
+            t = self.catalog[item.name].timestamp
+            return any(self.catalog[dep].timestamp > t
+                       for dep in self.catalog.graph.dependencies(item.name))
         t = mod_time(item)
         for dep in self.iter_dependencies(item):
             if mod_time(dep) > t:
                 return True
         return False
 
+    def stale_items(self):
+        """
+        :return: the names of all items that are older than
+                 at least one of their dependencies
+        :rtype: set
+        """
+        if self.catalog is not None:
+            table = self.catalog.table()
+            timestamps = dict(zip(table['path'], table['timestamp']))
+            return self.catalog.graph.stale(timestamps)
+        return set(item.name for item in self.iter_items()
+                   if self.is_stale(item))
+
     def external_references(self):
         def process(node, refs):
             if datatype(node) == 'reference':
@@ -435,6 +1065,12 @@ class ActivePaper(object):
                     paper_ref = paper_ref.flat[0]
                     ref_path = ref_path.flat[0]
                 refs[paper_ref][1].add(ref_path)
+            elif 'ACTIVE_PAPER_VIRTUAL_SOURCES' in node.attrs:
+                # Virtual datasets are links, materialized ones copies
+                kind = 0 if node.is_virtual else 1
+                for paper_ref, ref_path \
+                        in node.attrs['ACTIVE_PAPER_VIRTUAL_SOURCES']:
+                    refs[paper_ref][kind].add(ref_path)
             if isinstance(node, h5py.Group):
                 for item in node:
                     process(node[item], refs)
@@ -463,34 +1099,58 @@ class ActivePaper(object):
         :rtype: dict
         """
         graph = collections.defaultdict(set)
+        if self.catalog is not None:
+            graph.update(self.catalog.graph.reverse())
+            return graph
         for item in it.chain(self.iter_items(), self.iter_groups()):
             for dep in self.iter_dependencies(item):
                 graph[dep.name].add(item.name)
         return graph
 
-    def dependency_hierarchy(self):
+    def dependents(self, names, transitive=False):
+        """
+        :param names: the names of items in the paper
+        :param transitive: if True, include the items that depend
+                           indirectly on the given items
+        :return: the names of the items that depend on any of
+                 the given items
+        :rtype: set
+        """
+        if self.catalog is not None:
+            return self.catalog.graph.dependents(names, transitive)
+        graph = self.dependency_graph()
+        found = set()
+        new = set(names)
+        while new:
+            new = set(it.chain.from_iterable(graph[name] for name in new))
+            new -= found
+            found |= new
+            if not transitive:
+                break
+        return found
+
+    def dependency_hierarchy(self, nodes=True):
         """
-        Generator yielding a sequence of sets of HDF5 paths
+        Generator yielding a sequence of sets of items
         such that the items in each set depend only on the items
         in the preceding sets.
+
+        :param nodes: if True, the sets contain h5py nodes, otherwise
+                      they contain the HDF5 paths of the items
         """
-        known = set()
-        unknown = set()
-        for item in self.iter_items():
-            d = (item.name,
-                 frozenset(dep.name for dep in self.iter_dependencies(item)))
-            if len(d[1]) > 0:
-                unknown.add(d)
+        if self.catalog is not None:
+            graph = self.catalog.graph
+            dependencies = dict((path, graph.dependencies(path))
+                                for path in
+                                self.catalog.select(items=True)['path'])
+        else:
+            dependencies = dict((item.name, dependency_list(item))
+                                for item in self.iter_items())
+        for level in levels(dependencies):
+            if nodes:
+                yield set(self.file[p] for p in level)
             else:
-                known.add(d[0])
-        yield set(self.file[p] for p in known)
-        while len(unknown) > 0:
-            next = set(p for p, d in unknown if d <= known)
-            if len(next) == 0:
-                raise ValueError("cyclic dependencies")
-            known |= next
-            unknown = set((p, d) for p, d in unknown if p not in next)
-            yield set(self.file[p] for p in next)
+                yield level
 
     def rebuild(self, filename):
         """
@@ -499,9 +1159,11 @@ class ActivePaper(object):
         file, then all the calclets are run in the new file in the
         order determined by the dependency graph in the original file.
         """
-        deps = self.dependency_hierarchy()
-        with ActivePaper(filename, 'w') as clone:
-            for item in next(deps):
+        deps = self.dependency_hierarchy(nodes=False)
+        with ActivePaper(filename, 'w',
+                         catalog=self.catalog is not None) as clone:
+            for item_name in next(deps):
+                item = self.file[item_name]
                 # Make sure all the groups in the path exist
                 path = item.name.split('/')
                 name = path[-1]
@@ -514,30 +1176,238 @@ class ActivePaper(object):
                             dest.create_group(group_name)
                         dest = dest[group_name]
                     del groups[0]
-                clone.file.copy(item, item.name, expand_refs=True)
+                copy_node(item, clone.file, item.name)
                 timestamp(clone.file[item.name])
             for items in deps:
-                calclets = set(item.attrs['ACTIVE_PAPER_GENERATING_CODELET']
-                               for item in items)
+                calclets = set(owner(self.file[item_name])
+                               for item_name in items)
                 for calclet in calclets:
                     clone.run_codelet(calclet)
 
-    def snapshot(self, filename):
+    def snapshot(self, filename, incremental=False, progress_only=False):
         """
         Make a copy of the ActivePaper in its current state.
         This is meant to be used form inside long-running
         codelets in order to permit external monitoring of
         the progress, given that HDF5 files being written cannot
         be read simultaneously.
+
+        :param incremental: if True and filename contains a previous
+                            snapshot of the same paper, update it by
+                            copying only the items modified since then
+                            and deleting the items that no longer exist.
+                            Object references inside the updated items
+                            point to copies of the referenced objects.
+        :param progress_only: if True, store every item as a dummy
+                              dataset that has the item's ActivePapers
+                              attributes, and for datasets its shape in
+                              the attribute ACTIVE_PAPER_SHAPE, but no data.
         """
-        self.file.flush()
-        clone = h5py.File(filename, 'w')
-        for item in self.file:
-            clone.copy(self.file[item], item, expand_refs=True)
+        self.flush()
+        source = os.path.abspath(self.file.filename)
+        previous = None
+        if incremental and os.path.exists(filename):
+            clone = h5py.File(filename, 'r+')
+            if clone.attrs.get('ACTIVE_PAPER_SNAPSHOT_OF') == source \
+               and clone.attrs.get('ACTIVE_PAPER_SNAPSHOT_PROGRESS_ONLY') \
+                   == progress_only:
+                previous = clone.attrs['ACTIVE_PAPER_SNAPSHOT_TIME']
+            else:
+                clone.close()
+        if previous is None:
+            clone = h5py.File(filename, 'w')
+        snapshot_time = ms_since_epoch()
+        if previous is None and not progress_only:
+            for item in self.file:
+                copy_node(self.file[item], clone, item)
+        else:
+            self._update_snapshot(clone, previous, progress_only)
         for attr_name in self.file.attrs:
             clone.attrs[attr_name] = self.file.attrs[attr_name]
+        clone.attrs['ACTIVE_PAPER_SNAPSHOT_OF'] = source
+        clone.attrs['ACTIVE_PAPER_SNAPSHOT_TIME'] = snapshot_time
+        clone.attrs['ACTIVE_PAPER_SNAPSHOT_PROGRESS_ONLY'] = progress_only
         clone.close()
 
+    def _update_snapshot(self, clone, previous, progress_only):
+        # Copy the bookkeeping information, except for the catalog,
+        # which doesn't describe the snapshot.
+        for name in self.file:
+            if '/' + name in sections:
+                clone.require_group(name)
+            elif name != 'catalog':
+                if name in clone:
+                    del clone[name]
+                copy_node(self.file[name], clone, name)
+        if 'catalog' in clone:
+            del clone['catalog']
+        # Copy the items that were modified since the previous snapshot
+        if self.catalog is None:
+            entries = walk(self.file)
+        else:
+            entries = (self.catalog[path]
+                       for path in self.catalog.select(items=None)['path'])
+        paths = set()
+        for entry in entries:
+            paths.add(entry.path)
+            node = self.file[entry.path]
+            if not entry.is_item:
+                group = clone.require_group(entry.path)
+                for attr_name in node.attrs:
+                    group.attrs[attr_name] = node.attrs[attr_name]
+                continue
+            if entry.path in clone:
+                if previous is not None and 0 < entry.timestamp < previous:
+                    continue
+                del clone[entry.path]
+            if progress_only:
+                placeholder = clone.create_dataset(
+                                  entry.path,
+                                  data=np.zeros((), dtype=np.int64))
+                for attr_name in node.attrs:
+                    if attr_name.startswith('ACTIVE_PAPER'):
+                        placeholder.attrs[attr_name] = node.attrs[attr_name]
+                placeholder.attrs['ACTIVE_PAPER_DUMMY_DATASET'] = True
+                if isinstance(node, h5py.Dataset):
+                    placeholder.attrs['ACTIVE_PAPER_SHAPE'] = node.shape
+            else:
+                copy_node(node, clone, entry.path)
+        # Delete the items that no longer exist
+        for entry in list(walk(clone)):
+            if entry.path not in paths and entry.path in clone:
+                del clone[entry.path]
+
+    def space_usage(self):
+        """
+        :return: the size of the file and an estimate of the space
+                 occupied by live objects, both in bytes. The estimate
+                 counts the storage of all datasets plus a nominal
+                 metadata size per object.
+        :rtype: tuple
+        """
+        self.flush()
+        live = [0]
+        def count(name, node):
+            live[0] += _object_overhead
+            if isinstance(node, h5py.Dataset) and not node.is_virtual:
+                live[0] += node.id.get_storage_size()
+        self.file.visititems(count)
+        return self.file.id.get_filesize(), live[0]
+
+    def file_format(self):
+        """
+        :return: the file format options used for creating the paper
+                 (libver, track_order, page_size)
+        :rtype: dict
+        """
+        libver = self.file.attrs.get('ACTIVE_PAPER_LIBVER', None)
+        fcpl = self.file.id.get_create_plist()
+        page_size = None
+        if fcpl.get_file_space_strategy()[0] == h5py.h5f.FSPACE_STRATEGY_PAGE:
+            page_size = fcpl.get_file_space_page_size()
+        return dict(libver=None if libver is None else ascii(libver),
+                    track_order=self.track_order,
+                    page_size=page_size)
+
+    def unused_space(self):
+        """
+        :return: an estimate of the unused space in the file, in bytes
+        :rtype: int
+        """
+        free = self.file.id.get_freespace()
+        if self._persistent_free_space():
+            return free
+        # The free space of earlier sessions, lost when they closed
+        # the file, is recorded by _record_unused_space().
+        return free + int(self.file.attrs.get(_unused_space_attr, 0))
+
+    def _persistent_free_space(self):
+        fcpl = self.file.id.get_create_plist()
+        return bool(fcpl.get_file_space_strategy()[1])
+
+    def _record_unused_space(self):
+        # HDF5 reuses the space freed in a session only during that
+        # session, unless the paper was created with persistent free
+        # space (see file_format_options). Nothing is recorded if
+        # nothing was freed.
+        if self.in_memory or self._persistent_free_space() \
+           or self.file.id.get_freespace() == 0:
+            return
+        # In SWMR mode, a new attribute is created after closing
+        set_attribute(self.file, _unused_space_attr, self.unused_space())
+
+    def set_repack_threshold(self, threshold):
+        """
+        Store the fraction of unused space above which needs_repack()
+        returns True, and thus "aptool repack --if-over" without a
+        fraction repacks the paper.
+
+        :param threshold: a fraction between 0 and 1, or None for
+                          removing the threshold
+        """
+        if threshold is None:
+            if 'ACTIVE_PAPER_REPACK_THRESHOLD' in self.file.attrs:
+                del self.file.attrs['ACTIVE_PAPER_REPACK_THRESHOLD']
+        else:
+            self.file.attrs['ACTIVE_PAPER_REPACK_THRESHOLD'] = threshold
+
+    def repack_threshold(self):
+        """
+        :return: the threshold set by set_repack_threshold, or None
+        :rtype: float
+        """
+        threshold = self.file.attrs.get('ACTIVE_PAPER_REPACK_THRESHOLD', None)
+        return None if threshold is None else float(threshold)
+
+    def needs_repack(self, threshold=None):
+        """
+        :param threshold: a fraction between 0 and 1 (default: the
+                          threshold set by set_repack_threshold)
+        :return: True if the estimated fraction of unused space in the
+                 file (see unused_space()) exceeds threshold
+        :rtype: bool
+        """
+        if threshold is None:
+            threshold = self.repack_threshold()
+            if threshold is None:
+                return False
+        size = self.file.id.get_filesize()
+        return self.unused_space() > threshold*size
+
+    def repack(self, filename, compression_policy=None, split=None):
+        """
+        Copy all live objects of the paper to a new file, which thus
+        contains no unused space. Attributes, the history, and object
+        references are preserved.
+
+        :param filename: the name of the new file
+        :param compression_policy: if not None, all datasets to which
+                                   the policy applies are stored with
+                                   its compression options and chunks
+                                   of the shape chosen by
+                                   activepapers.layout.chunk_shape
+        :type compression_policy: activepapers.layout.CompressionPolicy
+        :param split: True for the split layout, False for a single
+                      file, None for the layout of the paper
+        """
+        self.flush()
+        options = file_format_options(**self.file_format())
+        if split is None:
+            split = self.split
+        if split:
+            filename, split_options = split_layout_options(filename)
+            options.update(split_options)
+        with h5py.File(filename, 'w', **options) as dest:
+            copy_attributes(self.file, dest)
+            if _unused_space_attr in dest.attrs:
+                del dest.attrs[_unused_space_attr]
+            _repack_group(self.file, dest, compression_policy)
+            self.file.visititems(lambda name, node:
+                                 _translate_references(self.file, dest,
+                                                       name, node))
+            # The compression policy can change the chunks
+            dest.attrs[largest_chunk_attr] = largest_chunk(dest)
+
     def open_internal_file(self, path, mode='r', encoding=None, creator=None):
         # path is always relative to the root group
         if path.startswith('/'):
@@ -556,7 +1426,7 @@ class ActivePaper(object):
                     raise ValueError("%s trying to overwrite data"
                                      " created by %s"
                                      % (creator.path, owner(test)))
-                del self.file[path]
+                self.delete_item(path)
             ds = self.file.create_dataset(
                        path, shape = (0,), dtype = np.uint8,
                        chunks = (100,), maxshape = (None,))
@@ -746,12 +1616,42 @@ class InternalFile(io.IOBase):
 #
 # A wrapper for nodes that works across references
 #
+# The target of a reference is resolved only when the node is used,
+# such that traversing a reference doesn't open the referenced paper.
+#
 
 class APNode(object):
 
-    def __init__(self, h5node, name = None):
-        self._h5node = h5node
+    def __init__(self, h5node, name = None, paper_ref = None):
+        self._node = h5node
+        # For nodes in referenced papers, the paper reference and
+        # the path permit reopening the paper if it was closed.
+        self._paper_ref = paper_ref
+        self._path = h5node.name
         self.name = h5node.name if name is None else name
+        # The reference node whose target this node stands for,
+        # until the target is resolved
+        self._reference = None
+
+    @classmethod
+    def _target(cls, ref_node, name):
+        node = cls.__new__(cls)
+        node._node = None
+        node._paper_ref = None
+        node._path = None
+        node.name = name
+        node._reference = ref_node
+        return node
+
+    @property
+    def _h5node(self):
+        if self._reference is not None:
+            self._paper_ref, self._node = _follow(self._reference)
+            self._path = self._node.name
+            self._reference = None
+        elif self._paper_ref is not None and not self._node.id.valid:
+            self._node = open_paper_ref(self._paper_ref).file[self._path]
+        return self._node
 
     def is_group(self):
         return isinstance(self._h5node, h5py.Group)
@@ -781,43 +1681,251 @@ class APNode(object):
 
     def _getitem(self, item):
         node = self._h5node
+        paper_ref = self._paper_ref
         if datatype(node) == 'reference':
-            _, node = dereference(node)
+            paper_ref, node = _follow(node)
         node = node[item]
-        if datatype(node) == 'reference':
-            _, node = dereference(node)
         name = self.name
         if not name.endswith('/'): name += '/'
         name += item
-        return APNode(node, name)
+        if datatype(node) == 'reference':
+            return APNode._target(node, name)
+        return APNode(node, name, paper_ref)
 
     def __getattr__(self, attrname):
         return getattr(self._h5node, attrname)
 
     def in_paper(self, paper):
+        if self._reference is not None:
+            # The target of a reference is in another paper
+            return False
         return paper.file.id is self._h5node.file.id
 
 #
-# A global dictionary mapping paper_refs to papers.
-# Each entry disappears when no reference to the paper remains.
+# File format options for new papers
+#
+# libver='latest' selects the most recent HDF5 file format, in which
+# groups with many members use a B-tree index for their links instead
+# of a symbol table. Creation order tracking (track_order=True) adds an
+# index that permits iterating over group members in the order of their
+# creation. Paged file space allocation (page_size) groups small
+# metadata blocks into pages, and permits the use of a page buffer
+# (see activepapers.cache). It also makes the file's free space
+# persistent, so that it can be reused in later sessions.
+#
+# Papers created with these options require HDF5 1.10 or later
+# (libver='latest' makes them require the HDF5 version that
+# created them) for reading.
+#
+def file_format_options(libver=None, track_order=False, page_size=None):
+    """
+    :return: the keyword arguments to h5py.File for creating a file
+             in the given format
+    :rtype: dict
+    """
+    options = {}
+    if libver is not None:
+        options['libver'] = libver
+    if track_order:
+        options['track_order'] = True
+    if page_size is not None:
+        options['fs_strategy'] = 'page'
+        options['fs_persist'] = True
+        options['fs_page_size'] = page_size
+    return options
+
+#
+# The split layout stores the metadata of a paper in the file "x.ap"
+# and the raw data of its datasets in "x.ap-raw", using HDF5's split
+# driver. Metadata operations then read only the small metadata file,
+# which can be kept in the operating system's file cache. Papers in
+# the split layout are recognized by the presence of the raw data file.
+#
+def raw_filename(filename):
+    return filename + '-raw'
+
+def split_layout_options(filename):
+    """
+    :return: the base name of the split layout files and
+             the corresponding keyword arguments to h5py.File
+    :rtype: tuple
+    """
+    base, ext = os.path.splitext(filename)
+    return base, dict(driver='split',
+                      meta_ext=ext.encode('utf-8'),
+                      raw_ext=raw_filename(ext).encode('utf-8'))
+
+def paper_files(filename):
+    """
+    :return: the names of the existing files that make up the paper
+    :rtype: list
+    """
+    return [f for f in [filename, raw_filename(filename)]
+            if os.path.exists(f)]
+
+def paper_size(filename):
+    return sum(os.path.getsize(f) for f in paper_files(filename))
+
+#
+# In-memory papers use HDF5's core driver without backing store.
+# Each one gets a unique HDF5 file name, because HDF5 considers
+# two in-memory files with the same name as identical.
 #
-_papers = weakref.WeakValueDictionary()
+_in_memory_count = it.count()
+
+def _open_in_memory(filename, mode, image, **options):
+    name = '%s-%d' % (filename, next(_in_memory_count))
+    if mode[0] == 'w':
+        return h5py.File(name, mode, driver='core', backing_store=False,
+                         **options)
+    if image is None:
+        with open(filename, 'rb') as f:
+            image = f.read()
+    if mode not in ['r', 'r+']:
+        raise ValueError("invalid mode %s for an ActivePaper "
+                         "created from an image" % mode)
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_fapl_core(backing_store=False)
+    fapl.set_file_image(image)
+    flags = h5py.h5f.ACC_RDONLY if mode == 'r' else h5py.h5f.ACC_RDWR
+    return h5py.File(h5py.h5f.open(name.encode('utf-8'),
+                                   flags, fapl=fapl))
+
+#
+# Repacking
+#
+
+# The nominal metadata size per object used by space_usage
+_object_overhead = 1024
+
+# The attribute recording the unused space of earlier sessions
+_unused_space_attr = 'ACTIVE_PAPER_UNUSED_SPACE'
+
+def _repack_group(source, dest, compression_policy, copied=None):
+    # copied maps the ids of the objects copied so far to their copies,
+    # such that objects with several hard links are copied only once.
+    if copied is None:
+        copied = {}
+    for name in source:
+        link = source.get(name, getlink=True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            dest[name] = link
+            continue
+        node = source[name]
+        if node.id in copied:
+            dest[name] = copied[node.id]
+            continue
+        if isinstance(node, h5py.Group):
+            gcpl = node.id.get_create_plist()
+            group = dest.create_group(
+                        name, track_order=bool(gcpl.get_link_creation_order()))
+            copy_attributes(node, group)
+            _repack_group(node, group, compression_policy, copied)
+        elif compression_policy is None or node.is_virtual \
+             or not compression_policy.applies_to(node.shape, node.dtype):
+            dest.copy(node, name)
+        else:
+            options = compression_policy.options()
+            options['chunks'] = chunk_shape(node.shape, node.dtype, 'rows',
+                                            node.maxshape)
+            copy_dataset(node, dest, name, options)
+        copied[node.id] = dest[name]
+
+def _translate_references(source, dest, name, node):
+    # Make the object and region references in dest[name] point to
+    # the objects in dest that correspond to the referenced objects
+    # in source.
+    def translate_ref(ref):
+        target = source[ref]
+        if isinstance(ref, h5py.RegionReference):
+            region = h5py.h5r.get_region(ref, target.id)
+            return h5py.h5r.create(dest.id, target.name.encode('utf-8'),
+                                   h5py.h5r.DATASET_REGION, region)
+        return dest[target.name].ref
+    def translate(refs):
+        refs = np.array(refs, dtype=object)
+        flat = refs.reshape((-1,))
+        for i, ref in enumerate(flat):
+            if ref:
+                flat[i] = translate_ref(ref)
+        return refs
+    def is_ref(dtype):
+        return h5py.check_dtype(ref=dtype) in (h5py.Reference,
+                                               h5py.RegionReference)
+    if isinstance(node, h5py.Dataset) and not node.is_virtual \
+       and is_ref(node.dtype):
+        dest[name][...] = translate(node[...])
+    for attr in node.attrs:
+        dtype = node.attrs.get_id(attr).dtype
+        if is_ref(dtype):
+            dest[name].attrs.create(attr, translate(node.attrs[attr]),
+                                    dtype=dtype)
+
+def repack(filename, compression_policy=None, split=None):
+    """
+    Repack a closed paper in place (see ActivePaper.repack),
+    converting it to or from the split layout if split is
+    True or False.
+
+    :return: the file sizes in bytes before and after repacking
+    :rtype: tuple
+    """
+    old_size = paper_size(filename)
+    directory, name = os.path.split(filename)
+    # Keep the extension, which is part of the split layout file names
+    tmp_filename = os.path.join(directory, 'repack-' + name)
+    paper = ActivePaper(filename, 'r')
+    try:
+        paper.repack(tmp_filename, compression_policy, split)
+    except:
+        paper.close()
+        for f in paper_files(tmp_filename):
+            os.remove(f)
+        raise
+    paper.close()
+    new_files = paper_files(tmp_filename)
+    os.rename(new_files[0], filename)
+    if len(new_files) > 1:
+        os.rename(new_files[1], raw_filename(filename))
+    elif os.path.exists(raw_filename(filename)):
+        os.remove(raw_filename(filename))
+    return old_size, paper_size(filename)
+
+#
+# The pool of the papers opened through references
+#
+paper_pool = PaperPool(lambda filename: ActivePaper(filename, "r"))
+# Close the papers while the interpreter is still fully functional
+atexit.register(paper_pool.clear)
 
 #
 # Dereference a reference node
 #
+# The targets are cached by the paper containing the reference node.
+#
 def dereference(ref_node):
+    paper_ref, paper, node = _dereference(ref_node)
+    return paper, node
+
+def _follow(ref_node):
+    paper_ref, paper, node = _dereference(ref_node)
+    return paper_ref, node
+
+def _dereference(ref_node):
+    paper = file_registry.get(ref_node.file.id)
+    if paper is None:
+        return _resolve(ref_node)
+    return paper.reference_cache.lookup(ref_node, _resolve)
+
+def _resolve(ref_node):
     assert datatype(ref_node) == 'reference'
     paper_ref, path = ref_node[()]
-    paper = open_paper_ref(ascii(paper_ref))
-    return paper, paper.file[path]
+    paper_ref = ascii(paper_ref)
+    paper = open_paper_ref(paper_ref)
+    return paper_ref, paper, paper.file[path]
 
 #
 # Open a paper given its reference
 #
 def open_paper_ref(paper_ref):
-    if paper_ref in _papers:
-        return _papers[paper_ref]
-    paper = ActivePaper(find_in_library(paper_ref), "r")
-    _papers[paper_ref] = paper
-    return paper
+    return paper_pool.get(find_in_library(paper_ref))
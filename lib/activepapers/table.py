@@ -0,0 +1,188 @@
+# Tables: compound datasets with sorted indexes
+#
+# A table is a data item consisting of a group that contains
+#  - the dataset 'rows', with a compound dtype and an unlimited
+#    first dimension,
+#  - for each indexed field, a group index/<field> with the datasets
+#    'keys' (the values of the field in sorted order), 'rows' (the
+#    corresponding row numbers), and 'fences' (the first key stored
+#    in each chunk of 'keys').
+#
+# A lookup reads the fences, which are small, and then only the
+# chunks of 'keys' and 'rows' that can contain the requested keys,
+# followed by the matching rows. The indexes are updated by append().
+# Appending rows whose keys are not smaller than the existing ones
+# only appends to the indexes, otherwise the indexes are rewritten.
+#
+# Tables are used through DataGroup.create_table and
+# DataGroup.open_table. Dependencies are tracked for the table
+# as a whole, like for any data item.
+
+import numpy as np
+
+from activepapers.utility import stamp
+
+
+class Table(object):
+
+    def __init__(self, group):
+        """
+        :param group: the group containing the table
+        :type group: activepapers.execution.DataGroup
+        """
+        self._group = group
+        node = group._node
+        self.rows = node['rows']
+        self.dtype = self.rows.dtype
+        if 'index' in node:
+            self.indexes = [field for field in self.dtype.names
+                            if field in node['index']]
+        else:
+            self.indexes = []
+
+    @classmethod
+    def create(cls, group, dtype, index=()):
+        """
+        :param group: an empty group that becomes the table
+        :type group: activepapers.execution.DataGroup
+        :param dtype: a compound dtype
+        :param index: the names of the fields to be indexed
+        :rtype: Table
+        """
+        dtype = np.dtype(dtype)
+        if dtype.names is None:
+            raise TypeError("tables require a compound dtype")
+        group.mark_as_data_item()
+        group.create_dataset('rows', shape=(0,), dtype=dtype,
+                             maxshape=(None,), access='append')
+        for field in index:
+            key_dtype = dtype.fields[field][0]
+            if key_dtype.hasobject or key_dtype.shape:
+                raise TypeError("field %s can't be indexed" % field)
+            for name, ds_dtype in [('keys', key_dtype),
+                                   ('rows', np.int64),
+                                   ('fences', key_dtype)]:
+                group.create_dataset('index/%s/%s' % (field, name),
+                                     shape=(0,), dtype=ds_dtype,
+                                     maxshape=(None,), access='append')
+        return cls(group)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        return self.rows[item]
+
+    def _index(self, field):
+        if field is None:
+            if not self.indexes:
+                raise ValueError("table %s has no index"
+                                 % self._group._node.name)
+            field = self.indexes[0]
+        elif field not in self.indexes:
+            raise ValueError("field %s is not indexed" % field)
+        index = self._group._node['index'][field]
+        return index['keys'], index['rows'], index['fences']
+
+    def append(self, records):
+        """
+        Add one or several records at the end of the table
+        and update the indexes.
+
+        :param records: a record or an array of records
+        """
+        records = np.asarray(records, dtype=self.dtype)
+        if records.ndim == 0:
+            records = records.reshape((1,))
+        start = len(self.rows)
+        end = start + len(records)
+        self.rows.resize((end,))
+        self.rows[start:end] = records
+        for field in self.indexes:
+            self._update_index(field, records[field], start)
+        stamp(self._group._node, "data",
+              self._group._codelet.dependency_attributes())
+
+    def _update_index(self, field, new_keys, start):
+        keys, rows, fences = self._index(field)
+        new_rows = np.arange(start, start+len(new_keys), dtype=np.int64)
+        # A stable sort keeps equal keys in the order of their rows
+        order = np.argsort(new_keys, kind='mergesort')
+        new_keys = new_keys[order]
+        new_rows = new_rows[order]
+        n = len(keys)
+        if n > 0 and new_keys[0] < keys[n-1]:
+            # Merge with the existing index and rewrite it
+            old_keys = keys[...]
+            positions = np.searchsorted(old_keys, new_keys, side='right')
+            new_keys = np.insert(old_keys, positions, new_keys)
+            new_rows = np.insert(rows[...], positions, new_rows)
+            n = 0
+        end = n + len(new_keys)
+        keys.resize((end,))
+        keys[n:end] = new_keys
+        rows.resize((end,))
+        rows[n:end] = new_rows
+        # The fences of the chunks that start at or after n
+        chunk = keys.chunks[0]
+        first = -(-n // chunk)
+        positions = np.arange(first*chunk, end, chunk)
+        fences.resize((first+len(positions),))
+        fences[first:] = new_keys[positions-n]
+
+    def _positions(self, field, lo, hi, hi_side):
+        # The keys and row numbers of the index entries with
+        # lo <= key < hi (hi_side='left') or lo <= key <= hi
+        # (hi_side='right'), reading only the chunks of the index
+        # that can contain them.
+        keys, rows, fences = self._index(field)
+        if len(keys) == 0:
+            return np.zeros((0,), keys.dtype), np.zeros((0,), np.int64)
+        chunk = keys.chunks[0]
+        fence_values = fences[...]
+        first = max(0, np.searchsorted(fence_values, lo, side='left') - 1)
+        last = np.searchsorted(fence_values, hi, side=hi_side)
+        block = slice(first*chunk, min(len(keys), last*chunk))
+        block_keys = keys[block]
+        i = np.searchsorted(block_keys, lo, side='left')
+        j = np.searchsorted(block_keys, hi, side=hi_side)
+        return block_keys[i:j], rows[block][i:j]
+
+    def _read_rows(self, row_numbers):
+        # Read rows in the given order. Each row number occurs
+        # only once in an index.
+        if len(row_numbers) == 0:
+            return np.zeros((0,), self.dtype)
+        order = np.argsort(row_numbers)
+        sorted_rows = row_numbers[order]
+        lo, hi = sorted_rows[0], sorted_rows[-1]+1
+        if 4*len(sorted_rows) >= hi-lo:
+            # Dense enough for reading a single block
+            data = self.rows[lo:hi][sorted_rows-lo]
+        else:
+            data = self.rows[sorted_rows]
+        result = np.empty_like(data)
+        result[order] = data
+        return result
+
+    def lookup(self, key, field=None):
+        """
+        :param key: a key value
+        :param field: the indexed field (default: the first index)
+        :return: the records whose field equals key, in the order
+                 in which they were added
+        :rtype: numpy.ndarray
+        """
+        keys, row_numbers = self._positions(field, key, key, 'right')
+        return self._read_rows(row_numbers)
+
+    def range(self, lo, hi, field=None):
+        """
+        :param lo: the lower bound (inclusive)
+        :param hi: the upper bound (exclusive)
+        :param field: the indexed field (default: the first index)
+        :return: the records with lo <= field < hi, sorted by field
+        :rtype: numpy.ndarray
+        """
+        keys, row_numbers = self._positions(field, lo, hi, 'left')
+        return self._read_rows(row_numbers)
@@ -0,0 +1,344 @@
+# Full-text index of the code and documentation of an ActivePaper
+#
+# The text index is part of the optional catalog (see
+# activepapers.catalog) and stored in the group "catalog/text". It is
+# an inverted index that maps each word (a sequence of letters, digits,
+# and underscores, converted to lower case) occurring in a text item
+# in /code or /documentation to the item and line numbers where the
+# word occurs:
+#  - 'items': the paths of the indexed items
+#  - 'words': all words in sorted order
+#  - 'offsets': the postings of words[i] are postings[offsets[i]:
+#               offsets[i+1]]
+#  - 'postings': (item number, line number) pairs
+#
+# A search for a string looks up the words it contains in the sorted
+# list of words, and then checks only the candidate lines of the
+# candidate items. All words of the string except the first one start
+# at a word boundary, so they are found by binary search, as complete
+# words or, for the last one, as prefixes. The first word can be the
+# end of a longer word and is used for the lookup only if it is the
+# only word in the string. Searching a paper opened for reading reads
+# only the words, the offsets, and the postings of the matching words.
+#
+# The catalog reports every change to a text item (when it is stamped
+# or deleted). The index records the paths of the changed items and
+# indexes them again only before a search and when the catalog is
+# saved, such that an item written in many small steps (for example
+# through InternalFile, which stamps the item after each write) is
+# indexed only once.
+
+import re
+
+import numpy as np
+import h5py
+
+from activepapers.utility import utf8, h5vstring, datatype
+
+sections = ['/code', '/documentation']
+
+word_pattern = re.compile(r'\w+', re.UNICODE)
+
+posting_dtype = np.dtype([('item', np.int32), ('line', np.int32)])
+
+
+def item_text(node):
+    """
+    :param node: an item in a paper
+    :return: the text of a code item or of a text file, or None
+             for other items and for binary files
+    :rtype: str
+    """
+    if not isinstance(node, h5py.Dataset) \
+       or node.attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False):
+        return None
+    dt = datatype(node)
+    if dt in ['calclet', 'importlet', 'module']:
+        data = node[()]
+    elif dt in ['file', 'text'] and node.dtype == np.uint8 \
+         and node.ndim == 1:
+        data = node[...].tobytes()
+    else:
+        return None
+    if isinstance(data, bytes):
+        if b'\0' in data:
+            return None
+        data = data.decode('utf-8', 'replace')
+    return data
+
+
+def _text_nodes(node):
+    # The node and all datasets inside it, if it is a group
+    if isinstance(node, h5py.Group):
+        nodes = []
+        node.visititems(lambda name, item: nodes.append(item))
+        return nodes
+    return [node]
+
+
+def text_items(h5file):
+    """
+    Generator yielding (path, text) for all text items in the
+    code and documentation sections of the paper stored in h5file.
+    """
+    for section in sections:
+        for node in _text_nodes(h5file[section]):
+            text = item_text(node)
+            if text is not None:
+                yield utf8(node.name), text
+
+
+def index_text(text):
+    """
+    :return: a dictionary mapping the words in text to the
+             numbers of the lines in which they occur
+    :rtype: dict
+    """
+    words = {}
+    for number, line in enumerate(text.splitlines(), 1):
+        for word in set(word_pattern.findall(line.lower())):
+            words.setdefault(word, []).append(number)
+    return words
+
+
+def _matching_lines(path, text, string, ignore_case, numbers=None):
+    # Generator yielding (path, line number, line) for the lines
+    # containing string, considering only the given line numbers
+    # if numbers is not None.
+    lines = text.splitlines()
+    if numbers is None:
+        numbers = range(1, len(lines)+1)
+    if ignore_case:
+        string = string.lower()
+    for number in numbers:
+        line = lines[number-1]
+        if string in (line.lower() if ignore_case else line):
+            yield path, number, line
+
+
+def search(h5file, string, ignore_case=False):
+    """
+    Search the text items of a paper without using an index.
+
+    :return: an iterator over (path, line number, line) for all
+             lines containing string
+    :rtype: iterator
+    """
+    for path, text in text_items(h5file):
+        for match in _matching_lines(path, text, string, ignore_case):
+            yield match
+
+
+def _next_string(prefix):
+    # The smallest string greater than all strings starting with prefix
+    return prefix[:-1] + u'%c' % (ord(prefix[-1])+1)
+
+
+class TextIndex(object):
+
+    def __init__(self, h5file):
+        self.file = h5file
+        # The indexed words of each item, loaded by _load()
+        self._items = None
+        # The paths of the items changed since they were indexed
+        self._dirty = set()
+        # (paths, words, offsets, postings) used for searching,
+        # see _arrays()
+        self._search_arrays = None
+        self._modified = False
+
+    def _load(self):
+        if self._items is not None:
+            return
+        if 'text' in self.file['catalog']:
+            self._items = self._read()
+        else:
+            # Catalog created before the text index was added
+            self.rebuild()
+
+    def _read(self):
+        paths, words, offsets, postings = self._stored_arrays()
+        postings = postings[...]
+        items = dict((path, {}) for path in paths)
+        for i, word in enumerate(words):
+            for item, line in postings[offsets[i]:offsets[i+1]]:
+                items[paths[item]].setdefault(word, []).append(int(line))
+        return items
+
+    def _stored_arrays(self):
+        group = self.file['catalog/text']
+        paths = [utf8(path) for path in group['items'][...]]
+        words = np.array([utf8(word) for word in group['words'][...]],
+                         dtype='U')
+        return paths, words, group['offsets'][...], group['postings']
+
+    def _make_arrays(self):
+        paths = sorted(self._items)
+        numbers = dict((path, i) for i, path in enumerate(paths))
+        postings = {}
+        for path in paths:
+            for word, lines in self._items[path].items():
+                postings.setdefault(word, []).extend((numbers[path], line)
+                                                     for line in lines)
+        words = sorted(postings)
+        offsets = np.zeros((len(words)+1,), np.int64)
+        offsets[1:] = np.cumsum([len(postings[word]) for word in words])
+        table = np.array([p for word in words for p in postings[word]],
+                         dtype=posting_dtype)
+        return paths, np.array(words, dtype='U'), offsets, table
+
+    def _arrays(self):
+        # The index as sorted arrays, computed from the loaded index
+        # or read from the file. The postings are read from the file
+        # only for the words that are looked up.
+        self._index_changes()
+        if self._search_arrays is None:
+            if self._items is not None:
+                self._search_arrays = self._make_arrays()
+            elif 'text' in self.file['catalog']:
+                self._search_arrays = self._stored_arrays()
+            else:
+                self._load()
+                self._search_arrays = self._make_arrays()
+        return self._search_arrays
+
+    def _index_changes(self):
+        if not self._dirty:
+            return
+        self._load()
+        for path in self._dirty:
+            prefix = path + '/'
+            for item in [p for p in self._items
+                         if p == path or p.startswith(prefix)]:
+                del self._items[item]
+            node = self.file.get(path)
+            if node is None:
+                continue
+            for node in _text_nodes(node):
+                text = item_text(node)
+                if text is not None:
+                    self._items[utf8(node.name)] = index_text(text)
+        self._dirty.clear()
+        self._search_arrays = None
+
+    def save(self):
+        """
+        Write the index to the HDF5 file, if it has been modified.
+        """
+        if not self._modified:
+            return
+        self._index_changes()
+        paths, words, offsets, table = self._arrays()
+        group = self.file.require_group('catalog/text')
+        for name, data, dtype in [('items', paths, h5vstring),
+                                  ('words', list(words), h5vstring),
+                                  ('offsets', offsets, np.int64),
+                                  ('postings', table, posting_dtype)]:
+            if name not in group:
+                group.create_dataset(name, shape=(0,), dtype=dtype,
+                                     maxshape=(None,), chunks=(1024,))
+            ds = group[name]
+            ds.resize((len(data),))
+            if len(data) > 0:
+                ds[...] = data
+        self._modified = False
+
+    def rebuild(self):
+        """
+        Rebuild the index from the contents of the paper.
+        """
+        self._items = dict((path, index_text(text))
+                           for path, text in text_items(self.file))
+        self._dirty.clear()
+        self._search_arrays = None
+        self._modified = True
+
+    def update(self, node):
+        """
+        Record a change to node, which is indexed again before
+        the next search or when the index is saved.
+        """
+        self._dirty.add(utf8(node.name))
+        self._modified = True
+
+    def remove(self, path):
+        """
+        Record the deletion of the node at path.
+        """
+        self._dirty.add(path)
+        self._modified = True
+
+    def _word_range(self, words, token, exact):
+        # The indices of the words equal to token (exact=True)
+        # or starting with token, which are consecutive.
+        start = np.searchsorted(words, token, side='left')
+        if exact:
+            end = np.searchsorted(words, token, side='right')
+        else:
+            end = np.searchsorted(words, _next_string(token), side='left')
+        return np.arange(start, end)
+
+    def _lookup(self, token, first, last):
+        # The lines containing token as a word (first=last=False),
+        # at the start of a word (last=True), at the end of a word
+        # (first=True), or anywhere in a word (first=last=True), as
+        # an array of item and line numbers combined into integers.
+        paths, words, offsets, postings = self._arrays()
+        if first:
+            if last:
+                match = np.char.find(words, token) >= 0
+            else:
+                match = np.char.endswith(words, token)
+            indices = np.flatnonzero(match)
+        else:
+            indices = self._word_range(words, token, exact=not last)
+        if len(indices) == 0:
+            return np.zeros((0,), np.int64)
+        # Read the postings of all matching words at once
+        start, end = indices[0], indices[-1]+1
+        block = postings[offsets[start]:offsets[end]]
+        counts = np.diff(offsets[start:end+1])
+        if len(indices) < end-start:
+            word = np.repeat(np.arange(start, end), counts)
+            block = block[np.isin(word, indices)]
+        keys = (block['item'].astype(np.int64) << 32) \
+               | block['line'].astype(np.int64)
+        return np.unique(keys)
+
+    def search(self, string, ignore_case=False):
+        """
+        :param string: the text to search for, which must not extend
+                       over several lines
+        :param ignore_case: if True, ignore the difference between
+                            upper and lower case
+        :return: an iterator over (path, line number, line) for all
+                 lines containing string, sorted by path and line number
+        :rtype: iterator
+        """
+        paths, words, offsets, postings = self._arrays()
+        tokens = list(word_pattern.finditer(string))
+        keys = None
+        for i, match in enumerate(tokens):
+            first = i == 0 and match.start() == 0
+            if first and len(tokens) > 1:
+                # The end of a word, found by the other words
+                continue
+            found = self._lookup(match.group().lower(), first,
+                                 match.end() == len(string))
+            keys = found if keys is None else np.intersect1d(keys, found)
+        if keys is None:
+            # No words in string, all lines are candidates
+            candidates = [(path, None) for path in paths]
+        else:
+            items = keys >> 32
+            lines = keys & 0xffffffff
+            candidates = [(paths[item], lines[items == item])
+                          for item in np.unique(items)]
+        # The decoded texts of the items, read once per search
+        texts = {}
+        for path, numbers in candidates:
+            if path not in texts:
+                texts[path] = item_text(self.file[path])
+            for match in _matching_lines(path, texts[path], string,
+                                         ignore_case, numbers):
+                yield match
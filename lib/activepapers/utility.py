@@ -1,5 +1,6 @@
 import sys
 import time
+import weakref
 
 # Python 2/3 compatibility issues
 if sys.version_info[0] == 2:
@@ -10,6 +11,13 @@ else:
 
     from activepapers.utility3 import *
 
+#
+# A registry of the open papers, indexed by the id of their HDF5 file.
+# It permits the notification of a paper when one of its items is
+# modified, which is needed for maintaining the optional catalog.
+#
+file_registry = weakref.WeakValueDictionary()
+
 # Various small functions
 
 def datatype(node):
@@ -36,12 +44,39 @@ def mod_time(node):
 def ms_since_epoch():
     return np.int64(1000.*time.time())
 
+def set_attribute(node, name, value, dtype=None):
+    """
+    Set an attribute of node. An existing attribute of the same shape
+    is overwritten in place, which is the only modification HDF5
+    permits for objects opened after switching a file to SWMR mode.
+    Other changes in SWMR mode are made when the paper is closed
+    (see ActivePaper.close).
+    """
+    if name in node.attrs:
+        attr = node.attrs.get_id(name)
+        # Fixed-length strings would be truncated
+        if attr.dtype.kind not in 'SU':
+            value_array = np.asarray(value, dtype=attr.dtype)
+            if value_array.shape == attr.shape:
+                attr.write(np.ascontiguousarray(value_array))
+                return
+    if node.file.swmr_mode:
+        paper = file_registry.get(node.file.id)
+        if paper is not None:
+            paper.deferred_attributes.append((node.name, name,
+                                              value, dtype))
+            return
+    node.attrs.create(name, value, dtype=dtype)
+
 def timestamp(node, time=None):
     if time is None:
         time = ms_since_epoch()
     else:
         time *= 1000.
-    node.attrs['ACTIVE_PAPER_TIMESTAMP'] = time
+    set_attribute(node, 'ACTIVE_PAPER_TIMESTAMP', time)
+    paper = file_registry.get(node.file.id)
+    if paper is not None:
+        paper.node_changed(node)
 
 def stamp(node, ap_type, attributes):
     allowed_transformations = {'group': 'data',
@@ -55,20 +90,20 @@ def stamp(node, ap_type, attributes):
         if isstring(value):
             previous = node.attrs.get(key, None)
             if previous is None:
-                node.attrs[key] = value
+                set_attribute(node, key, value)
             else:
                 if previous != value:
                     # String attributes can't change when re-stamping...
                     if key == 'ACTIVE_PAPER_DATATYPE' \
                        and allowed_transformations.get(previous) == value:
                         # ...with a few exceptions
-                        node.attrs[key] = value
+                        set_attribute(node, key, value)
                     else:
                         raise ValueError("%s: %s != %s"
                                          % (key, value, previous))
         elif key == 'ACTIVE_PAPER_DEPENDENCIES':
-            node.attrs.create(key, np.array(value, dtype=object),
-                              shape = (len(value),), dtype=h5vstring)
+            set_attribute(node, key, np.array(value, dtype=object),
+                          dtype=h5vstring)
         else:
             raise ValueError("unexpected key %s" % key)
     timestamp(node)
@@ -142,6 +142,9 @@ def check_paper(filename, ref_items, ref_deps, ref_hierarchy):
     hierarchy = [sorted([ascii(item.name) for item in items])
                  for items in paper.dependency_hierarchy()]
     assert hierarchy == ref_hierarchy
+    hierarchy = [sorted(ascii(name) for name in names)
+                 for names in paper.dependency_hierarchy(nodes=False)]
+    assert hierarchy == ref_hierarchy
     calclets = paper.calclets()
     assert len(calclets) == 1
     assert ascii(calclets['/code/calc_sine'].path) == '/code/calc_sine'
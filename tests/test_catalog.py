@@ -0,0 +1,243 @@
+# Test the catalog of items
+
+import os
+
+import numpy as np
+import h5py
+import tempdir
+
+from activepapers.storage import ActivePaper
+from activepapers.catalog import walk, scan
+from activepapers.depgraph import levels
+
+
+def make_paper_with_catalog(filename):
+    paper = ActivePaper(filename, "w", catalog=True)
+    paper.data.create_dataset("frequency", data=0.2)
+    paper.data.create_dataset("time", data=0.1*np.arange(100))
+    script = paper.create_calclet("calc",
+"""
+from activepapers.contents import data, open_documentation
+import numpy as np
+
+frequency = data['frequency'][...]
+time = data['time'][...]
+angular = data.create_group('angular')
+angular.create_dataset("sine", data=np.sin(2.*np.pi*frequency*time))
+item = data.create_group('item')
+item.mark_as_data_item()
+item['cosine'] = np.cos(2.*np.pi*frequency*time)
+with open_documentation('notes.txt', 'w') as f:
+    f.write('Some notes\\n')
+""")
+    script.run()
+    paper.close()
+
+
+def test_catalog_maintenance():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        make_paper_with_catalog(filename)
+        h5file = h5py.File(filename, 'r')
+        assert 'catalog/items' in h5file
+        h5file.close()
+        paper = ActivePaper(filename, 'r+')
+        assert paper.catalog is not None
+        assert paper.catalog.verify() == []
+        items = sorted(item.name for item in paper.iter_items())
+        assert items == ['/code/calc', '/data/angular/sine',
+                         '/data/frequency', '/data/item', '/data/time',
+                         '/documentation/notes.txt']
+        groups = [group.name for group in paper.iter_groups()]
+        assert groups == ['/data/angular']
+        paper.replace_by_dummy('/data/angular/sine')
+        paper.run_codelet('calc')
+        assert paper.catalog.verify() == []
+        paper.delete_item('/data/time')
+        assert '/data/time' not in paper.catalog
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert paper.catalog.verify() == []
+        selected = paper.catalog.select(owner='/code/calc')
+        assert list(selected['path']) == ['/data/angular/sine',
+                                          '/data/item',
+                                          '/documentation/notes.txt']
+        assert list(paper.catalog.select(datatype='calclet')['path']) \
+            == ['/code/calc']
+        entry = paper.catalog['/data/item']
+        assert entry.is_item
+        assert entry.timestamp > 0
+        paper.close()
+
+
+def test_catalog_rebuild():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, "w")
+        paper.data.create_dataset("frequency", data=0.2)
+        paper.close()
+        paper = ActivePaper(filename, "r+")
+        assert paper.catalog is None
+        paper.rebuild_catalog()
+        paper.close()
+        paper = ActivePaper(filename, "r")
+        assert [e.path for e in walk(paper.file)] == ['/data/frequency']
+        assert len(paper.catalog) == 1
+        assert paper.catalog.verify() == []
+        paper.close()
+
+
+def test_dependency_graph():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        make_paper_with_catalog(filename)
+        paper = ActivePaper(filename, 'r+')
+        graph = paper.catalog.graph
+        assert graph.dependencies('/data/item') \
+            == ('/code/calc', '/data/frequency', '/data/time')
+        paths, ids, indptr, indices = graph.csr()
+        assert len(indptr) == len(paths) + 1
+        h5file = paper.file
+        assert list(h5file['catalog/dependencies/indptr'][...]) \
+            == list(indptr)
+        # Compare to the graph obtained by walking through the paper
+        catalog = paper.catalog
+        paper.catalog = None
+        walked = paper.dependency_graph()
+        assert paper.dependents(['/data/time']) \
+            == set(['/data/angular', '/data/angular/sine', '/data/item',
+                    '/documentation/notes.txt'])
+        paper.catalog = catalog
+        assert paper.dependency_graph() == walked
+        assert paper.dependents(['/data/time']) \
+            == set(['/data/angular', '/data/angular/sine', '/data/item',
+                    '/documentation/notes.txt'])
+        assert paper.stale_items() == set()
+        del paper.data['time']
+        paper.data['time'] = 0.2*np.arange(100)
+        assert paper.stale_items() == set(['/data/angular',
+                                           '/data/angular/sine',
+                                           '/data/item',
+                                           '/documentation/notes.txt'])
+        assert paper.is_stale(paper.file['/data/item'])
+        paper.close()
+
+
+def test_levels():
+    deps = {'/a': [], '/b': ['/a'], '/c': ['/a', '/b'], '/d': ['/c'],
+            '/e': []}
+    assert list(levels(deps)) == [set(['/a', '/e']), set(['/b']),
+                                  set(['/c']), set(['/d'])]
+    deps['/a'] = ['/d']
+    try:
+        list(levels(deps))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_query():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        make_paper_with_catalog(filename)
+        # The same paper without a catalog
+        filename2 = os.path.join(t, "paper2.ap")
+        with h5py.File(filename, 'r') as source, \
+             h5py.File(filename2, 'w') as dest:
+            for name in source:
+                if name != 'catalog':
+                    source.copy(source[name], dest, name)
+            for attr in source.attrs:
+                dest.attrs[attr] = source.attrs[attr]
+        assert sorted(e.path for e in scan(h5py.File(filename2, 'r'))) \
+               == sorted(e.path for e in walk(h5py.File(filename2, 'r')))
+        for fn in [filename, filename2]:
+            paper = ActivePaper(fn, 'r')
+            def paths(**criteria):
+                return sorted(e.path for e in paper.query(**criteria))
+            assert paths(owner='/code/calc', datatype='data') \
+                   == ['/data/angular/sine', '/data/item']
+            assert paths(patterns=['data/*'], min_size=800) \
+                   == ['/data/angular/sine', '/data/item', '/data/time']
+            assert paths(max_size=8, datatype='data') == ['/data/frequency']
+            assert paths(items=False) == ['/data/angular']
+            assert paths(before=0.) == []
+            assert len(paths(after=0.)) == 6
+            assert paths(dummy=True) == []
+            paper.close()
+
+
+def test_select_changes():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        make_paper_with_catalog(filename)
+        paper = ActivePaper(filename, 'r+')
+        catalog = paper.catalog
+        def paths(**criteria):
+            return list(catalog.select(**criteria)['path'])
+        # Changes that have not been saved yet
+        paper.data.create_dataset("amplitude", data=2.)
+        paper.delete_item('/data/time')
+        paper.replace_by_dummy('/data/angular/sine')
+        assert len(catalog) == len(catalog.table())
+        assert paths(patterns=['data/*']) \
+               == ['/data/amplitude', '/data/angular/sine',
+                   '/data/frequency', '/data/item']
+        assert paths(patterns=['data/a*e']) \
+               == ['/data/amplitude', '/data/angular/sine']
+        assert paths(patterns=['*/i?em', 'code/*']) \
+               == ['/code/calc', '/data/item']
+        assert paths(dummy=True) == ['/data/angular/sine']
+        assert '/data/time' not in catalog
+        assert catalog['/data/amplitude'].size == 8
+        paper.delete_item('/data/angular')
+        assert paths(patterns=['data/an*'], items=None) == []
+        assert catalog.verify() == []
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert paper.catalog.verify() == []
+        assert list(paper.catalog.select(patterns=['data/*'])['path']) \
+               == ['/data/amplitude', '/data/frequency', '/data/item']
+        paper.close()
+
+
+def test_text_search():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        make_paper_with_catalog(filename)
+        paper = ActivePaper(filename, 'r+')
+        assert 'catalog/text/words' in paper.file
+        assert list(paper.search_text('open_doc')) \
+            == [('/code/calc', 2,
+                 'from activepapers.contents import data, '
+                 'open_documentation'),
+                ('/code/calc', 12,
+                 "with open_documentation('notes.txt', 'w') as f:")]
+        assert [m[:2] for m in paper.search_text('Some notes')] \
+            == [('/code/calc', 13), ('/documentation/notes.txt', 1)]
+        assert list(paper.search_text('some NOTES')) == []
+        assert [m[:2] for m in paper.search_text('some NOTES',
+                                                 ignore_case=True)] \
+            == [('/code/calc', 13), ('/documentation/notes.txt', 1)]
+        assert [m[:2] for m in paper.search_text('*np.pi*')] \
+            == [('/code/calc', 8), ('/code/calc', 11)]
+        paper.add_module('tools', "def helper():\n    return 42\n")
+        assert [m[:2] for m in paper.search_text('helper')] \
+            == [('/code/python-packages/tools', 1)]
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert [m[:2] for m in paper.search_text('return 42')] \
+            == [('/code/python-packages/tools', 2)]
+        # Without the index
+        catalog = paper.catalog
+        paper.catalog = None
+        for string in ['data', 'np.', ' = ', 'return 42', 'pen_doc',
+                       'en_documentation(', 'ta[\'time', 'ume', 'NP.SIN']:
+            assert list(paper.search_text(string)) \
+                == list(catalog.text.search(string))
+        paper.catalog = catalog
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        paper.delete_item('/code/python-packages/tools')
+        assert list(paper.search_text('helper')) == []
+        paper.close()
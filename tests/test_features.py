@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import os
+import time
 import numpy as np
 import h5py
 import tempdir
@@ -365,6 +366,42 @@ angular.create_dataset("tangent", data=np.tan(2.*np.pi*frequency*time))
             time_ref = root['/data/angular'].attrs['time']
             assert root[time_ref].name == '/data/time'
 
+def test_incremental_snapshots():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        snapshot = os.path.join(t, "snapshot.ap")
+        progress = os.path.join(t, "progress.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data.create_dataset("frequency", data = 0.2)
+        paper.data.create_dataset("time", data=0.1*np.arange(100))
+        # Make sure the snapshot is more recent than the datasets
+        time.sleep(0.01)
+        paper.snapshot(snapshot, incremental=True)
+        paper.snapshot(progress, progress_only=True, incremental=True)
+        h5file = h5py.File(snapshot, 'r')
+        address = h5py.h5o.get_info(h5file['/data/time'].id).addr
+        h5file.close()
+        del paper.data['frequency']
+        paper.data.create_dataset("sine", data=np.sin(0.1*np.arange(100)))
+        paper.snapshot(snapshot, incremental=True)
+        paper.snapshot(progress, progress_only=True, incremental=True)
+        paper.close()
+        ActivePaper(snapshot, 'r').close()
+        ActivePaper(progress, 'r').close()
+        h5file = h5py.File(snapshot, 'r')
+        assert '/data/frequency' not in h5file
+        assert (h5file['/data/sine'][...] == np.sin(0.1*np.arange(100))).all()
+        # The unmodified dataset has not been copied again
+        assert h5py.h5o.get_info(h5file['/data/time'].id).addr == address
+        h5file.close()
+        h5file = h5py.File(progress, 'r')
+        assert '/data/frequency' not in h5file
+        sine = h5file['/data/sine']
+        assert sine.shape == ()
+        assert sine.attrs['ACTIVE_PAPER_DUMMY_DATASET']
+        assert tuple(sine.attrs['ACTIVE_PAPER_SHAPE']) == (100,)
+        h5file.close()
+
 def test_modified_scripts():
     with tempdir.TempDir() as t:
         filename = os.path.join(t, "paper.ap")
@@ -428,3 +465,582 @@ angular.create_dataset("sine", data=np.sin(2.*np.pi*frequency*time))
             passed = False
         assert not passed
         paper.close()
+
+def test_swmr():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', swmr=True)
+        paper.close()
+        writer = ActivePaper(filename, 'r+', swmr=True)
+        script = writer.create_calclet("grow",
+"""
+from activepapers.contents import data, start_swmr
+ds = data.create_dataset('numbers', shape=(0,), dtype=int,
+                         maxshape=(None,), chunks=(10,))
+start_swmr()
+ds.resize((10,))
+ds[:] = range(10)
+data.flush()
+""")
+        script.run()
+        reader = ActivePaper(filename, 'r', swmr=True)
+        numbers = reader.data['numbers']
+        assert numbers.shape == (10,)
+        writer.data['numbers'].resize((20,))
+        writer.flush()
+        numbers.refresh()
+        assert numbers.shape == (20,)
+        reader.close()
+        writer.close()
+
+def test_swmr_new_handles():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', swmr=True, catalog=True)
+        paper.data['offset'] = 100
+        paper.close()
+        writer = ActivePaper(filename, 'r+', swmr=True)
+        script = writer.create_calclet("grow",
+"""
+from activepapers.contents import data, start_swmr
+import numpy as np
+ds = data.create_dataset('numbers', shape=(0,), dtype=int,
+                         maxshape=(None,), chunks=(10,))
+start_swmr()
+ds.resize((10,))
+ds[:] = range(10)
+numbers = data['numbers']
+numbers.resize((20,))
+# Changes the dependencies of the dataset
+numbers[10:] = data['offset'][...] + np.arange(10)
+data.flush()
+""")
+        assert script.run() is None
+        reader = ActivePaper(filename, 'r', swmr=True)
+        numbers = reader.data['numbers']
+        assert numbers.shape == (20,)
+        assert numbers[19] == 109
+        reader.close()
+        writer.close()
+        paper = ActivePaper(filename, 'r')
+        assert paper.catalog.verify() == []
+        deps = paper.data_group['numbers'].attrs['ACTIVE_PAPER_DEPENDENCIES']
+        assert '/data/offset' in [ascii(d) for d in deps]
+        paper.close()
+
+def test_compression_policy():
+    from activepapers.layout import CompressionPolicy
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.set_compression_policy(CompressionPolicy('gzip', 1, True,
+                                                       min_size=1000))
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        assert paper.compression_policy.compression_opts == 1
+        paper.data.create_dataset('large', data=np.arange(1000))
+        paper.data['large_too'] = np.arange(1000)
+        paper.data['small'] = np.arange(10)
+        paper.data.create_dataset('explicit', data=np.arange(1000),
+                                  compression='lzf')
+        paper.data.create_dataset('text', data=1000*'x')
+        for name in ['large', 'large_too']:
+            ds = paper.data_group[name]
+            assert ds.compression == 'gzip'
+            assert ds.shuffle
+            assert (ds[...] == np.arange(1000)).all()
+        assert paper.data_group['small'].compression is None
+        assert paper.data_group['explicit'].compression == 'lzf'
+        assert not paper.data_group['explicit'].shuffle
+        assert paper.data_group['text'].compression is None
+        paper.close()
+
+def test_chunk_shapes():
+    from activepapers.layout import chunk_shape
+    assert chunk_shape((1000, 1000), np.float64, 'rows') == (65, 1000)
+    assert chunk_shape((1000, 1000), np.float64, 'columns') == (1000, 65)
+    assert chunk_shape((0, 10), np.float64, 'append',
+                       maxshape=(None, 10)) == (6553, 10)
+    assert chunk_shape((), np.float64, 'rows') is None
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        ds = paper.data.create_dataset('growing', shape=(0, 10),
+                                       dtype=np.float64,
+                                       maxshape=(None, 10))
+        assert ds._node.chunks == (6553, 10)
+        ds = paper.data.create_dataset('matrix', shape=(1000, 1000),
+                                       dtype=np.float64, access='columns')
+        assert ds._node.chunks == (1000, 65)
+        data = np.arange(100000.).reshape((1000, 100))
+        paper.data.create_dataset('rechunked', data=data,
+                                  chunks=(1, 1), compression='gzip')
+        before = paper.data_group['rechunked'].attrs['ACTIVE_PAPER_TIMESTAMP']
+        paper.rechunk('/data/rechunked', access='columns')
+        ds = paper.data_group['rechunked']
+        assert ds.chunks == (1000, 65)
+        assert ds.compression == 'gzip'
+        assert (ds[...] == data).all()
+        assert ds.attrs['ACTIVE_PAPER_TIMESTAMP'] == before
+        assert ascii(ds.attrs['ACTIVE_PAPER_DATATYPE']) == 'data'
+        paper.close()
+
+def test_deduplication():
+    from activepapers.contentstore import ContentStore
+    with tempdir.TempDir() as t:
+        store = ContentStore(os.path.join(t, "store"))
+        data = np.arange(100000)
+        for name in ["paper1.ap", "paper2.ap"]:
+            paper = ActivePaper(os.path.join(t, name), 'w')
+            paper.data.create_dataset('large', data=data, compression='gzip')
+            paper.data['small'] = np.arange(10)
+            paper.close()
+        for name in ["paper1.ap", "paper2.ap"]:
+            paper = ActivePaper(os.path.join(t, name), 'r+')
+            moved = paper.deduplicate(store, min_size=1000)
+            assert [path for path, h in moved] == ['/data/large']
+            paper.close()
+        assert len(store.hashes()) == 1
+        paper = ActivePaper(os.path.join(t, "paper1.ap"), 'r+')
+        ds = paper.data_group['large']
+        assert ds.is_virtual
+        assert (ds[...] == data).all()
+        assert ascii(ds.attrs['ACTIVE_PAPER_DATATYPE']) == 'data'
+        assert paper.inline_shared() == ['/data/large']
+        ds = paper.data_group['large']
+        assert not ds.is_virtual
+        assert ds.compression == 'gzip'
+        assert (ds[...] == data).all()
+        assert 'ACTIVE_PAPER_CONTENT_HASH' not in ds.attrs
+        paper.close()
+        # Writing to a shared dataset doesn't modify the store
+        paper = ActivePaper(os.path.join(t, "paper2.ap"), 'r+')
+        paper.data['large'][0] = -999
+        ds = paper.data_group['large']
+        assert not ds.is_virtual
+        assert ds[0] == -999
+        paper.close()
+        paper = ActivePaper(os.path.join(t, "paper1.ap"), 'r+')
+        paper.deduplicate(store, min_size=1000)
+        assert paper.data_group['large'][0] == 0
+        paper.close()
+        # Neither does write_direct
+        stored = [open(store.filename(h), 'rb').read()
+                  for h in store.hashes()]
+        paper = ActivePaper(os.path.join(t, "paper1.ap"), 'r+')
+        paper.data['large'].write_direct(np.array([-1, -2]),
+                                         np.s_[0:2], np.s_[10:12])
+        ds = paper.data_group['large']
+        assert not ds.is_virtual
+        assert list(ds[9:13]) == [9, -1, -2, 12]
+        assert [open(store.filename(h), 'rb').read()
+                for h in store.hashes()] == stored
+        # Resizable datasets and internal files are not shared
+        paper.data.create_dataset('growing', data=data, maxshape=(None,))
+        with paper.open_internal_file('data/file.bin', 'wb') as f:
+            f.write(np.arange(10000).tobytes())
+        moved = paper.deduplicate(store, min_size=1000)
+        assert [path for path, h in moved] == ['/data/large']
+        paper.close()
+
+def test_repack():
+    from activepapers.storage import repack
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        for i in range(5):
+            paper.data['large%d' % i] = np.arange(100000)
+        paper.data['kept'] = np.arange(100)
+        target = paper.data_group['kept']
+        ref_dtype = h5py.special_dtype(ref=h5py.Reference)
+        paper.data_group.create_dataset('ref', data=target.ref,
+                                        dtype=ref_dtype)
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        for i in range(5):
+            paper.delete_item('/data/large%d' % i)
+        size, live = paper.space_usage()
+        assert size - live > 3000000
+        paper.close()
+        old_size, new_size = repack(filename)
+        assert old_size - new_size > 3000000
+        paper = ActivePaper(filename, 'r')
+        assert len(paper.history) == 2
+        ref = paper.data_group['ref'][()]
+        assert paper.file[ref].name == '/data/kept'
+        assert (paper.file[ref][...] == np.arange(100)).all()
+        paper.close()
+        # The estimate of unused space is kept across sessions
+        paper = ActivePaper(filename, 'r+')
+        paper.set_repack_threshold(0.5)
+        paper.data['large'] = np.arange(1000000)
+        paper.data['more'] = np.arange(10)
+        assert not paper.needs_repack()
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        paper.delete_item('/data/large')
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        assert paper.unused_space() >= 8000000
+        assert paper.needs_repack()
+        paper.close()
+        # Closing doesn't repack
+        assert os.path.getsize(filename) > new_size + 8000000
+        repack(filename)
+        paper = ActivePaper(filename, 'r')
+        assert paper.unused_space() == 0
+        assert paper.repack_threshold() == 0.5
+        paper.close()
+        assert os.path.getsize(filename) < new_size + 100000
+
+def test_repack_links_and_regions():
+    from activepapers.storage import repack
+    from activepapers.layout import CompressionPolicy
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['values'] = np.arange(100000)
+        target = paper.data_group['values']
+        # A second hard link to the same dataset
+        paper.data_group.create_group('links')['values'] = target
+        region_dtype = h5py.special_dtype(ref=h5py.RegionReference)
+        paper.data_group.create_dataset('region',
+                                        data=target.regionref[10:20],
+                                        dtype=region_dtype)
+        paper.close()
+        for policy in [None, CompressionPolicy('gzip', 1, True, 1024)]:
+            repack(filename, policy)
+            paper = ActivePaper(filename, 'r')
+            values = paper.data_group['values']
+            assert paper.data_group['links/values'].id == values.id
+            ref = paper.data_group['region'][()]
+            assert paper.file[ref].id == values.id
+            assert (paper.file[ref][ref] == np.arange(10, 20)).all()
+            paper.close()
+        assert os.path.getsize(filename) < 1000000
+
+def test_in_memory_papers():
+    with tempdir.TempDir() as t:
+        paper = ActivePaper("scratch", 'w', in_memory=True)
+        paper.data['x'] = np.arange(10)
+        calclet = paper.create_calclet("square",
+"""
+from activepapers.contents import data, open
+data['x2'] = data['x'][...]**2
+with open('notes.txt', 'w') as f:
+    f.write('done')
+""")
+        calclet.run()
+        assert not os.path.exists("scratch")
+        image = paper.to_bytes()
+        # The open paper's session has no closing time
+        assert paper.history[-1][1] == 0
+        filename = os.path.join(t, "paper.ap")
+        paper.save(filename)
+        paper.close()
+        paper = ActivePaper.from_bytes(image)
+        assert paper.history[-1][1] > 0
+        paper.close()
+        for paper in [ActivePaper(filename, 'r'),
+                      ActivePaper.from_bytes(image),
+                      ActivePaper(filename, 'r+', in_memory=True)]:
+            assert (paper.data['x2'][...] == np.arange(10)**2).all()
+            assert ascii(paper.data['notes.txt'][...].tostring()) == 'done'
+            paper.close()
+        # Modifications of an in-memory copy don't change the file
+        paper = ActivePaper.from_bytes(image, 'r+')
+        paper.data['y'] = 42
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert 'y' not in paper.data_group
+        paper.close()
+
+def test_cache_settings():
+    import activepapers.cache
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w',
+                            cache=dict(rdcc_nbytes=4*2**20, rdcc_w0=0.5,
+                                       mdc_nbytes=4*2**20))
+        nslots, nbytes, w0 = \
+            paper.file.id.get_access_plist().get_cache()[1:]
+        assert nbytes == 4*2**20
+        assert w0 == 0.5
+        assert paper.file.id.get_mdc_config().initial_size == 4*2**20
+        paper.data.create_dataset('x', shape=(100, 100000),
+                                  dtype=np.float64, chunks=(10, 100000))
+        paper.close()
+        # The largest chunk is recorded when the paper is closed
+        with h5py.File(filename, 'r') as h5file:
+            assert h5file.attrs['ACTIVE_PAPER_LARGEST_CHUNK'] == 8000000
+        paper = ActivePaper(filename, 'r+')
+        item = paper.data.create_group('item')
+        item.mark_as_data_item()
+        item.create_dataset('y', shape=(100, 200000),
+                            dtype=np.float64, chunks=(10, 200000))
+        paper.close()
+        with h5py.File(filename, 'r') as h5file:
+            assert h5file.attrs['ACTIVE_PAPER_LARGEST_CHUNK'] == 16000000
+        defaults = dict(activepapers.cache.defaults)
+        activepapers.cache.defaults['rdcc_nbytes'] = 'auto'
+        activepapers.cache.defaults['page_buf_size'] = 2**20
+        try:
+            paper = ActivePaper(filename, 'r')
+        finally:
+            activepapers.cache.defaults.clear()
+            activepapers.cache.defaults.update(defaults)
+        nslots, nbytes, w0 = \
+            paper.file.id.get_access_plist().get_cache()[1:]
+        assert nbytes == activepapers.cache.auto_chunks*16000000
+        paper.close()
+
+def test_file_format_options():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', libver='latest',
+                            track_order=True, page_size=4096)
+        for name in ['b', 'c', 'a']:
+            paper.data[name] = np.arange(10)
+        paper.data.create_group('g')
+        paper.close()
+        paper = ActivePaper(filename, 'r', cache=dict(page_buf_size=2**16))
+        assert list(paper.data_group) == ['b', 'c', 'a', 'g']
+        assert paper.data_group['g'].id.get_create_plist() \
+                                   .get_link_creation_order() != 0
+        assert paper.file_format() == dict(libver='latest', track_order=True,
+                                           page_size=4096)
+        repacked = os.path.join(t, "repacked.ap")
+        paper.repack(repacked)
+        paper.close()
+        paper = ActivePaper(repacked, 'r')
+        assert paper.file_format()['page_size'] == 4096
+        assert list(paper.data_group) == ['b', 'c', 'a', 'g']
+        paper.close()
+
+def test_split_layout():
+    from activepapers.storage import repack
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', split=True)
+        paper.data['x'] = np.arange(100000)
+        paper.close()
+        assert os.path.getsize(filename + '-raw') >= 800000
+        assert os.path.getsize(filename) < 100000
+        paper = ActivePaper(filename, 'r+')
+        assert paper.split
+        assert (paper.data['x'][...] == np.arange(100000)).all()
+        paper.data['y'] = np.arange(10)
+        paper.close()
+        repack(filename, split=False)
+        assert not os.path.exists(filename + '-raw')
+        paper = ActivePaper(filename, 'r')
+        assert not paper.split
+        assert (paper.data['x'][...] == np.arange(100000)).all()
+        paper.close()
+        repack(filename, split=True)
+        assert os.path.exists(filename + '-raw')
+        paper = ActivePaper(filename, 'r')
+        assert paper.split
+        assert (paper.data['y'][...] == np.arange(10)).all()
+        paper.close()
+
+def test_parallel_compression():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        data = np.sin(0.01*np.arange(100000.)).reshape((1000, 100))
+        for shuffle in [False, True]:
+            for workers in [None, 3]:
+                name = 'x%s%s' % (shuffle, workers)
+                paper.data.create_dataset(name, data=data,
+                                          chunks=(64, 30),
+                                          compression='gzip',
+                                          shuffle=shuffle, workers=workers)
+            serial = paper.data_group['x%sNone' % shuffle]
+            parallel = paper.data_group['x%s3' % shuffle]
+            assert (parallel[...] == data).all()
+            for offset in [(0, 0), (960, 90), (512, 60)]:
+                assert serial.id.read_direct_chunk(offset) \
+                       == parallel.id.read_direct_chunk(offset)
+        paper.close()
+
+def test_parallel_decompression():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        data = np.sin(0.01*np.arange(100000.)).reshape((1000, 100))
+        paper.data.create_dataset('x', data=data, chunks=(64, 30),
+                                  compression='gzip', shuffle=True)
+        paper.data.create_dataset('partial', shape=(100, 100),
+                                  dtype=np.int32, chunks=(10, 10),
+                                  compression='gzip', fillvalue=-1)
+        paper.data_group['partial'][:10, :10] = 1
+        ds = paper.data['x']
+        for selection in [Ellipsis, (slice(10, 900), slice(5, 95)),
+                          (500, Ellipsis), (slice(None), -1), (3, 4),
+                          (slice(None, None, 2),), (slice(100, 50),)]:
+            parallel = ds.read_parallel(selection, workers=3)
+            serial = ds[selection]
+            assert parallel.shape == serial.shape
+            assert (parallel == serial).all()
+        partial = paper.data['partial'].read_parallel(workers=2)
+        assert (partial == paper.data_group['partial'][...]).all()
+        paper.close()
+
+def test_raw_chunk_copy():
+    from activepapers.copying import CopyStatistics, copy_node
+    from activepapers.layout import copy_dataset
+    with tempdir.TempDir() as t:
+        source = h5py.File(os.path.join(t, "source.h5"), 'w')
+        data = np.arange(100000.).reshape((1000, 100))
+        group = source.create_group('group', track_order=True)
+        group.attrs['label'] = 'test'
+        ds = group.create_dataset('x', data=data, chunks=(100, 50),
+                                  compression='gzip', shuffle=True,
+                                  maxshape=(None, 100))
+        ds.attrs['unit'] = 'm'
+        group['y'] = ds
+        group['z'] = h5py.SoftLink('/group/x')
+        group.create_dataset('text', data=np.array(['a', 'bc'], dtype=object),
+                             dtype=h5py.string_dtype(), chunks=(1,))
+        dest = h5py.File(os.path.join(t, "dest.h5"), 'w')
+        statistics = CopyStatistics()
+        copy = copy_node(group, dest, 'copy', statistics)
+        x = copy['x']
+        assert (x[...] == data).all()
+        assert x.chunks == ds.chunks and x.maxshape == ds.maxshape
+        assert x.compression == 'gzip' and x.shuffle
+        assert x.attrs['unit'] == 'm' and copy.attrs['label'] == 'test'
+        assert copy['y'].id == x.id
+        assert copy.get('z', getlink=True).path == '/group/x'
+        assert list(copy['text'][...]) == [b'a', b'bc']
+        assert statistics.datasets == 2
+        assert statistics.nbytes['hdf5'] == ds.id.get_storage_size() \
+               + group['text'].id.get_storage_size()
+        # The same chunks and filters: the chunks are copied unchanged
+        statistics = CopyStatistics()
+        copy = copy_dataset(ds, dest, 'same',
+                            dict(chunks=(100, 50), compression='gzip',
+                                 shuffle=True), statistics)
+        assert (copy[...] == data).all()
+        assert statistics.nbytes == dict(chunks=ds.id.get_storage_size(),
+                                         blocks=0, hdf5=0)
+        # A different chunk shape requires recompression
+        statistics = CopyStatistics()
+        copy_dataset(ds, dest, 'rechunked',
+                     dict(chunks=(10, 100), compression='gzip'), statistics)
+        assert (dest['rechunked'][...] == data).all()
+        assert statistics.nbytes == dict(chunks=0, blocks=data.nbytes, hdf5=0)
+        source.close()
+        dest.close()
+
+def test_lazy_dependencies():
+    import sys
+    with tempdir.TempDir() as t:
+        with open(os.path.join(t, "apdependency.py"), 'w') as f:
+            f.write("__version__ = '1.0'\nvalue = 42\n")
+        sys.path.insert(0, t)
+        try:
+            filename = os.path.join(t, "paper.ap")
+            paper = ActivePaper(filename, 'w', dependencies=['apdependency'])
+            paper.create_calclet("calc",
+"""
+from activepapers.contents import data
+import apdependency
+data['x'] = apdependency.value
+""")
+            paper.close()
+            del sys.modules['apdependency']
+            paper = ActivePaper(filename, 'r', metadata_only=True)
+            assert 'apdependency' not in sys.modules
+            assert [item.name for item in paper.iter_items()] \
+                   == ['/code/calc']
+            try:
+                paper.data
+                assert False
+            except ValueError:
+                pass
+            paper.close()
+            paper = ActivePaper(filename, 'r')
+            assert 'apdependency' not in sys.modules
+            paper.import_dependencies()
+            assert 'apdependency' in sys.modules
+            paper.close()
+            del sys.modules['apdependency']
+            paper = ActivePaper(filename, 'r+')
+            assert 'apdependency' in sys.modules
+            paper.run_codelet('calc')
+            assert paper.data['x'][()] == 42
+            paper.close()
+        finally:
+            sys.path.remove(t)
+            sys.modules.pop('apdependency', None)
+
+@raises(ValueError)
+def test_metadata_only_requires_read_mode():
+    with tempdir.TempDir() as t:
+        ActivePaper(os.path.join(t, "paper.ap"), 'w', metadata_only=True)
+
+def test_appendable_datasets():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.create_calclet("calc",
+"""
+from activepapers.contents import data
+import numpy as np
+with data.create_appendable('rows', np.float64, (3,),
+                            buffer_rows=10) as appender:
+    for i in range(25):
+        appender.append([i, 2*i, 3*i])
+    appender.extend(np.ones((100, 3)))
+    appender.extend(np.zeros((2, 3)))
+    assert len(appender) == 127
+    assert appender.resizes < 10
+""").run()
+        rows = paper.data_group['rows']
+        assert rows.shape == (127, 3)
+        assert rows.maxshape == (None, 3)
+        assert (rows[:25, 1] == 2*np.arange(25)).all()
+        assert (rows[25:125] == 1.).all() and (rows[125:] == 0.).all()
+        assert ascii(rows.attrs['ACTIVE_PAPER_GENERATING_CODELET']) \
+               == '/code/calc'
+        paper.close()
+
+def test_tables():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.create_calclet("make_table",
+"""
+from activepapers.contents import data
+import numpy as np
+dtype = np.dtype([('id', np.int64), ('name', 'S8'), ('value', np.float64)])
+table = data.create_table('table', dtype, index=['id', 'value'])
+table.append(np.array([(i, b'row%d' % i, (7*i) % 50)
+                       for i in range(50000)], dtype=dtype))
+# Keys smaller than existing ones require a merge
+table.append((-1, b'first', 100.))
+table.append(np.array([(3, b'again', 0.5)], dtype=dtype))
+""").run()
+        paper.create_calclet("use_table",
+"""
+from activepapers.contents import data
+table = data.open_table('table')
+found = table.lookup(3)
+data['names'] = found['name']
+data['range'] = table.range(10., 11., field='value')['id']
+""").run()
+        assert list(paper.data_group['names'][...]) == [b'row3', b'again']
+        selected = paper.data_group['range'][...]
+        assert len(selected) == 1000 and (selected % 50 == 30).all()
+        deps = sorted(ascii(item.name) for item in
+                      paper.iter_dependencies(paper.data_group['names']))
+        assert deps == ['/code/make_table', '/code/use_table', '/data/table']
+        table = paper.data.open_table('table')
+        assert len(table) == 50002
+        assert table.lookup(-1)['name'][0] == b'first'
+        assert len(table.lookup(12345, field='id')) == 1
+        assert len(table.lookup(50000)) == 0
+        assert len(table.range(40000, 60000)) == 10000
+        paper.close()
@@ -6,7 +6,7 @@ import numpy as np
 import h5py
 import tempdir
 
-from activepapers.storage import ActivePaper
+from activepapers.storage import ActivePaper, APNode
 from activepapers.utility import ascii
 from activepapers import library
 
@@ -194,3 +194,157 @@ def test_copy():
             assert ascii(paper_ref) == "local:simple1"
             assert ascii(ref_path) == path
 
+
+def test_virtual_datasets():
+    with tempdir.TempDir() as t:
+        library.library = [t]
+        os.mkdir(os.path.join(t, "local"))
+        filename1 = os.path.join(t, "local/simple1.ap")
+        filename2 = os.path.join(t, "simple2.ap")
+        make_simple_paper(filename1)
+        paper = ActivePaper(filename2, 'w')
+        ds = paper.create_virtual("/data/combined",
+                                  [("local:simple1", "/data/time",
+                                    np.s_[10:20]),
+                                   ("local:simple1", "/data/sine")])
+        assert ds.is_virtual
+        assert ds.shape == (110,)
+        time = 0.1*np.arange(100)
+        assert (ds[:10] == time[10:20]).all()
+        assert (ds[10:] == np.sin(2.*np.pi*0.2*time)).all()
+        refs = paper.external_references()
+        assert refs[b"local:simple1"][0] == set([b"/data/time",
+                                                 b"/data/sine"])
+        assert ds.id.get_storage_size() == 0
+        new = paper.materialize("/data/combined")
+        assert not new.is_virtual
+        assert (new[:10] == time[10:20]).all()
+        refs = paper.external_references()
+        assert refs[b"local:simple1"][1] == set([b"/data/time",
+                                                 b"/data/sine"])
+        assert 'ACTIVE_PAPER_TIMESTAMP' in new.attrs
+        paper.close()
+
+
+def test_paper_pool():
+    from activepapers.storage import paper_pool, APNode
+    with tempdir.TempDir() as t:
+        library.library = [t]
+        os.mkdir(os.path.join(t, "local"))
+        for i in range(3):
+            make_simple_paper(os.path.join(t, "local/simple%d.ap" % i))
+        filename = os.path.join(t, "refs.ap")
+        paper = ActivePaper(filename, "w")
+        for i in range(3):
+            paper.create_data_ref("time%d" % i, "local:simple%d" % i, "time")
+        paper.close()
+        max_open = paper_pool.max_open
+        paper_pool.clear()
+        paper_pool.set_max_open(2)
+        try:
+            paper = ActivePaper(filename, "r")
+            root = APNode(paper.file)
+            start = paper_pool.statistics()
+            times = [root['data/time%d' % i] for i in range(3)]
+            # The referenced papers are opened on first use
+            assert paper_pool.statistics()['misses'] == start['misses']
+            assert [node.shape for node in times] == 3*[(100,)]
+            stats = paper_pool.statistics()
+            assert stats['open'] == 2
+            assert stats['misses'] - start['misses'] == 3
+            assert stats['evictions'] - start['evictions'] == 1
+            # The first paper was closed, and is reopened on access
+            assert_almost_equal(times[0][...], 0.1*np.arange(100), 1.e-10)
+            stats = paper_pool.statistics()
+            assert stats['evictions'] - start['evictions'] == 2
+            root['data/time0'].shape
+            assert paper_pool.statistics()['hits'] - stats['hits'] == 1
+            paper.close()
+        finally:
+            paper_pool.set_max_open(max_open)
+
+
+def test_pinned_papers():
+    from activepapers.storage import paper_pool
+    with tempdir.TempDir() as t:
+        library.library = [t]
+        os.mkdir(os.path.join(t, "local"))
+        for i in range(2):
+            make_simple_paper(os.path.join(t, "local/simple%d.ap" % i))
+        filename = os.path.join(t, "refs.ap")
+        paper = ActivePaper(filename, "w")
+        for i in range(2):
+            paper.create_data_ref("time%d" % i, "local:simple%d" % i, "time")
+        paper.close()
+        max_open = paper_pool.max_open
+        paper_pool.clear()
+        paper_pool.set_max_open(1)
+        try:
+            paper = ActivePaper(filename, "r")
+            # The wrappers keep their papers open
+            times = [paper.data['time%d' % i] for i in range(2)]
+            stats = paper_pool.statistics()
+            assert stats['open'] == 2 and stats['pinned'] == 2
+            for i in range(2):
+                assert_almost_equal(times[i][...], 0.1*np.arange(100),
+                                    1.e-10)
+            # Papers without wrappers are closed
+            del times
+            stats = paper_pool.statistics()
+            assert stats['open'] == 1 and stats['pinned'] == 0
+            paper.close()
+        finally:
+            paper_pool.set_max_open(max_open)
+
+
+def test_reference_cache():
+    with tempdir.TempDir() as t:
+        library.library = [t]
+        os.mkdir(os.path.join(t, "local"))
+        filename1 = os.path.join(t, "local/simple1.ap")
+        filename2 = os.path.join(t, "simple2.ap")
+        make_simple_paper(filename1)
+        make_simple_paper_with_data_refs(filename2, "local:simple1")
+        paper = ActivePaper(filename2, 'r+')
+        cache = paper.reference_cache
+        node = APNode(paper.data_group)
+        for i in range(10):
+            assert node['time_from_ref'][5] == 0.5
+        stats = cache.statistics()
+        assert stats['misses'] == 1 and stats['hits'] == 9
+        # Changing the reference invalidates the cached target
+        paper.create_data_ref("time_from_ref", "local:simple1", "sine")
+        assert cache.statistics()['invalidations'] == 1
+        assert node['time_from_ref'][0] == 0.
+        assert cache.statistics()['misses'] == 2
+        paper.close()
+        assert len(cache) == 0
+
+
+def test_lazy_references():
+    from activepapers.storage import paper_pool
+    with tempdir.TempDir() as t:
+        library.library = [t]
+        os.mkdir(os.path.join(t, "local"))
+        filename1 = os.path.join(t, "local/library.ap")
+        filename2 = os.path.join(t, "simple.ap")
+        make_library_paper(filename1)
+        make_simple_paper_with_library_refs(filename2, "local:library")
+        assert library.find_in_library("local:library") == filename1
+        paper_pool.clear()
+        paper = ActivePaper(filename2, "r")
+        node = APNode(paper.code_group)['python-packages/my_math']
+        assert node.name == '/code/python-packages/my_math'
+        assert not node.in_paper(paper)
+        assert filename1 not in paper_pool
+        assert node.attrs['ACTIVE_PAPER_DATATYPE'] == 'module'
+        assert filename1 in paper_pool
+        paper.close()
+        # A paper that was moved within the library is found again
+        more = os.path.join(t, "more")
+        os.makedirs(os.path.join(more, "local"))
+        library.library = [t, more]
+        assert library.find_in_library("local:library") == filename1
+        moved = os.path.join(more, "local", "library.ap")
+        os.rename(filename1, moved)
+        assert library.find_in_library("local:library") == moved